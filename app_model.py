@@ -0,0 +1,95 @@
+import sys
+
+# The keys of a server_info.json AppID section that hold parsed Steam data, everything else is settings
+STEAM_KEYS = ('name', 'build_id', 'branch', 'branches', 'build_ids', 'password_required')
+
+
+class Branch:
+    __slots__ = ('name', 'build_id', 'password_required')
+
+    def __init__(self, name, build_id=None, password_required=None):
+        self.name = sys.intern(name)
+        self.build_id = build_id
+        self.password_required = password_required
+
+    def __eq__(self, other):
+        return isinstance(other, Branch) and (self.name, self.build_id, self.password_required) == \
+            (other.name, other.build_id, other.password_required)
+
+    def __repr__(self):
+        return f"Branch({self.name!r}, {self.build_id!r}, {self.password_required!r})"
+
+
+# The Steam data of one tracked app. Branch names are interned, so the names shared by many apps ('public', 'beta',
+# ...) are stored once, and the build ID of an AppID and branch is one dict lookup. The branches are kept as a
+# tuple of names, a name -> build ID dict and the set of password protected names rather than one object per
+# branch, Branch records are built when asked for. Records are never modified once stored, a refresh replaces
+# the whole record.
+class App:
+    __slots__ = ('name', 'build_id', 'branch', 'branch_names', 'build_ids', 'password_protected')
+
+    def __init__(self, name, build_id, branch='public', branch_names=(), build_ids=None, password_protected=()):
+        self.name = name
+        self.build_id = build_id
+        self.branch = sys.intern(branch) if branch is not None else None
+        self.branch_names = tuple(sys.intern(name) for name in branch_names)
+        self.build_ids = {sys.intern(name): build_id for name, build_id in (build_ids or {}).items()}
+        self.password_protected = frozenset(sys.intern(name) for name in password_protected)
+
+    def __eq__(self, other):
+        return isinstance(other, App) and all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    def __repr__(self):
+        return f"App({self.name!r}, {self.build_id!r}, {self.branch!r}, {len(self.branch_names)} branches)"
+
+    def branch_build_id(self, branch=None):
+        return self.build_ids.get(branch or self.branch)
+
+    def get_branch(self, name):
+        if name not in self.build_ids and name not in self.branch_names:
+            return None
+        return Branch(name, self.build_ids.get(name), name in self.password_protected)
+
+    def branches(self):
+        return [Branch(name, self.build_ids.get(name), name in self.password_protected) for name in self.branch_names]
+
+    # From the persisted format. Sections written before build_ids existed only know the public build ID.
+    @classmethod
+    def from_section(cls, section):
+        build_ids = {name: build_id for name, build_id in (section.get('build_ids') or {}).items()
+                     if build_id is not None}
+        if 'build_ids' not in section and section.get('build_id') is not None:
+            build_ids['public'] = section['build_id']
+        password_required = section.get('password_required') or {}
+        names = list(section.get('branches') or ())
+        known = set(names)
+        names += [name for name in list(build_ids) + list(password_required) if name not in known]
+        return cls(section.get('name'), section.get('build_id'), section.get('branch'), dict.fromkeys(names),
+                   build_ids, [name for name, required in password_required.items() if required])
+
+    # To the persisted format, new containers on every call
+    def to_section(self):
+        return {
+            "name": self.name,
+            "build_id": self.build_id,
+            "branch": self.branch,
+            "branches": list(self.branch_names),
+            "build_ids": dict(self.build_ids),
+            "password_required": {name: name in self.password_protected for name in self.branch_names},
+        }
+
+
+# Split a persisted AppID section into its Steam data record (None without Steam data) and the remaining settings
+def split_section(section):
+    if not any(key in section for key in ('branches', 'build_ids', 'build_id')):
+        return None, section
+    settings = {key: value for key, value in section.items() if key not in STEAM_KEYS}
+    return App.from_section(section), settings
+
+
+def join_section(app, settings):
+    if app is None:
+        return settings
+    section = dict(settings)
+    section.update(app.to_section())
+    return section
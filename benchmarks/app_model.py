@@ -0,0 +1,93 @@
+"""Memory and lookup cost of the tracked app data as nested dicts versus app_model records.
+
+Builds --apps AppID sections with --branches branches each in the persisted server_info.json format. For both
+forms it reports:
+- the memory they take after loading them from JSON (tracemalloc)
+- the time to look up the build ID of the tracked branch of every app, the way the fleet heartbeat and the
+  steamcmd outdated check do: from a copy of the section before, from the record now
+- the time to serialize everything back to the persisted format
+
+    python benchmarks/app_model.py [--apps 500] [--branches 40]
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app_model import split_section, join_section  # noqa: E402
+
+
+def make_sections(apps, branches):
+    sections = {}
+    for app_id in range(apps):
+        names = ['public'] + [f'branch-{index}' for index in range(branches - 1)]
+        sections[str(app_id)] = {
+            "name": f"App {app_id}",
+            "build_id": str(10_000_000 + app_id),
+            "branch": 'public',
+            "branches": names,
+            "build_ids": {name: str(10_000_000 + app_id + index) for index, name in enumerate(names)},
+            "password_required": {name: index % 3 == 0 for index, name in enumerate(names)},
+            "installed_build_id": str(10_000_000 + app_id),
+        }
+    return sections
+
+
+def measure_memory(build):
+    tracemalloc.start()
+    value = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return value, size
+
+
+def best_of(func, runs=5):
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--apps', type=int, default=500)
+    parser.add_argument('--branches', type=int, default=40)
+    args = parser.parse_args()
+
+    template = make_sections(args.apps, args.branches)
+    # Both forms are loaded from JSON text like server_info.json, so neither shares strings with the template
+    content = json.dumps(template)
+    sections, dict_size = measure_memory(lambda: json.loads(content))
+    records, record_size = measure_memory(lambda: {app_id: split_section(section)
+                                                    for app_id, section in json.loads(content).items()})
+
+    def dict_lookups():
+        for section in sections.values():
+            app_data = copy.deepcopy(section)
+            (app_data.get('build_ids') or {}).get(app_data.get('branch', 'public'))
+
+    def record_lookups():
+        for app, settings in records.values():
+            app.branch_build_id(app.branch)
+            dict(settings)
+
+    def serialize():
+        return {app_id: join_section(app, settings) for app_id, (app, settings) in records.items()}
+
+    assert serialize() == template
+    print(f"{args.apps} apps with {args.branches} branches each")
+    print(f"{'form':<8} {'memory MB':>10} {'lookups ms':>11}")
+    print(f"{'dicts':<8} {dict_size / 1e6:>10.2f} {best_of(dict_lookups) * 1000:>11.2f}")
+    print(f"{'records':<8} {record_size / 1e6:>10.2f} {best_of(record_lookups) * 1000:>11.2f}")
+    print(f"Serializing the records to the persisted format: {best_of(serialize) * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
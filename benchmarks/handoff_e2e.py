@@ -0,0 +1,217 @@
+"""End-to-end check of the blue/green handoff of core.py against a local stand-in for the Discord gateway
+(Linux/macOS).
+
+The driver clones the committed code into a sandbox that stands in for BOT_DIRECTORY and runs a tiny gateway.
+Like Discord, the gateway delivers every message to every connected bot process. The bot processes import the
+real core module and skip the Discord login. Every message goes through bot.dispatch('message'), so it takes the
+path of a real message: GameManagerBot.process_commands, the command limiter and the command. The commands are:
+- *ping <id>: answers the gateway after a short delay
+- *update: runs core.hand_off_to_successor, started in place of the real *update. It starts this script as the
+  successor, which reports ready from core.on_ready through core.take_over_from_predecessor.
+
+The process the driver started plays the one the service wrapper owns. It must stay alive after the handoff
+(core.stay_for_successor). When it gets SIGTERM it must stop the successor too. The driver reports:
+- duplicated and unanswered commands
+- the gap between the last command answered by the old process and the first one answered by the new one
+- whether the wrapper-owned process stayed alive and stopped the successor
+
+Needs the bot's dependencies (discord.py, GitPython) installed. No token is used, the bot never connects.
+
+    python benchmarks/handoff_e2e.py [--startup-delay 1.5] [--duration 4]
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMAND_INTERVAL = 0.01
+COMMAND_DURATION = 0.05
+
+
+class FakeUser:
+    def __init__(self, user_id, name, bot=False):
+        self.id = user_id
+        self.name = name
+        self.bot = bot
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+
+# Only what get_context, argument parsing, the command limiter and the commands read from a message
+class FakeMessage:
+    def __init__(self, state, message_id, content):
+        self._state = state
+        self.id = message_id
+        self.content = content
+        self.author = FakeUser(1000 + message_id % 50, 'member')
+        self.channel = FakeChannel(1)
+        self.guild = None
+        self.attachments = []
+
+
+# hand_off_to_successor reports through ctx.send, the messages go to stderr
+class Reporter:
+    async def send(self, content=None, **kwargs):
+        print(f"[{os.getpid()}] {content}", file=sys.stderr, flush=True)
+
+
+# A bot process: the real core module, connected to the stand-in gateway after startup_delay (the login)
+async def run_bot(gateway_port, startup_delay):
+    sys.path.insert(0, os.getcwd())
+    import core
+    bot = core.bot
+    writer = None
+
+    async def answer(command_id):
+        writer.write(json.dumps({"id": command_id, "pid": os.getpid()}).encode() + b'\n')
+        await writer.drain()
+
+    bot.remove_command('update')
+
+    @bot.command(name='update')
+    async def update(ctx, command_id: int):
+        await answer(command_id)
+        command = [sys.executable, os.path.abspath(__file__), '--role', 'bot', '--gateway-port', str(gateway_port),
+                   '--startup-delay', str(startup_delay)]
+        await core.hand_off_to_successor(Reporter(), [], command=command)
+
+    @bot.command(name='ping')
+    async def ping(ctx, command_id: int):
+        await asyncio.sleep(COMMAND_DURATION)
+        await answer(command_id)
+
+    async with bot:
+        await asyncio.sleep(startup_delay)
+        reader, writer = await asyncio.open_connection('127.0.0.1', gateway_port)
+        bot._connection.user = FakeUser(1, 'GameManager', bot=True)
+        # Runs core.on_ready, which starts take_over_from_predecessor in a successor
+        bot.dispatch('ready')
+
+        async def read_messages():
+            while line := await reader.readline():
+                # A closed bot has no event loop to dispatch on anymore
+                if bot.is_closed():
+                    break
+                command = json.loads(line)
+                bot.dispatch('message', FakeMessage(bot._connection, command['id'], command['content']))
+
+        read_task = asyncio.create_task(read_messages())
+        while not bot.is_closed() and not read_task.done():
+            await asyncio.sleep(0.05)
+        read_task.cancel()
+        writer.close()
+    return await core.stay_for_successor()
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+async def wait_exit(pid, timeout):
+    deadline = time.monotonic() + timeout
+    while process_alive(pid) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    return not process_alive(pid)
+
+
+async def drive(sandbox, startup_delay, duration, log_level):
+    clients = set()
+    answers = {}
+    sent_at = {}
+
+    async def handle(reader, writer):
+        clients.add(writer)
+        try:
+            while line := await reader.readline():
+                answer = json.loads(line)
+                answers.setdefault(answer['id'], []).append((answer['pid'], time.perf_counter()))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            clients.discard(writer)
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    env = dict(os.environ, HANDOFF_ENABLED='true', METRICS_PORT='0', FLEET_STORE='memory', LOG_LEVEL=log_level,
+               COMMAND_USER_RATE='0', COMMAND_CHANNEL_RATE='0', COMMAND_MAX_QUEUE='100000')
+    first = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), '--role', 'bot', '--gateway-port',
+        str(port), '--startup-delay', '0', cwd=sandbox, env=env)
+    while not clients:
+        await asyncio.sleep(0.01)
+
+    command_id = 0
+    update_sent = None
+    start_time = time.perf_counter()
+    while time.perf_counter() < start_time + duration + startup_delay:
+        command_id += 1
+        content = f'*ping {command_id}'
+        if update_sent is None and time.perf_counter() > start_time + 0.5:
+            content = f'*update {command_id}'
+            update_sent = command_id
+        sent_at[command_id] = time.perf_counter()
+        for writer in list(clients):
+            writer.write(json.dumps({"id": command_id, "content": content}).encode() + b'\n')
+        await asyncio.sleep(COMMAND_INTERVAL)
+    await asyncio.sleep(COMMAND_DURATION * 2)
+
+    pids = {pid for entries in answers.values() for pid, _ in entries}
+    successors = pids - {first.pid}
+    # The wrapper-owned process must still run, and stopping it must stop the successor
+    first_alive = first.returncode is None
+    first.send_signal(signal.SIGTERM)
+    await asyncio.wait_for(first.wait(), 30)
+    successors_stopped = all([await wait_exit(pid, 30) for pid in successors])
+
+    for writer in list(clients):
+        writer.close()
+    server.close()
+
+    duplicated = [command_id for command_id, entries in answers.items() if len(entries) > 1]
+    unanswered = [command_id for command_id in sent_at if command_id not in answers]
+    old_answers = [at for entries in answers.values() for pid, at in entries if pid == first.pid]
+    new_answers = [at for entries in answers.values() for pid, at in entries if pid != first.pid]
+    print(f"Sent {len(sent_at)} commands, update was command {update_sent}")
+    print(f"Answered by {len(pids)} processes, {len(duplicated)} duplicated, {len(unanswered)} unanswered")
+    if old_answers and new_answers:
+        print(f"Gap between the last old and the first new answer: "
+              f"{(min(new_answers) - max(old_answers)) * 1000:.1f}ms (successor startup took {startup_delay}s)")
+    print(f"Wrapper-owned process alive after the handoff: {first_alive}, exited with {first.returncode} on "
+          f"SIGTERM, successor stopped with it: {successors_stopped}")
+    ok = len(pids) == 2 and not duplicated and not unanswered and new_answers and first_alive and successors_stopped
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--role', choices=('driver', 'bot'), default='driver')
+    parser.add_argument('--root', default=ROOT)
+    parser.add_argument('--gateway-port', type=int)
+    parser.add_argument('--startup-delay', type=float, default=1.5)
+    parser.add_argument('--duration', type=float, default=4)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    if args.role == 'bot':
+        sys.exit(asyncio.run(run_bot(args.gateway_port, args.startup_delay)))
+    with tempfile.TemporaryDirectory() as directory:
+        sandbox = os.path.join(directory, 'production')
+        subprocess.run(['git', 'clone', '--quiet', args.root, sandbox], check=True)
+        sys.exit(asyncio.run(drive(sandbox, args.startup_delay, args.duration, args.log_level)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,379 @@
+"""Load test of the real cogs and *update against local stand-ins for Discord, Steam and GitHub.
+
+The driver copies the committed code into a sandbox:
+- a bare repository stands in for GIT_REPO_URL
+- a clone of it stands in for BOT_DIRECTORY
+
+It then runs the scenarios in a second interpreter started from that clone, so *update deploys into the sandbox
+and never into this checkout. Each scenario calls the command callbacks of RoleCog, UtilityCog, AppIDCog and the
+core update command with fake contexts:
+- query_role: a guild with --members members and --roles roles, with and without the role index
+- info: the embed with the cached git info
+- steam_refresh: BuildIDPoller.poll over --app-ids AppIDs. The real SteamWorker runs with a fake SteamClient
+  that answers after --steam-latency seconds. The first poll is cold, later polls only download the apps that
+  changed since the previous poll.
+- update: --update-callers concurrent *update commands per new commit through the command limiter, so one deploys
+  and the others are turned away
+
+It reports throughput, p50/p99 latency and the event loop lag measured while each scenario ran. Needs the bot's
+dependencies (discord.py, steam, gevent, GitPython) installed. No token is used, the bot never connects.
+
+    python benchmarks/load_test.py [--members 10000] [--app-ids 200] [--steam-latency 0.05]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def git(*args, cwd=None):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, stdout=subprocess.PIPE, text=True).stdout.strip()
+
+
+# Discord stand-ins, only the attributes the cogs use
+
+class FakeRole:
+    def __init__(self, guild, role_id, name, position):
+        self.guild = guild
+        self.id = role_id
+        self.name = name
+        self.position = position
+
+    # Like discord.py, a scan over every member of the guild
+    @property
+    def members(self):
+        return [member for member in self.guild.members if self.id in member.role_ids]
+
+
+class FakePermissions:
+    administrator = True
+    embed_links = True
+
+
+class FakeMember:
+    def __init__(self, guild, member_id, joined_at, roles):
+        self.guild = guild
+        self.id = member_id
+        self.name = f'member{member_id}'
+        self.display_name = self.name
+        self.discriminator = '0'
+        self.joined_at = joined_at
+        self.roles = roles
+        self.role_ids = {role.id for role in roles}
+        self.mention = f'<@{member_id}>'
+        self.guild_permissions = FakePermissions()
+
+
+# Every member has the default role, role i is given to every member with probability 1 / (i + 2)
+class FakeGuild:
+    def __init__(self, guild_id, member_count, role_count, seed=1):
+        rng = random.Random(seed)
+        self.id = guild_id
+        self.name = f'Guild {guild_id}'
+        self.roles = [FakeRole(self, guild_id, '@everyone', 0)]
+        self.roles += [FakeRole(self, guild_id * 1000 + index, f'Role {index}', index + 1)
+                       for index in range(role_count)]
+        start = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        self.members = []
+        for index in range(member_count):
+            roles = [self.roles[0]] + [role for position, role in enumerate(self.roles[1:])
+                                       if rng.random() < 1 / (position + 2)]
+            joined_at = start + datetime.timedelta(seconds=rng.randrange(100_000_000))
+            self.members.append(FakeMember(self, guild_id * 10_000_000 + index, joined_at, roles))
+        self.members_by_id = {member.id: member for member in self.members}
+        self.member_count = member_count
+        self.text_channels = [object()] * 20
+        self.voice_channels = [object()] * 5
+        self.me = self.members[0]
+
+    def get_member(self, member_id):
+        return self.members_by_id.get(member_id)
+
+
+class FakeMessage:
+    def __init__(self, message_id, content=''):
+        self.id = message_id
+        self.content = content
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+
+    async def add_reaction(self, emoji):
+        pass
+
+    async def remove_reaction(self, emoji, user):
+        pass
+
+    async def clear_reactions(self):
+        pass
+
+    async def edit(self, **kwargs):
+        pass
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+    def permissions_for(self, member):
+        return FakePermissions()
+
+
+# Page navigation never gets a reaction, the paginator stops right after sending its first page
+class FakeBot:
+    async def wait_for(self, event, timeout=None, check=None):
+        raise asyncio.TimeoutError()
+
+
+class FakeContext:
+    message_ids = 0
+
+    def __init__(self, guild, author, channel_id=1, content=''):
+        FakeContext.message_ids += 1
+        self.bot = FakeBot()
+        self.guild = guild
+        self.author = author
+        self.channel = FakeChannel(channel_id)
+        self.message = FakeMessage(FakeContext.message_ids, content)
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content if content is not None else kwargs)
+        FakeContext.message_ids += 1
+        return FakeMessage(FakeContext.message_ids)
+
+
+# Steam stand-in for steam.client.SteamClient. Every request waits latency seconds in gevent, like a request to
+# Steam would. changes_per_poll apps get a new build before every change query.
+class FakeSteamClient:
+    latency = 0.05
+    app_count = 200
+    changes_per_poll = 5
+
+    def __init__(self):
+        import gevent
+        self.gevent = gevent
+        self.logged_on = False
+        self.verbose_debug = False
+        self.change_number = 1000
+        self.apps = {app_id: self.make_app(app_id, 1) for app_id in range(1, self.app_count + 1)}
+
+    @staticmethod
+    def make_app(app_id, build):
+        branches = {f'branch-{index}': {"buildid": str(build * 100 + index), "pwdrequired": str(index % 2)}
+                    for index in range(10)}
+        branches['public'] = {"buildid": str(build * 100)}
+        return {"common": {"name": f"App {app_id}"}, "depots": {"branches": branches}, "_change_number": 1000,
+                "_missing_token": False}
+
+    def anonymous_login(self):
+        from steam.enums import EResult
+        self.gevent.sleep(self.latency)
+        self.logged_on = True
+        return EResult.OK
+
+    def logout(self):
+        self.logged_on = False
+
+    def disconnect(self):
+        pass
+
+    def get_changes_since(self, change_number, app_changes=True, package_changes=False):
+        self.gevent.sleep(self.latency)
+        for app_id in random.sample(sorted(self.apps), min(self.changes_per_poll, len(self.apps))):
+            self.change_number += 1
+            build = int(self.apps[app_id]['depots']['branches']['public']['buildid']) // 100 + 1
+            self.apps[app_id] = self.make_app(app_id, build)
+            self.apps[app_id]['_change_number'] = self.change_number
+        changes = [types.SimpleNamespace(appid=app_id, change_number=app['_change_number'])
+                   for app_id, app in self.apps.items() if app['_change_number'] > change_number]
+        return types.SimpleNamespace(current_change_number=self.change_number, force_full_update=False,
+                                     force_full_app_update=False, app_changes=changes)
+
+    def get_access_tokens(self, app_ids=(), package_ids=()):
+        self.gevent.sleep(self.latency)
+        return {"apps": {app_id: 0 for app_id in app_ids}, "packages": {}}
+
+    def get_product_info(self, apps=(), packages=(), timeout=15, **kwargs):
+        self.gevent.sleep(self.latency)
+        app_ids = [app[0] if isinstance(app, tuple) else app for app in apps]
+        return {"apps": {app_id: json.loads(json.dumps(self.apps[app_id])) for app_id in app_ids
+                         if app_id in self.apps}}
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q / 100 * len(samples)))] if samples else 0.0
+
+
+# Run operation(index) count times with at most concurrency at once, return the scenario's row
+async def run_scenario(name, operation, count, concurrency, metrics):
+    registry = metrics.MetricsRegistry()
+    monitor = metrics.LoopLagMonitor(registry, interval=0.005)
+    monitor.start()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def timed(index):
+        async with semaphore:
+            start_time = time.perf_counter()
+            await operation(index)
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(timed(index) for index in range(count)))
+    duration = time.perf_counter() - start_time
+    monitor.stop()
+    lags = list(registry.histograms.get('event_loop_lag_seconds', {}).get((), metrics.Histogram()).recent)
+    return {"scenario": name, "count": count, "throughput": count / duration, "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99), "lag_p99": percentile(lags, 99), "lag_max": max(lags, default=0.0)}
+
+
+async def run(args):
+    sys.path.insert(0, args.root)
+    import steam.client
+    steam.client.SteamClient = FakeSteamClient
+    FakeSteamClient.latency = args.steam_latency
+    FakeSteamClient.app_count = args.app_ids
+    FakeSteamClient.changes_per_poll = args.changed_per_poll
+
+    import core
+    import metrics
+    from extensions.appid import AppIDCog
+    from extensions.role import RoleCog
+    from extensions.utility import UtilityCog
+
+    rows = []
+    async with core.bot:
+        role_cog = RoleCog(core.bot)
+        utility_cog = UtilityCog(core.bot)
+        appid_cog = AppIDCog(core.bot)
+        for cog in (role_cog, utility_cog, appid_cog):
+            await core.bot.add_cog(cog)
+
+        build_start = time.perf_counter()
+        guild = FakeGuild(1, args.members, args.roles)
+        unindexed_guild = FakeGuild(2, args.members, args.roles)
+        core.role_index.build(guild)
+        print(f"Built guilds of {args.members} members and {args.roles} roles and indexed one in "
+              f"{time.perf_counter() - build_start:.1f}s", flush=True)
+
+        async def query_role(index, target=guild):
+            ctx = FakeContext(target, target.members[index % len(target.members)], channel_id=index)
+            await role_cog.query_role.callback(role_cog, ctx, query=f"Role {index % 3} --page {index % 5 + 1}")
+
+        async def query_role_unindexed(index):
+            await query_role(index, unindexed_guild)
+
+        async def info(index):
+            ctx = FakeContext(guild, guild.members[index], channel_id=index)
+            await utility_cog.info.callback(utility_cog, ctx)
+
+        rows.append(await run_scenario('query_role', query_role, args.queries, args.concurrency, metrics))
+        rows.append(await run_scenario('query_role unindexed', query_role_unindexed, max(1, args.queries // 10),
+                                       args.concurrency, metrics))
+        rows.append(await run_scenario('info', info, args.queries, args.concurrency, metrics))
+
+        store = core.server_store
+        await store.ensure_loaded()
+        for app_id in range(1, args.app_ids + 1):
+            store.set(core.COMPUTER_NAME, str(app_id), {})
+        await appid_cog.cog_load()
+
+        async def steam_refresh(index):
+            results, failures = await appid_cog.poller.poll(force=True)
+            if failures:
+                raise RuntimeError(f"{len(failures)} AppIDs failed: {next(iter(failures.values()))}")
+
+        rows.append(await run_scenario(f'steam_refresh cold ({args.app_ids} apps)', steam_refresh, 1, 1, metrics))
+        rows.append(await run_scenario(f'steam_refresh ({args.app_ids} apps)', steam_refresh, args.polls, 1,
+                                       metrics))
+        await appid_cog.cog_unload()
+
+        outcomes = []
+
+        async def update(index):
+            if index % args.update_callers == 0:
+                with open(os.path.join(args.work, 'README.md'), 'a') as f:
+                    f.write(f"\nLoad test update {index}\n")
+                git('-c', 'user.name=Load Test', '-c', 'user.email=load@example.com', 'commit', '--quiet', '-am',
+                    f'Load test update {index}', cwd=args.work)
+                git('push', '--quiet', 'origin', 'HEAD', cwd=args.work)
+            ctx = FakeContext(guild, guild.members[index], channel_id=10_000 + index, content='*update')
+            outcomes.append(await core.command_limiter.run('update', ctx.author.id, ctx.channel.id,
+                                                           ctx.message.content, core.update.callback, ctx))
+            if outcomes[-1] is None and not any('No action taken' in str(sent) or 'Deployed' in str(sent)
+                                                for sent in ctx.sent):
+                raise RuntimeError(f"*update did not deploy: {ctx.sent}")
+
+        # One round of concurrent callers per new commit
+        for round_index in range(args.update_rounds):
+            offset = round_index * args.update_callers
+            row = await run_scenario(f'update x{args.update_callers}', lambda index: update(offset + index),
+                                     args.update_callers, args.update_callers, metrics)
+            rows.append(row)
+        print(f"Updates: {sum(outcome is None for outcome in outcomes)} deployed, "
+              f"{sum(outcome is not None and outcome[0] == 'busy' for outcome in outcomes)} turned away")
+
+        await store.close()
+    print(json.dumps(rows))
+
+
+def drive(args):
+    with tempfile.TemporaryDirectory() as directory:
+        origin = os.path.join(directory, 'origin.git')
+        production = os.path.join(directory, 'production')
+        work = os.path.join(directory, 'work')
+        git('clone', '--quiet', '--bare', args.root, origin)
+        git('clone', '--quiet', origin, production)
+        git('clone', '--quiet', origin, work)
+        env = dict(os.environ, GIT_REPO_URL=origin, METRICS_PORT='0', LOG_LEVEL=args.log_level,
+                   FLEET_STORE='memory', HANDOFF_ENABLED='false', STEAM_INFO_FRESHNESS='0')
+        command = [sys.executable, os.path.abspath(__file__), '--role', 'run', '--root', production, '--work', work]
+        for option in ('members', 'roles', 'queries', 'concurrency', 'app_ids', 'polls', 'changed_per_poll',
+                       'steam_latency', 'update_rounds', 'update_callers'):
+            command += [f"--{option.replace('_', '-')}", str(getattr(args, option))]
+        output = subprocess.run(command, cwd=production, env=env, check=True, stdout=subprocess.PIPE,
+                                text=True).stdout
+    lines = output.strip().splitlines()
+    print('\n'.join(lines[:-1]))
+    rows = json.loads(lines[-1])
+    print(f"{'scenario':<34} {'count':>6} {'ops/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'lag p99 ms':>11} "
+          f"{'lag max ms':>11}")
+    for row in rows:
+        print(f"{row['scenario'][:34]:<34} {row['count']:>6} {row['throughput']:>9.1f} {row['p50'] * 1000:>9.1f} "
+              f"{row['p99'] * 1000:>9.1f} {row['lag_p99'] * 1000:>11.1f} {row['lag_max'] * 1000:>11.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--role', choices=('driver', 'run'), default='driver')
+    parser.add_argument('--root', default=ROOT)
+    parser.add_argument('--work')
+    parser.add_argument('--members', type=int, default=10_000)
+    parser.add_argument('--roles', type=int, default=20)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--app-ids', type=int, default=200)
+    parser.add_argument('--polls', type=int, default=10)
+    parser.add_argument('--changed-per-poll', type=int, default=5)
+    parser.add_argument('--steam-latency', type=float, default=0.05)
+    parser.add_argument('--update-rounds', type=int, default=2)
+    parser.add_argument('--update-callers', type=int, default=4)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    if args.role == 'run':
+        asyncio.run(run(args))
+    else:
+        drive(args)
+
+
+if __name__ == '__main__':
+    main()
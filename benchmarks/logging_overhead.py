@@ -0,0 +1,124 @@
+"""Per-command logging overhead of the development and production logging modes.
+
+Runs the log calls of one AppID refresh (the command line, the full product info payload at DEBUG, the parsed
+values and the summary) many times and reports the time spent on the calling thread, which is the time the
+event loop is blocked. Both modes run with eager f-string calls and with deferred %-formatting, all at the same
+--level, so the rows separate the two changes: deferred formatting (eager versus lazy in one mode) and the queue
+handler (development versus production with the same calls). Every run uses a fresh interpreter since logging is
+configured once per process.
+
+    python benchmarks/logging_overhead.py [--iterations 2000] [--level INFO]
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logging_setup import LOG_FORMAT, configure_logging  # noqa: E402
+
+
+# Product info shaped like a get_product_info response of an app with many branches
+def make_payload(branches=60):
+    return {
+        "common": {"name": "Example Dedicated Server", "type": "Tool", "oslist": "windows,linux"},
+        "depots": {
+            "branches": {f"branch-{index}": {"buildid": str(10_000_000 + index), "pwdrequired": str(index % 2),
+                                             "timeupdated": str(1_700_000_000 + index),
+                                             "description": f"Test branch number {index}"}
+                         for index in range(branches)},
+        },
+    }
+
+
+# The log calls of the fetch path before this change: eager f-strings, the whole payload formatted every call
+def eager_command(payload, app_id):
+    branches = payload['depots']['branches']
+    logging.info("'appid' command invoked by user#0001")
+    logging.info(f"Starting the process to fetch info for AppID: {app_id}")
+    logging.debug(f"Data fetched for AppID {app_id}: {payload}")
+    logging.debug(f"Parsed values - Service Name: {payload['common']['name']}, Build ID: "
+                  f"{branches['branch-0']['buildid']}, Branches: {branches}")
+    logging.info("Fetched info for 1 AppIDs, 0 failed")
+
+
+# The same calls with deferred %-formatting
+def lazy_command(payload, app_id):
+    branches = payload['depots']['branches']
+    logging.info("'appid' command invoked by %s", 'user#0001')
+    logging.info("Starting the process to fetch info for AppID: %s", app_id)
+    logging.debug("Data fetched for AppID %s: %s", app_id, payload)
+    logging.debug("Parsed values - Service Name: %s, Build ID: %s, Branches: %s", payload['common']['name'],
+                  branches['branch-0']['buildid'], branches)
+    logging.info("Fetched info for %d AppIDs, %d failed", 1, 0)
+
+
+def run_scenario(mode, calls, level, iterations, directory):
+    log_file = os.path.join(directory, f'{mode}-{calls}.log')
+    if mode == 'development':
+        # Written synchronously on the calling thread (to a file here so the terminal stays readable)
+        logging.basicConfig(level=level, format=LOG_FORMAT, filename=log_file)
+    else:
+        configure_logging('production', level=level, levels='discord=WARNING', log_file=log_file,
+                          console_level='CRITICAL')
+    command = eager_command if calls == 'eager' else lazy_command
+
+    payload = make_payload()
+    durations = []
+    for index in range(iterations):
+        start_time = time.perf_counter()
+        command(payload, str(index))
+        durations.append(time.perf_counter() - start_time)
+    durations.sort()
+    return {
+        "mode": mode,
+        "calls": calls,
+        "mean_us": sum(durations) / len(durations) * 1e6,
+        "p50_us": durations[len(durations) // 2] * 1e6,
+        "p99_us": durations[int(len(durations) * 0.99)] * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--level', default='INFO', choices=('DEBUG', 'INFO'))
+    parser.add_argument('--mode', choices=('development', 'production'))
+    parser.add_argument('--calls', choices=('eager', 'lazy'))
+    parser.add_argument('--directory')
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_scenario(args.mode, args.calls, args.level, args.iterations, args.directory)))
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in ('development', 'production'):
+            for calls in ('eager', 'lazy'):
+                output = subprocess.run([sys.executable, __file__, '--mode', mode, '--calls', calls, '--level',
+                                         args.level, '--iterations', str(args.iterations), '--directory', directory],
+                                        check=True, stdout=subprocess.PIPE, text=True).stdout
+                results[(mode, calls)] = json.loads(output)
+
+    print(f"All at {args.level}")
+    print(f"{'mode':<12} {'calls':<6} {'mean us':>10} {'p50 us':>10} {'p99 us':>10}")
+    for result in results.values():
+        print(f"{result['mode']:<12} {result['calls']:<6} {result['mean_us']:>10.1f} {result['p50_us']:>10.1f} "
+              f"{result['p99_us']:>10.1f}")
+    # Negative values mean the change costs time on the calling thread
+    for mode in ('development', 'production'):
+        saved = results[(mode, 'eager')]['mean_us'] - results[(mode, 'lazy')]['mean_us']
+        print(f"Deferred formatting in {mode} mode: {saved:+.1f}us saved per command")
+    for calls in ('eager', 'lazy'):
+        saved = results[('development', calls)]['mean_us'] - results[('production', calls)]['mean_us']
+        print(f"Queue handler instead of synchronous writes with {calls} calls: {saved:+.1f}us saved per command")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Time and disk usage of pull_repo's fetch modes against a local bare repository.
+
+Builds a bare repository with a long history of large blobs, then for every fetch mode, with and without a
+reference repository:
+- clones it into a fresh staging directory
+- pushes one more commit and pulls again, the way *update does
+
+It reports the time of both pulls and the size of the staging .git directory. The reference repository is a full
+clone of an older commit, standing in for BOT_DIRECTORY.
+
+    python benchmarks/pull_repo.py [--commits 300] [--blob-size 200000]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core  # noqa: E402
+
+AUTHOR = 'Benchmark <benchmark@example.com>'
+
+
+def git(*args, cwd=None):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, stdout=subprocess.PIPE, text=True).stdout.strip()
+
+
+# A history of commits that each replace a large binary file and touch a small source file, written with
+# git fast-import so building it takes seconds
+def build_repository(path, commits, blob_size):
+    git('init', '--quiet', '--bare', '--initial-branch=main', path)
+    git('config', 'uploadpack.allowFilter', 'true', cwd=path)
+    stream = []
+    for index in range(commits):
+        data = os.urandom(blob_size)
+        source = f"VERSION = {index}\n".encode()
+        stream.append(b'commit refs/heads/main\n')
+        stream.append(f'committer {AUTHOR} {1_700_000_000 + index} +0000\n'.encode())
+        message = f'Commit {index}'.encode()
+        stream.append(b'data %d\n%s\n' % (len(message), message))
+        stream.append(b'M 644 inline assets/data.bin\ndata %d\n%s\n' % (len(data), data))
+        stream.append(b'M 644 inline version.py\ndata %d\n%s\n' % (len(source), source))
+    subprocess.run(['git', 'fast-import', '--quiet'], cwd=path, input=b''.join(stream), check=True)
+
+
+def add_commit(bare_path, work_path):
+    if not os.path.isdir(work_path):
+        git('clone', '--quiet', bare_path, work_path)
+    with open(os.path.join(work_path, 'version.py'), 'a') as f:
+        f.write("UPDATED = True\n")
+    git('-c', 'user.name=Benchmark', '-c', 'user.email=benchmark@example.com', 'commit', '--quiet', '-am',
+        'Update', cwd=work_path)
+    git('push', '--quiet', 'origin', 'main', cwd=work_path)
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(directory, filename))
+               for directory, _, filenames in os.walk(path) for filename in filenames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--commits', type=int, default=300)
+    parser.add_argument('--blob-size', type=int, default=200_000)
+    parser.add_argument('--modes', default='full,blobless,shallow')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        bare_path = os.path.join(directory, 'origin.git')
+        start_time = time.perf_counter()
+        build_repository(bare_path, args.commits, args.blob_size)
+        print(f"Built {args.commits} commits ({directory_size(bare_path) / 1e6:.1f} MB) in "
+              f"{time.perf_counter() - start_time:.1f}s")
+        # file:// so git uses its network transport and honours --depth and --filter
+        url = f'file://{bare_path}'
+        reference = os.path.join(directory, 'production')
+        git('clone', '--quiet', bare_path, reference)
+        git('checkout', '--quiet', 'HEAD~10', cwd=reference)
+
+        print(f"{'mode':<10} {'reference':<10} {'clone s':>8} {'update s':>9} {'.git MB':>8}")
+        for mode in args.modes.split(','):
+            for use_reference in (False, True):
+                staging = os.path.join(directory, f'staging-{mode}-{use_reference}')
+                work = os.path.join(directory, 'work')
+                shutil.rmtree(work, ignore_errors=True)
+
+                start_time = time.perf_counter()
+                core.pull_repo(url, staging, 'main', None, fetch_mode=mode,
+                               reference=reference if use_reference else None)
+                clone_time = time.perf_counter() - start_time
+
+                add_commit(bare_path, work)
+                start_time = time.perf_counter()
+                core.pull_repo(url, staging, 'main', None, fetch_mode=mode,
+                               reference=reference if use_reference else None)
+                update_time = time.perf_counter() - start_time
+
+                size = directory_size(os.path.join(staging, '.git')) / 1e6
+                print(f"{mode:<10} {'yes' if use_reference else 'no':<10} {clone_time:>8.2f} {update_time:>9.2f} "
+                      f"{size:>8.1f}")
+                shutil.rmtree(staging, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Time from interpreter start until the bot is ready to log in.
+
+After *update restarts the bot, this time is pure downtime. Every run uses a fresh interpreter. It measures:
+- importing the core module, which covers configuration, the bot object and the shared services
+- loading every extension the way process_all_extensions does
+
+It also reports which heavy dependencies were imported by then. The committed code of --root (this checkout by
+default) is cloned into a temporary directory first, so the directories and files the bot creates on startup
+never land in a live checkout. Pass --root and --module bot to measure an older checkout where the core still
+lived in bot.py.
+
+    python benchmarks/startup_time.py [--runs 5] [--root PATH] [--module core]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY_MODULES = ('steam', 'gevent', 'git', 'requests', 'aiohttp', 'discord')
+
+# Runs inside the measured interpreter. No token is used, the bot never connects. The extensions are loaded inside
+# the bot's async context, as setup_hook loads them once the bot has its event loop.
+PROBE = """
+import asyncio, json, sys, time
+start_time = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+core = __import__(sys.argv[2])
+imported_at = time.perf_counter()
+
+async def load_extensions():
+    async with core.bot:
+        timings = await core.process_all_extensions()
+        loaded_at = time.perf_counter()
+        for extension_name in list(core.bot.extensions):
+            await core.bot.unload_extension(extension_name)
+    return timings, loaded_at
+
+timings, loaded_at = asyncio.run(load_extensions())
+print(json.dumps({
+    "import": imported_at - start_time,
+    "extensions": loaded_at - imported_at,
+    "failed": [name for name, timing in timings.items() if not timing['ok']],
+    "modules": sorted(name for name in json.loads(sys.argv[3]) if name in sys.modules),
+}))
+"""
+
+
+def measure(root, module):
+    env = dict(os.environ, LOG_LEVEL='WARNING', METRICS_PORT='0', FLEET_STORE='memory')
+    # The interpreter's own start is part of the downtime too, so the whole process is also timed from outside
+    start_time = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', PROBE, root, module, json.dumps(HEAVY_MODULES)],
+                            cwd=root, env=env, check=True, stdout=subprocess.PIPE, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process'] = time.perf_counter() - start_time
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--root', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument('--module', default='core')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        sandbox = os.path.join(directory, 'checkout')
+        subprocess.run(['git', 'clone', '--quiet', args.root, sandbox], check=True)
+        results = [measure(sandbox, args.module) for _ in range(args.runs)]
+    import_times = [result['import'] for result in results]
+    extension_times = [result['extensions'] for result in results]
+    process_times = [result['process'] for result in results]
+    print(f"{args.runs} runs of {args.module} in {args.root}")
+    print(f"{'phase':<12} {'median ms':>10} {'min ms':>10} {'max ms':>10}")
+    for phase, times in (('import', import_times), ('extensions', extension_times), ('process', process_times)):
+        print(f"{phase:<12} {statistics.median(times) * 1000:>10.1f} {min(times) * 1000:>10.1f} "
+              f"{max(times) * 1000:>10.1f}")
+    print(f"Heavy modules imported before login: {', '.join(results[-1]['modules']) or 'none'}")
+    if results[-1]['failed']:
+        print(f"Extensions that failed to load: {', '.join(results[-1]['failed'])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import time
+
+
+# Refills rate tokens per second up to capacity, every command takes one
+class TokenBucket:
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # 0 when a token was taken, otherwise the seconds until the next one
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+# One token bucket per key, e.g. per user id. Buckets that refilled completely are dropped now and then so the
+# dict only holds recently active keys.
+class RateLimiter:
+    def __init__(self, rate, capacity, prune_every=1000):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}
+        self.prune_every = prune_every
+        self.hits = 0
+
+    def hit(self, key, now=None):
+        if not self.rate:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        self.hits += 1
+        if self.hits % self.prune_every == 0:
+            self.prune(now)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.capacity, now)
+        return bucket.take(now)
+
+    # Give back the token hit took, nothing to give back when the key has no bucket (rate 0 creates none)
+    def refund(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            bucket.tokens = min(bucket.capacity, bucket.tokens + 1)
+
+    def prune(self, now):
+        for key in [key for key, bucket in self.buckets.items()
+                    if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.capacity]:
+            del self.buckets[key]
+
+
+# Runs one call per key at a time, callers that arrive while it runs share its result (or exception). The call
+# runs in its own task, so a caller that is cancelled does not cancel it for the others.
+class SingleFlight:
+    def __init__(self):
+        self.flights = {}
+        self.coalesced = 0
+
+    def __contains__(self, key):
+        return key in self.flights
+
+    async def do(self, key, func, *args, **kwargs):
+        task = self.flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self.flights[key] = task
+            task.add_done_callback(lambda t: self.done(key, t))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def done(self, key, task):
+        if self.flights.get(key) is task:
+            del self.flights[key]
+        # Retrieved here so an exception nobody waited for anymore is not reported as never retrieved
+        if not task.cancelled():
+            task.exception()
+
+
+# How a command runs: commands of the same group share concurrency slots. wait=False rejects the command when
+# every slot is taken instead of queueing it, at most max_queue commands wait per group. coalesce makes identical
+# commands (same name and arguments) sent while one is running wait for it instead of running again, per 'channel'
+# or per 'user' in a channel.
+class CommandPolicy:
+    def __init__(self, group='default', concurrency=8, wait=True, max_queue=50, coalesce=None):
+        self.group = group
+        self.concurrency = concurrency
+        self.wait = wait
+        self.max_queue = max_queue
+        self.coalesce = coalesce
+
+
+class CommandRejected(Exception):
+    pass
+
+
+class CommandLimiter:
+    def __init__(self, registry, policies=None, default_policy=None, user_rate=0.5, user_burst=5, channel_rate=2,
+                 channel_burst=10):
+        self.registry = registry
+        self.policies = dict(policies or {})
+        self.default_policy = default_policy or CommandPolicy()
+        self.user_limiter = RateLimiter(user_rate, user_burst)
+        self.channel_limiter = RateLimiter(channel_rate, channel_burst)
+        self.semaphores = {}
+        self.waiting = {}
+        self.running = {}
+        self.flights = SingleFlight()
+
+    def policy(self, command_name):
+        return self.policies.get(command_name, self.default_policy)
+
+    # The seconds until the user may run another command in the channel, 0 when they may now. Both buckets are
+    # charged only when both have a token.
+    def check_rate(self, user_id, channel_id, now=None):
+        now = time.monotonic() if now is None else now
+        retry_after = self.user_limiter.hit(user_id, now)
+        if retry_after:
+            return retry_after
+        retry_after = self.channel_limiter.hit(channel_id, now)
+        if retry_after:
+            # Give the user their token back, the channel was full
+            self.user_limiter.refund(user_id)
+        return retry_after
+
+    def semaphore(self, policy):
+        if policy.group not in self.semaphores:
+            self.semaphores[policy.group] = asyncio.Semaphore(policy.concurrency)
+        return self.semaphores[policy.group]
+
+    def update_gauges(self, group):
+        self.registry.set_gauge('command_queue_depth', self.waiting.get(group, 0), group=group)
+        self.registry.set_gauge('command_in_flight', self.running.get(group, 0), group=group)
+
+    def queue_depth(self):
+        return sum(self.waiting.values())
+
+    # Run func in a slot of the policy's group, raises CommandRejected when the group is busy and the command may
+    # not wait (or the queue is full)
+    async def run_in_slot(self, policy, func, *args):
+        group = policy.group
+        semaphore = self.semaphore(policy)
+        if semaphore.locked() and (not policy.wait or self.waiting.get(group, 0) >= policy.max_queue):
+            self.registry.increment('command_rejected_total', reason='busy', group=group)
+            raise CommandRejected(group)
+
+        start_time = time.perf_counter()
+        self.waiting[group] = self.waiting.get(group, 0) + 1
+        self.update_gauges(group)
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting[group] -= 1
+        self.registry.observe('command_queue_wait_seconds', time.perf_counter() - start_time, group=group)
+        self.running[group] = self.running.get(group, 0) + 1
+        self.update_gauges(group)
+        try:
+            return await func(*args)
+        finally:
+            semaphore.release()
+            self.running[group] -= 1
+            self.update_gauges(group)
+
+    # Run a command through the rate limits, coalescing and its concurrency slot. Returns None when it ran, else
+    # why it did not: ('rate', retry_after), ('busy', group) or ('coalesced', None).
+    async def run(self, command_name, user_id, channel_id, arguments, func, *args):
+        retry_after = self.check_rate(user_id, channel_id)
+        if retry_after:
+            self.registry.increment('command_rejected_total', reason='rate', group=self.policy(command_name).group)
+            return 'rate', retry_after
+
+        policy = self.policy(command_name)
+        try:
+            if policy.coalesce is None:
+                await self.run_in_slot(policy, func, *args)
+                return None
+            key = (command_name, channel_id, arguments) if policy.coalesce == 'channel' else \
+                (command_name, channel_id, user_id, arguments)
+            if key in self.flights:
+                self.registry.increment('command_coalesced_total', command=command_name)
+                logging.debug("Coalesced %s in channel %s with the running identical command", command_name,
+                              channel_id)
+                await self.flights.do(key, self.run_in_slot, policy, func, *args)
+                return 'coalesced', None
+            await self.flights.do(key, self.run_in_slot, policy, func, *args)
+            return None
+        except CommandRejected as e:
+            return 'busy', str(e)
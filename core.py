@@ -0,0 +1,936 @@
+import os
+import discord
+from discord.ext import commands, tasks
+from dotenv import load_dotenv
+import logging
+import sys
+import time
+import subprocess
+import shutil
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import functools
+import bisect
+import hashlib
+import heapq
+import json
+import platform
+import random
+import re
+from server_store import ServerInfoStore
+from role_index import RoleIndex
+from fleet_store import FleetCoordinator, open_fleet_store
+import metrics
+from command_limits import CommandLimiter, CommandPolicy, SingleFlight
+from logging_setup import configure_logging
+from steam_worker import SteamWorker, SteamTimeoutError
+from steam_cache import ProductInfoCache
+from app_model import App
+import handoff
+from deploy import FileIndex, diff_trees, apply_changes, backup_changes, restore_changes, choose_action, \
+    validate_staged_code, ACTION_RELOAD, ACTION_RESTART
+
+# Load environment variables
+load_dotenv()
+BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
+ADMIN_ROLE_NAME = os.getenv('ADMIN_ROLE_NAME')
+GIT_REPO_URL = os.getenv('GIT_REPO_URL')
+BOT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+STAGING_DIRECTORY = os.path.join(BOT_DIRECTORY, 'staging')
+EXTENSIONS_DIRECTORY = os.path.join(BOT_DIRECTORY, 'extensions')
+COGS_DIRECTORY = os.path.join(BOT_DIRECTORY, 'cogs')
+COMPUTER_NAME = os.environ.get("COMPUTERNAME", "") if os.name == 'nt' else os.environ.get("HOSTNAME", "")
+STEAM_PRODUCT_INFO_CHUNK_SIZE = int(os.getenv('STEAM_PRODUCT_INFO_CHUNK_SIZE', 50))
+STEAM_REQUEST_TIMEOUT = float(os.getenv('STEAM_REQUEST_TIMEOUT', 30))
+STEAM_POLL_INTERVAL = float(os.getenv('STEAM_POLL_INTERVAL', 300))
+STEAM_POLL_JITTER = float(os.getenv('STEAM_POLL_JITTER', 0.1))
+STEAM_POLL_MAX_BACKOFF = float(os.getenv('STEAM_POLL_MAX_BACKOFF', 3600))
+STEAM_APP_MIN_INTERVAL = float(os.getenv('STEAM_APP_MIN_INTERVAL', 600))
+STEAM_INFO_CACHE_FILE = os.getenv('STEAM_INFO_CACHE_FILE', 'steam_product_info.json')
+STEAM_INFO_FRESHNESS = float(os.getenv('STEAM_INFO_FRESHNESS', 60))
+GIT_MAX_WORKERS = int(os.getenv('GIT_MAX_WORKERS', 4))
+GIT_OPERATION_TIMEOUT = float(os.getenv('GIT_OPERATION_TIMEOUT', 120))
+GIT_INFO_CACHE_TTL = float(os.getenv('GIT_INFO_CACHE_TTL', 300))
+GIT_FETCH_MODE = os.getenv('GIT_FETCH_MODE', 'blobless')
+GIT_CLONE_REFERENCE = os.getenv('GIT_CLONE_REFERENCE', BOT_DIRECTORY)
+SUPERVISOR_LOG_LINES = int(os.getenv('SUPERVISOR_LOG_LINES', 500))
+SUPERVISOR_SAMPLE_INTERVAL = float(os.getenv('SUPERVISOR_SAMPLE_INTERVAL', 30))
+SUPERVISOR_RESTART_BACKOFF = float(os.getenv('SUPERVISOR_RESTART_BACKOFF', 5))
+SUPERVISOR_MAX_RESTART_BACKOFF = float(os.getenv('SUPERVISOR_MAX_RESTART_BACKOFF', 300))
+SUPERVISOR_STABLE_UPTIME = float(os.getenv('SUPERVISOR_STABLE_UPTIME', 600))
+SUPERVISOR_STOP_TIMEOUT = float(os.getenv('SUPERVISOR_STOP_TIMEOUT', 30))
+FLEET_STORE = os.getenv('FLEET_STORE', 'memory')
+FLEET_HEARTBEAT_INTERVAL = float(os.getenv('FLEET_HEARTBEAT_INTERVAL', 30))
+FLEET_INSTANCE_STALE_AFTER = float(os.getenv('FLEET_INSTANCE_STALE_AFTER', 120))
+FLEET_INSTANCE_PRUNE_AFTER = float(os.getenv('FLEET_INSTANCE_PRUNE_AFTER', 24 * 3600))
+# Stable across restarts of the same bot directory on the same host, so a restarted bot takes over the leases of
+# the process it replaced instead of waiting for them to expire
+INSTANCE_ID = os.getenv('FLEET_INSTANCE_ID') or \
+    f"{COMPUTER_NAME}:{hashlib.sha1(BOT_DIRECTORY.encode('utf-8')).hexdigest()[:8]}"
+STEAMCMD_PATH = os.getenv('STEAMCMD_PATH', 'steamcmd')
+STEAMCMD_INSTALL_DIRECTORY = os.getenv('STEAMCMD_INSTALL_DIRECTORY', os.path.join(BOT_DIRECTORY, 'servers'))
+STEAMCMD_MAX_JOBS = int(os.getenv('STEAMCMD_MAX_JOBS', 4))
+STEAMCMD_MAX_JOBS_PER_DISK = int(os.getenv('STEAMCMD_MAX_JOBS_PER_DISK', 1))
+STEAMCMD_LEASE_TTL = float(os.getenv('STEAMCMD_LEASE_TTL', 6 * 3600))
+STEAMCMD_REPORT_CHANNEL_ID = int(os.getenv('STEAMCMD_REPORT_CHANNEL_ID', 0))
+VALIDATION_IMPORT_TIMEOUT = float(os.getenv('VALIDATION_IMPORT_TIMEOUT', 60))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.5))
+COMMAND_MAX_CONCURRENCY = int(os.getenv('COMMAND_MAX_CONCURRENCY', 8))
+COMMAND_MAX_QUEUE = int(os.getenv('COMMAND_MAX_QUEUE', 50))
+COMMAND_USER_RATE = float(os.getenv('COMMAND_USER_RATE', 0.5))
+COMMAND_USER_BURST = int(os.getenv('COMMAND_USER_BURST', 5))
+COMMAND_CHANNEL_RATE = float(os.getenv('COMMAND_CHANNEL_RATE', 2))
+COMMAND_CHANNEL_BURST = int(os.getenv('COMMAND_CHANNEL_BURST', 10))
+SERVER_INFO_FILE = 'server_info.json'
+SERVER_INFO_FLUSH_DELAY = float(os.getenv('SERVER_INFO_FLUSH_DELAY', 1.0))
+SERVER_INFO_COMPACT_THRESHOLD = int(os.getenv('SERVER_INFO_COMPACT_THRESHOLD', 200))
+HANDOFF_ENABLED = os.getenv('HANDOFF_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+HANDOFF_READY_TIMEOUT = float(os.getenv('HANDOFF_READY_TIMEOUT', 120))
+HANDOFF_DRAIN_TIMEOUT = float(os.getenv('HANDOFF_DRAIN_TIMEOUT', 300))
+HANDOFF_HELD_MESSAGES = int(os.getenv('HANDOFF_HELD_MESSAGES', 1000))
+HANDOFF_PID_FILE = os.getenv('HANDOFF_PID_FILE', os.path.join(BOT_DIRECTORY, 'bot.pid'))
+DEPLOY_BACKUP_DIRECTORY = os.path.join(BOT_DIRECTORY, '.deploy-backup')
+LOGIN_RETRY_BACKOFF = float(os.getenv('LOGIN_RETRY_BACKOFF', 1))
+LOGIN_RETRY_MAX_BACKOFF = float(os.getenv('LOGIN_RETRY_MAX_BACKOFF', 60))
+LOGIN_MAX_RETRIES = int(os.getenv('LOGIN_MAX_RETRIES', 10))
+LOG_MODE = os.getenv('LOG_MODE', 'development')
+LOG_LEVEL = os.getenv('LOG_LEVEL')
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+LOG_FILE = os.getenv('LOG_FILE', os.path.join(BOT_DIRECTORY, 'logs', 'bot.log'))
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+LOG_CONSOLE_LEVEL = os.getenv('LOG_CONSOLE_LEVEL', 'WARNING')
+
+# Initialize logging, LOG_MODE=production logs through a background thread into rotating files
+configure_logging(LOG_MODE, level=LOG_LEVEL and LOG_LEVEL.upper(), levels=LOG_LEVELS, log_file=LOG_FILE,
+                  max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT, console_level=LOG_CONSOLE_LEVEL.upper())
+
+# Random hash included in UNSET_VALUE_ to prevent accidental use of UNSET_VALUE_
+unset = "UNSET_BRANCH_5f3a2b1"
+
+# Create directories if they don't exist
+if not os.path.exists(STAGING_DIRECTORY):
+    os.makedirs(STAGING_DIRECTORY)
+if not os.path.exists(EXTENSIONS_DIRECTORY):
+    os.makedirs(EXTENSIONS_DIRECTORY)
+if not os.path.exists(COGS_DIRECTORY):
+    os.makedirs(COGS_DIRECTORY)
+
+# Set up Discord intents
+intents = discord.Intents.default()
+intents.members = True
+intents.message_content = True
+
+# The bot loads its extensions and starts the metrics endpoint in setup_hook, on its own event loop right before it
+# connects. A retried login runs setup_hook again, so everything in it only does what is still missing.
+# A bot started by a handoff (see hand_off_to_successor) takes no commands until its predecessor stopped taking
+# them, and cogs that write shared state wait in wait_for_handoff until the predecessor flushed and exited.
+# Messages that arrive before that are held, and the ones after the last message the predecessor took are
+# processed once it stopped, so no command in between is dropped or run twice.
+class GameManagerBot(commands.Bot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.restart_requested = False
+        self.commands_in_flight = 0
+        self.extension_failures = []
+        self.successor = handoff.Successor.from_environment()
+        self.started_by_handoff = self.successor is not None
+        self.accepting_commands = self.successor is None
+        # Snowflake id of the last message taken, and of the last one the predecessor took
+        self.last_message_id = 0
+        self.taken_after = 0
+        self.held_messages = collections.deque(maxlen=HANDOFF_HELD_MESSAGES) if self.successor is not None else None
+        self.handoff_done = asyncio.Event()
+        # Managed servers that were running in the predecessor, the supervisor starts them again
+        self.inherited_servers = []
+        # Set once a successor took over, it carries on as the same fleet instance
+        self.handed_off = False
+        if self.successor is None:
+            self.handoff_done.set()
+
+    async def process_commands(self, message):
+        if not self.accepting_commands:
+            if self.held_messages is not None:
+                self.held_messages.append(message)
+            return
+        if message.id <= self.taken_after:
+            return
+        self.last_message_id = max(self.last_message_id, message.id)
+        self.commands_in_flight += 1
+        try:
+            await super().process_commands(message)
+        finally:
+            self.commands_in_flight -= 1
+
+    # Every command goes through command_limiter: the per-user and per-channel rate limits, coalescing of identical
+    # commands and the concurrency slots of its command group
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        command_name = ctx.command.qualified_name
+        outcome = await command_limiter.run(command_name, ctx.author.id, ctx.channel.id, ctx.message.content,
+                                            super().invoke, ctx)
+        if outcome is None:
+            return
+        reason, detail = outcome
+        if reason == 'rate':
+            logging.info("Rate limited %s in channel %s for %.1fs", ctx.author.id, ctx.channel.id, detail)
+            # A reaction instead of a reply, so a flood of commands is not answered with a flood of messages
+            try:
+                await ctx.message.add_reaction(RATE_LIMITED_REACTION)
+            except discord.HTTPException:
+                pass
+        elif reason == 'coalesced':
+            # The identical command this one waited for already answered in the channel
+            try:
+                await ctx.message.add_reaction(COALESCED_REACTION)
+            except discord.HTTPException:
+                pass
+        elif reason == 'busy':
+            if detail == 'deploy':
+                await ctx.send("An update is already running. Try again once it finished.")
+            else:
+                await ctx.send(f"Too many '{command_name}' commands are queued. Try again in a moment.")
+
+    async def wait_for_handoff(self):
+        await self.handoff_done.wait()
+
+    # Start taking commands from the predecessor, running the held messages it did not take
+    def take_commands(self, after):
+        self.taken_after = after
+        self.accepting_commands = True
+        held, self.held_messages = self.held_messages or (), None
+        missed = [message for message in held if message.id > after]
+        if missed:
+            logging.info(f"Processing {len(missed)} messages that arrived while the predecessor stopped")
+        for message in missed:
+            asyncio.create_task(self.process_commands(message))
+
+    async def setup_hook(self):
+        timings = await process_all_extensions()
+        self.extension_failures = [extension_name for extension_name, timing in timings.items() if not timing['ok']]
+        loop_lag_monitor.start()
+        if METRICS_PORT and not metrics_server.started:
+            try:
+                await metrics_server.start()
+            except OSError as e:
+                logging.error(f"Could not serve metrics on {METRICS_HOST}:{METRICS_PORT}: {str(e)}")
+
+    # Leave the fleet so the other instances don't wait for this one's leases to expire
+    async def close(self):
+        if not self.handed_off and not self.is_closed():
+            try:
+                await fleet.leave()
+            except Exception as e:
+                logging.error(f"Could not leave the fleet: {str(e)}. Type: {type(e).__name__}")
+        await super().close()
+
+    # Close the gateway connection cleanly, the entry point then exits so the service wrapper starts the new code
+    async def restart(self):
+        self.restart_requested = True
+        await self.close()
+
+
+RATE_LIMITED_REACTION = '\u23f3'
+COALESCED_REACTION = '\U0001f446'
+
+# Command groups share concurrency slots. Commands without a policy run in the default group.
+command_limiter = CommandLimiter(
+    metrics.registry,
+    policies={
+        # Only one update touches STAGING_DIRECTORY and BOT_DIRECTORY at a time, a second one is turned away
+        'update': CommandPolicy(group='deploy', concurrency=1, wait=False),
+        'info': CommandPolicy(group='info', concurrency=COMMAND_MAX_CONCURRENCY, max_queue=COMMAND_MAX_QUEUE,
+                              coalesce='channel'),
+        # query_role sorts and pages through roles with many members, so it gets a group of its own
+        'query_role': CommandPolicy(group='query_role', concurrency=COMMAND_MAX_CONCURRENCY,
+                                    max_queue=COMMAND_MAX_QUEUE, coalesce='user'),
+    },
+    default_policy=CommandPolicy(concurrency=COMMAND_MAX_CONCURRENCY, max_queue=COMMAND_MAX_QUEUE),
+    user_rate=COMMAND_USER_RATE, user_burst=COMMAND_USER_BURST, channel_rate=COMMAND_CHANNEL_RATE,
+    channel_burst=COMMAND_CHANNEL_BURST)
+
+# Initialize the bot
+bot = GameManagerBot(command_prefix='*', intents=intents)
+bot.command_limiter = command_limiter
+
+# Shared in-memory copy of server_info.json, loaded by the first cog that needs it
+server_store = ServerInfoStore(SERVER_INFO_FILE, flush_delay=SERVER_INFO_FLUSH_DELAY,
+                               compact_threshold=SERVER_INFO_COMPACT_THRESHOLD)
+bot.server_store = server_store
+
+# Role name and role membership lookups, kept current from the member and role events
+role_index = RoleIndex(bot)
+role_index.register()
+bot.role_index = role_index
+
+# Latency histograms of commands, git, Steam, extensions and persistence, served on METRICS_HOST:METRICS_PORT
+# (METRICS_PORT=0 disables the endpoint) and shown by *stats
+bot.metrics = metrics.registry
+loop_lag_monitor = metrics.LoopLagMonitor(metrics.registry, interval=LOOP_LAG_INTERVAL)
+metrics_server = metrics.MetricsServer(metrics.registry, host=METRICS_HOST, port=METRICS_PORT)
+bot.loop_lag_monitor = loop_lag_monitor
+
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.command_started_at = time.perf_counter()
+
+
+@bot.after_invoke
+async def record_command_duration(ctx):
+    started_at = getattr(ctx, 'command_started_at', None)
+    if started_at is not None:
+        metrics.registry.observe('command_duration_seconds', time.perf_counter() - started_at,
+                                 command=ctx.command.qualified_name, outcome='error' if ctx.command_failed else 'ok')
+
+
+# Heartbeats, per-AppID state and work leases shared with the other bot instances of the fleet
+fleet = FleetCoordinator(open_fleet_store(FLEET_STORE), INSTANCE_ID, COMPUTER_NAME, lease_ttl=STEAM_POLL_INTERVAL * 3)
+bot.fleet = fleet
+
+
+# Fetch current info as git commit and branch, or commit of a provided branch
+def get_github_default_branch(repo_url):
+    import requests
+    logging.info(f'Fetching default branch for {repo_url}')
+    user_repo = "/".join(repo_url.split('/')[-2:])
+    url = f"https://api.github.com/repos/{user_repo}"
+    try:
+        response = requests.get(url, timeout=GIT_OPERATION_TIMEOUT)
+        if response.status_code == 200:
+            logging.info(f"Default branch for {repo_url} is {response.json()['default_branch']}")
+            return response.json()["default_branch"]
+        else:
+            logging.error(f"Could not get default branch: {response.status_code} {response.reason}")
+    except Exception as e:
+        logging.error(f"Could not get default branch: {e}")
+        return None
+
+
+# Full commit hashes ls-remote reported per (repo url, branch), pull_repo checks out exactly that commit and skips
+# the fetch when the staging repository already has it
+remote_heads = {}
+
+
+def handle_http_git_info(repo_path, target_branch=unset):
+    logging.info(f"Target branch is unset. Trying to determine the default branch for {repo_path}.")
+    if target_branch == unset:
+        target_branch = get_github_default_branch(repo_path)
+    if target_branch == unset:
+        logging.error(f"Failed to determine the default branch for {repo_path}.")
+        raise ValueError("Could not determine the default branch.")
+    logging.info(f"Targeting remote repository {repo_path} {target_branch}")
+    cmd = ['git', 'ls-remote', repo_path, f'refs/heads/{target_branch}']
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, timeout=GIT_OPERATION_TIMEOUT)
+    output = result.stdout.decode('utf-8').strip()
+
+    if output:
+        logging.debug('Received output from ls-remote command: %s', output)
+        commit_hash = output.split()[0]
+        commit = commit_hash[:7]  # Shorten to 7 characters
+        branch = target_branch
+        remote_heads[(repo_path, branch)] = (time.monotonic(), commit_hash)
+        logging.info(f'Determined commit {commit} for branch {branch}')
+
+    return commit, branch
+
+
+def get_git_info(repo_path, target_branch=unset):
+    # GitPython is imported on first use, it is only needed for *update and *info
+    import git
+    try:
+        logging.info(f'Fetching git info for {repo_path}')
+        # Check if repo_path is a remote git repo using http or https via handle_http_git_info
+        if repo_path.startswith('http') or repo_path.startswith('https'):
+            commit, branch = handle_http_git_info(repo_path, target_branch)
+        # Check if repo_path is a local directory with a git repo in it
+        elif os.path.isdir(repo_path) and os.path.isdir(os.path.join(repo_path, '.git')):
+            repo = git.Repo(repo_path)
+            if target_branch != unset:
+                logging.info(f"Targeting local repository {repo_path} {target_branch}")
+                branch_commit = repo.refs[f"refs/remotes/origin/{target_branch}"].commit
+                commit = branch_commit.hexsha[:7]
+                branch = target_branch
+            else:
+                logging.info(f"Targeting local repository {repo_path} {repo.active_branch.name}")
+                repo.git.fetch(kill_after_timeout=GIT_OPERATION_TIMEOUT)
+                commit = repo.head.object.hexsha[:7]
+                branch = repo.active_branch.name
+        else:
+            # If we get here, we couldn't determine the git info, meaning we need to make .git info, we will assume
+            # we are using the default GitHub branch and url via GIT_REPO_URL and will pull it down into Staging directory
+            logging.info(f'Could not determine git info for {repo_path}.')
+            commit, branch = handle_http_git_info(GIT_REPO_URL, target_branch)
+            pull_repo(GIT_REPO_URL, STAGING_DIRECTORY, branch, commit)
+
+        return commit, branch
+
+    except git.exc.GitCommandError as e:
+        logging.error(f"GitCommandError: {str(e)}. Status: {e.status}, Command: {e.command}, Stderr: {e.stderr}")
+        raise e
+
+    except Exception as e:
+        logging.error(f"Returning exception: {e} Type: {type(e).__name__}")
+        raise e
+
+
+# The fresh ls-remote result for a branch of repo_url, or None
+def known_remote_head(repo_url, branch):
+    entry = remote_heads.get((repo_url, branch))
+    if entry and time.monotonic() - entry[0] < GIT_INFO_CACHE_TTL:
+        return entry[1]
+    return None
+
+
+def has_commit(repo, commit):
+    import git
+    try:
+        repo.git.rev_parse('--verify', '--quiet', f'{commit}^{{commit}}')
+        return True
+    except git.exc.GitCommandError:
+        return False
+
+
+# Fetch modes: 'full' fetches the complete history, 'blobless' every commit and tree but file contents only when
+# a checkout needs them (a partial clone), 'shallow' only the tip of the branch
+def fetch_options(fetch_mode):
+    if fetch_mode == 'blobless':
+        return ['--filter=blob:none']
+    if fetch_mode == 'shallow':
+        return ['--depth=1']
+    return []
+
+
+# Clone only the target branch. Objects that the reference repository (BOT_DIRECTORY, the production checkout)
+# already has are borrowed from it during the clone instead of being downloaded again, then copied with --dissociate,
+# so the clone never depends on the production object store that a deploy or a git gc may change later.
+def clone_repo(repo_url, repo_path, branch, fetch_mode=GIT_FETCH_MODE, reference=GIT_CLONE_REFERENCE):
+    import git
+    options = fetch_options(fetch_mode)
+    if branch:
+        options += ['--single-branch', f'--branch={branch}']
+    if reference and os.path.isdir(os.path.join(reference, '.git')):
+        options += [f'--reference-if-able={reference}', '--dissociate']
+    git.Repo.clone_from(repo_url, repo_path, multi_options=options, kill_after_timeout=GIT_OPERATION_TIMEOUT)
+    logging.info(f"Cloned repository {repo_url} to {repo_path} with {' '.join(options)}")
+
+
+# Fetch just one branch into its remote-tracking ref
+def fetch_branch(repo, branch, fetch_mode=GIT_FETCH_MODE):
+    refspec = f'+refs/heads/{branch}:refs/remotes/origin/{branch}'
+    repo.git.fetch(*fetch_options(fetch_mode), 'origin', refspec, kill_after_timeout=GIT_OPERATION_TIMEOUT)
+    logging.info(f"Fetched {branch} with fetch mode {fetch_mode}")
+
+
+# Function to pull from GIT_REPO_URL repo into STAGING_DIRECTORY. Only the target branch is fetched, and nothing
+# at all when the commit ls-remote reported (or the requested commit) is already there.
+def pull_repo(repo_url, repo_path, target_branch, target_commit, fetch_mode=GIT_FETCH_MODE,
+              reference=GIT_CLONE_REFERENCE):
+    import git
+    target_branch = None if target_branch == unset else target_branch
+    target_commit = None if target_commit == unset else target_commit
+    try:
+        if not os.path.exists(repo_path):
+            os.makedirs(repo_path)
+            logging.info(f"Created directory {repo_path}.")
+        if not os.path.isdir(os.path.join(repo_path, '.git')):
+            clone_repo(repo_url, repo_path, target_branch, fetch_mode, reference)
+
+        logging.info(f'Pulling {repo_url} {target_branch} {target_commit} into {repo_path}')
+        repo = git.Repo(repo_path)
+        if repo.is_dirty(untracked_files=True):
+            logging.error("The repository is dirty; aborting pull.")
+            return False
+
+        branch = target_branch
+        if not branch:
+            if repo.head.is_detached:
+                raise ValueError("No target branch given and the staging repository has no branch checked out")
+            branch = repo.active_branch.name
+        remote_head = known_remote_head(repo_url, branch)
+        wanted = target_commit or remote_head
+        if wanted and has_commit(repo, wanted):
+            logging.info(f"{repo_path} already has commit {wanted[:7]}, skipping the fetch.")
+        else:
+            fetch_branch(repo, branch, fetch_mode)
+            if target_commit and not has_commit(repo, target_commit) and \
+                    os.path.exists(os.path.join(repo.git_dir, 'shallow')):
+                # The requested commit is older than the shallow history
+                logging.info(f"Commit {target_commit} is not in the shallow history, fetching the full branch.")
+                repo.git.fetch('--unshallow', 'origin', f'+refs/heads/{branch}:refs/remotes/origin/{branch}',
+                               kill_after_timeout=GIT_OPERATION_TIMEOUT)
+
+        if target_commit:
+            logging.info(f"Switching to commit {target_commit}.")
+            repo.git.checkout(target_commit)
+            logging.info(f"Switched to commit {target_commit}.")
+        else:
+            # Reset the local branch to the commit that was compared against, or the fetched tip
+            start_point = remote_head if remote_head and has_commit(repo, remote_head) else f'origin/{branch}'
+            logging.info(f"Switching to branch {branch} at {start_point[:7] if remote_head else start_point}.")
+            repo.git.checkout('-B', branch, start_point)
+            logging.info(f"Switched to branch {branch}.")
+
+        return True
+
+    except git.exc.GitCommandError as e:
+        logging.error(f"GitCommandError: {str(e)}. Status: {e.status}, Command: {e.command}, Stderr: {e.stderr}")
+        raise e
+
+    except Exception as e:
+        logging.error(f"An unexpected error occurred: {str(e)}. Type: {type(e).__name__}")
+        raise e
+
+
+# Async front end for the git helpers above. Blocking calls run on a bounded executor with a timeout,
+# and only one mutating git operation runs per repository directory at a time.
+# get_git_info results are cached per repo path and target branch for cache_ttl seconds, once expired the
+# stale entry is still returned while a background refresh fetches the new one (stale-while-revalidate).
+class GitService:
+    def __init__(self, max_workers=GIT_MAX_WORKERS, timeout=GIT_OPERATION_TIMEOUT, cache_ttl=GIT_INFO_CACHE_TTL):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='git')
+        self.timeout = timeout
+        self.repo_locks = {}
+        self.cache_ttl = cache_ttl
+        self.info_cache = {}
+        # Concurrent refreshes of the same entry share one git call
+        self.refreshes = SingleFlight()
+        # Bumped on every invalidation so refreshes started before it don't store outdated results
+        self.cache_generation = 0
+        self.cache_hits = 0
+        self.cache_stale_hits = 0
+        self.cache_misses = 0
+        logging.debug(
+            f"GitService initialized with max_workers: {max_workers}, timeout: {timeout}, cache_ttl: {cache_ttl}")
+
+    def cache_key(self, repo_path, target_branch):
+        if not (repo_path.startswith('http') or repo_path.startswith('https')):
+            repo_path = os.path.normcase(os.path.realpath(repo_path))
+        return repo_path, target_branch
+
+    def repo_lock(self, repo_path):
+        key = os.path.normcase(os.path.realpath(repo_path))
+        if key not in self.repo_locks:
+            self.repo_locks[key] = asyncio.Lock()
+        return self.repo_locks[key]
+
+    async def run(self, func, *args, lock=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        if lock:
+            await lock.acquire()
+        try:
+            future = loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        except Exception:
+            if lock:
+                lock.release()
+            raise
+        # The lock is held until the blocking call really finishes, even if the caller timed out
+        if lock:
+            future.add_done_callback(lambda f: lock.release())
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"{func.__name__} timed out after {self.timeout}s")
+            raise
+
+    async def get_github_default_branch(self, repo_url):
+        return await self.run(get_github_default_branch, repo_url)
+
+    async def handle_http_git_info(self, repo_path, target_branch=unset):
+        return await self.run(handle_http_git_info, repo_path, target_branch)
+
+    # Returns the cached commit and branch when possible, use_cache=False always asks git (and refreshes the cache)
+    @metrics.registry.timed('git_operation_duration_seconds', operation='get_git_info')
+    async def get_git_info(self, repo_path, target_branch=unset, use_cache=True):
+        key = self.cache_key(repo_path, target_branch)
+        entry = self.info_cache.get(key)
+        if use_cache and entry:
+            cached_at, result = entry
+            if time.monotonic() - cached_at < self.cache_ttl:
+                self.cache_hits += 1
+                return result
+            self.cache_stale_hits += 1
+            self.refresh_in_background(repo_path, target_branch)
+            return result
+
+        self.cache_misses += 1
+        return await self.refreshes.do(key, self.refresh_git_info, repo_path, target_branch)
+
+    async def refresh_git_info(self, repo_path, target_branch=unset):
+        generation = self.cache_generation
+        if repo_path.startswith('http') or repo_path.startswith('https'):
+            result = await self.run(get_git_info, repo_path, target_branch)
+        else:
+            # Local repositories are fetched, anything else is cloned into STAGING_DIRECTORY
+            if os.path.isdir(os.path.join(repo_path, '.git')):
+                lock = self.repo_lock(repo_path)
+            else:
+                lock = self.repo_lock(STAGING_DIRECTORY)
+            result = await self.run(get_git_info, repo_path, target_branch, lock=lock)
+        if generation == self.cache_generation:
+            self.info_cache[self.cache_key(repo_path, target_branch)] = (time.monotonic(), result)
+        return result
+
+    # Start a refresh of a cache entry unless one is already running for it
+    def refresh_in_background(self, repo_path, target_branch=unset):
+        key = self.cache_key(repo_path, target_branch)
+        if key in self.refreshes:
+            return
+        task = asyncio.create_task(self.refreshes.do(key, self.refresh_git_info, repo_path, target_branch))
+        task.add_done_callback(lambda t: self.refresh_done(key, t))
+
+    def refresh_done(self, key, task):
+        if not task.cancelled() and task.exception():
+            logging.error(f"Background refresh of git info for {key[0]} failed: {task.exception()}")
+
+    # Drop the cached entries of the given repo paths or urls, or every entry when none are given
+    def invalidate(self, *repo_paths):
+        self.cache_generation += 1
+        if not repo_paths:
+            self.info_cache.clear()
+            return
+        paths = {self.cache_key(repo_path, unset)[0] for repo_path in repo_paths}
+        for key in [key for key in self.info_cache if key[0] in paths]:
+            del self.info_cache[key]
+
+    def cache_stats(self):
+        return {
+            "hits": self.cache_hits,
+            "stale_hits": self.cache_stale_hits,
+            "misses": self.cache_misses,
+            "entries": len(self.info_cache),
+        }
+
+    @metrics.registry.timed('git_operation_duration_seconds', operation='pull_repo')
+    async def pull_repo(self, repo_url, repo_path, target_branch, target_commit):
+        result = await self.run(pull_repo, repo_url, repo_path, target_branch, target_commit,
+                                lock=self.repo_lock(repo_path))
+        if result:
+            self.invalidate(repo_url, repo_path)
+        return result
+
+
+git_service = GitService()
+bot.git_service = git_service
+
+
+# Cached content hashes of the staging and production trees, only files whose mtime or size changed are re-read
+file_index = FileIndex()
+
+
+# Content hash of every extension's source as of its last successful load or reload
+extension_manifest = {}
+
+
+def hash_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# Function to process all extensions in the EXTENSIONS_DIRECTORY. Only new extensions are loaded, extensions whose
+# source changed since they were loaded are reloaded and extensions whose file was deleted are unloaded.
+# Returns the action, result and duration per extension that was processed.
+async def process_all_extensions():
+    start_time = time.perf_counter()
+    sources = {f'extensions.{filename[:-3]}': os.path.join(EXTENSIONS_DIRECTORY, filename)
+               for filename in os.listdir(EXTENSIONS_DIRECTORY) if filename.endswith('.py')}
+    hashes = await asyncio.to_thread(lambda: {name: hash_file(path) for name, path in sources.items()})
+
+    actions = {}
+    for extension_name, digest in hashes.items():
+        # Check if extension is already loaded
+        if extension_name not in bot.extensions:
+            actions[extension_name] = 'load'
+        elif extension_manifest.get(extension_name) != digest:
+            actions[extension_name] = 'reload'
+    for extension_name in bot.extensions:
+        if extension_name.startswith('extensions.') and extension_name not in hashes:
+            actions[extension_name] = 'unload'
+
+    # Extensions are independent of each other, so they are processed concurrently
+    results = await asyncio.gather(*(process_extension(extension_name, action, hashes.get(extension_name))
+                                     for extension_name, action in actions.items()))
+    timings = dict(zip(actions, results))
+    logging.info(f"Processed {len(timings)} of {len(hashes)} extensions in {time.perf_counter() - start_time:.3f}s, "
+                 f"{len(hashes) - len(actions)} unchanged")
+    return timings
+
+
+async def process_extension(extension_name, action, digest):
+    start_time = time.perf_counter()
+    ok = True
+    try:
+        if action == 'load':
+            await bot.load_extension(extension_name)
+            extension_manifest[extension_name] = digest
+        elif action == 'reload':
+            await bot.reload_extension(extension_name)
+            extension_manifest[extension_name] = digest
+        else:
+            await bot.unload_extension(extension_name)
+            extension_manifest.pop(extension_name, None)
+    except commands.ExtensionError as e:
+        ok = False
+        logging.error(f"Failed to {action} extension {extension_name}: {e}")
+    duration = time.perf_counter() - start_time
+    metrics.registry.observe('extension_duration_seconds', duration, action=action, outcome='ok' if ok else 'error')
+    if ok:
+        logging.info(f"{action.capitalize()}ed extension: {extension_name} in {duration:.3f}s")
+    return {"action": action, "ok": ok, "duration": duration}
+
+
+# Add a check to see if the user is an admin role or administrator
+def is_admin(ctx):
+    if ctx.author.guild_permissions.administrator:
+        return True
+    if ctx.guild and ctx.bot.role_index.is_indexed(ctx.guild.id):
+        return ctx.bot.role_index.member_has_role(ctx.guild.id, ctx.author.id, ADMIN_ROLE_NAME)
+    return discord.utils.get(ctx.author.roles, name=ADMIN_ROLE_NAME)
+
+
+# Check if argument is a git commit hash
+def is_likely_commit(arg):
+    return len(arg) == 7 and all(c.isalnum() for c in arg)
+
+
+# Command to update the bot
+@bot.command(name='update', help='Update the bot code from a git repo')
+@commands.check(is_admin)
+async def update(ctx, *args):
+    try:
+        # Get git info of production code in BOT_DIRECTORY
+        current_commit, current_branch = await git_service.get_git_info(BOT_DIRECTORY, use_cache=False)
+        logging.info(f"Current commit: {current_commit}, current branch: {current_branch}")
+
+        # Get git info of GIT_REPO_URL repo
+        github_commit, github_branch = await git_service.get_git_info(GIT_REPO_URL, target_branch=current_branch,
+                                                                     use_cache=False)
+        logging.info(f"Github commit: {github_commit}, github branch: {github_branch}")
+
+        # Parse arguments
+        target_branch = unset
+        target_commit = unset
+
+        commit_count = 0
+        branch_count = 0
+
+        for arg in args:
+            if is_likely_commit(arg):
+                commit_count += 1
+                target_commit = arg
+            else:
+                branch_count += 1
+                target_branch = arg
+
+        if commit_count == len(args) and len(args) > 0:
+            await ctx.send("All arguments are being interpreted as commit hashes. Please provide a branch name.")
+            return
+
+        if branch_count == len(args) and len(args) > 0:
+            await ctx.send(
+                "All arguments are being interpreted as branch names. Please provide a commit hash if intended.")
+            return
+
+        # Compare current commit and branch to target commit and branch
+        if target_branch != unset and target_commit != unset:
+            if target_branch == current_branch and target_commit == current_commit:
+                await ctx.send(
+                    f"Current commit is already {target_commit} and branch is already {target_branch}. No action taken.")
+                return
+
+        # If only one of target commit or branch is provided, check if it's the same as the current commit or branch
+        elif target_commit != unset:
+            if target_commit == current_commit:
+                await ctx.send(f"Current commit is already {target_commit} on {current_branch}. No action taken.")
+                return
+
+        # Uncertain of logic here
+        elif target_branch != unset:
+            if target_branch == current_branch and github_commit == current_commit:
+                await ctx.send(f"Current branch is already {target_branch} with commit {current_commit}. No action taken.")
+                return
+
+        else:
+            # Compare current commit and branch to GitHub commit and branch
+            if github_branch == current_branch and github_commit == current_commit:
+                await ctx.send(
+                    f"Current commit is already {github_commit} and branch is already {github_branch}. No action taken.")
+                return
+
+        # Pull from GIT_REPO_URL repo into STAGING_DIRECTORY. Without a branch argument the branch ls-remote was just
+        # asked about is pulled, so pull_repo can reuse that answer instead of asking the remote again.
+        pull_branch = target_branch if target_branch != unset else github_branch
+        if await git_service.pull_repo(GIT_REPO_URL, STAGING_DIRECTORY, target_branch=pull_branch,
+                                       target_commit=target_commit):
+            await ctx.send(f"Repository at {GIT_REPO_URL} updated successfully for {STAGING_DIRECTORY}.")
+        else:
+            await ctx.send(f"Failed to update the repository at {GIT_REPO_URL}.")
+            return
+
+        # Compile every staged file and import every staged extension before anything goes live
+        report = await validate_staged_code(STAGING_DIRECTORY, import_timeout=VALIDATION_IMPORT_TIMEOUT)
+        failed = [result for result in report['results'] if not result['ok']]
+        if failed:
+            details = '\n'.join(f"{result['path']} ({result['stage']}): {result['error']}" for result in failed)
+            await ctx.send(f"Validation of the staged code failed:\n{details}"[:2000])
+            return
+        await ctx.send(f"Validated {len(report['results'])} checks in {report['duration']:.2f}s.")
+
+        # Compare the staged code against production and copy over only the files that changed
+        changes = await asyncio.to_thread(diff_trees, STAGING_DIRECTORY, BOT_DIRECTORY, file_index)
+        if not changes:
+            await ctx.send("Staged code is identical to the running code. No action taken.")
+            return
+        if HANDOFF_ENABLED:
+            await asyncio.to_thread(backup_changes, changes, BOT_DIRECTORY, DEPLOY_BACKUP_DIRECTORY)
+        await asyncio.to_thread(apply_changes, changes, STAGING_DIRECTORY, BOT_DIRECTORY)
+        changed_files = ', '.join(f"{change['path']} ({change['change']})" for change in changes)
+        await ctx.send(f"Deployed {len(changes)} changed files: {changed_files}"[:2000])
+
+        # Take the cheapest action that puts the changes live
+        action = choose_action(changes)
+        if action == ACTION_RELOAD:
+            logging.info("Only extensions have changed. Reloading extensions...")
+            timings = await process_all_extensions()  # Function to reload Discord extensions
+            failed = [extension_name for extension_name, timing in timings.items() if not timing['ok']]
+            if failed:
+                await ctx.send(f"Failed to reload extensions: {', '.join(failed)}")
+            else:
+                await ctx.send(f"Reloaded {len(timings)} extensions.")
+        elif action == ACTION_RESTART and HANDOFF_ENABLED:
+            logging.info("Core files have changed. Handing off to a new process...")
+            await ctx.send("Core files have changed. Starting a new process to hand off to...")
+            await hand_off_to_successor(ctx, changes)
+        elif action == ACTION_RESTART:
+            logging.info("Core files have changed. Restarting script...")
+            await ctx.send("Core files have changed. Restarting...")
+            await bot.restart()  # The script exits once the bot closed, WinSW should handle the restart
+        else:
+            logging.info("Only non-code files have changed. No reload needed.")
+
+    except Exception as e:
+        await ctx.send(f"An unexpected error occurred: {str(e)}. Type: {type(e).__name__}")
+
+
+# Blue/green handoff for core updates (HANDOFF_ENABLED). The new code starts as a second process from BOT_DIRECTORY,
+# loads every extension and connects to the gateway, then reports ready over a local socket. Only then this process
+# stops taking commands, lets the successor take over, drains its in-flight commands, stops its managed servers,
+# flushes server_info.json and disconnects. If the successor fails or is not ready in time it is killed and the
+# previous files are restored, this process keeps running. The process the service wrapper started does not exit
+# after handing off, see stay_for_successor. command starts the successor, bot.py by default.
+async def hand_off_to_successor(ctx, changes, command=None):
+    predecessor = handoff.Predecessor(command or [sys.executable, os.path.join(BOT_DIRECTORY, 'bot.py')],
+                                      BOT_DIRECTORY, ready_timeout=HANDOFF_READY_TIMEOUT)
+    try:
+        pid = await predecessor.launch()
+        await asyncio.to_thread(handoff.write_active_pid, HANDOFF_PID_FILE, pid)
+    except (handoff.HandoffError, OSError) as e:
+        logging.error(f"Handoff failed: {str(e)}")
+        await predecessor.abort()
+        await asyncio.to_thread(restore_changes, changes, BOT_DIRECTORY, DEPLOY_BACKUP_DIRECTORY)
+        await ctx.send(f"Handoff failed, kept the running process and restored the previous files: {str(e)}")
+        return
+
+    bot.accepting_commands = False
+    await predecessor.go(last_message_id=bot.last_message_id)
+    logging.info(f"Process {pid} took over, draining {bot.commands_in_flight} in-flight commands")
+    await ctx.send(f"Process {pid} took over. This process disconnects once its running commands finished.")
+    asyncio.create_task(finish_handoff(predecessor))
+
+
+async def finish_handoff(predecessor):
+    # The update command that started the handoff is still counted until it returns
+    deadline = time.monotonic() + HANDOFF_DRAIN_TIMEOUT
+    while bot.commands_in_flight and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if bot.commands_in_flight:
+        logging.warning(f"Exiting with {bot.commands_in_flight} commands still running after {HANDOFF_DRAIN_TIMEOUT}s")
+
+    servers = getattr(bot, 'managed_servers', {})
+    running_servers = [app_id for app_id, server in servers.items() if server.running]
+    await asyncio.gather(*(server.stop() for server in servers.values()))
+    await server_store.close()
+    bot.handed_off = True
+    await predecessor.done(running_servers=running_servers)
+    await asyncio.to_thread(shutil.rmtree, DEPLOY_BACKUP_DIRECTORY, True)
+    # The successor takes over the metrics endpoint
+    await metrics_server.stop()
+    loop_lag_monitor.stop()
+    await bot.close()
+
+
+# The process the service wrapper started stays alive after it handed off, for as long as the bot that took over
+# (or any later successor) runs. The wrapper therefore never starts a second bot next to it, and stopping the
+# service stops the running bot. Returns the exit status for the entry point: 1 once the running bot exited on its
+# own, so the wrapper starts a new one, otherwise 0. Successors simply exit after handing off.
+async def stay_for_successor():
+    if not bot.handed_off or bot.started_by_handoff:
+        return 0
+    logging.info(f"Handed off, staying alive while the bot in {HANDOFF_PID_FILE} runs")
+    stopped = await handoff.keep_alive(HANDOFF_PID_FILE)
+    return 0 if stopped else 1
+
+
+# The successor's side of the handoff, runs once the new process is connected
+async def take_over_from_predecessor(successor):
+    if bot.extension_failures:
+        await successor.signal_failed(f"Failed to load extensions: {', '.join(bot.extension_failures)}")
+        await bot.close()
+        return
+    try:
+        go = await successor.signal_ready(timeout=HANDOFF_READY_TIMEOUT)
+    except (handoff.HandoffError, OSError, asyncio.TimeoutError) as e:
+        logging.error(f"Handoff from the previous process failed: {str(e)}")
+        await bot.close()
+        return
+    bot.take_commands(after=go.get('last_message_id', 0))
+    logging.info("Taking commands, waiting for the previous process to finish")
+
+    message = await successor.wait_done(timeout=HANDOFF_DRAIN_TIMEOUT + SUPERVISOR_STOP_TIMEOUT + 60)
+    # Pick up whatever the previous process wrote while it drained
+    if server_store.loaded:
+        await asyncio.to_thread(server_store.load)
+    bot.inherited_servers = message.get('running_servers', [])
+    bot.handoff_done.set()
+    logging.info("Handoff complete")
+    # The previous process held the port until now
+    if METRICS_PORT and not metrics_server.started:
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            logging.error(f"Could not serve metrics on {METRICS_HOST}:{METRICS_PORT}: {str(e)}")
+
+
+# Discord on ready event with logging
+@bot.event
+async def on_ready():
+    logging.info(f'Logged in as {bot.user.name} (ID: {bot.user.id})')
+    logging.info(f'Discord.py version: {discord.__version__}')
+    # Warm the git info cache so the first *info does not wait for a fetch
+    git_service.refresh_in_background(BOT_DIRECTORY)
+    if bot.successor is not None:
+        successor, bot.successor = bot.successor, None
+        asyncio.create_task(take_over_from_predecessor(successor))
+
+
+# discord.py reconnects on its own and resumes the session when it can, these only log the transitions
+@bot.event
+async def on_disconnect():
+    logging.warning("Disconnected from the Discord gateway, reconnecting")
+
+
+@bot.event
+async def on_resumed():
+    logging.info("Resumed the Discord gateway session")
+
+
+# Command to provide a link to the source code GIT_REPO_URL, state license as AGPL-3.0, strip the .git suffix
+@bot.command(name='source', help='Provide a link to the source code')
+async def source(ctx):
+    await ctx.send(f"Source code available at {GIT_REPO_URL} under the Affero GPL-3.0 license.")
+
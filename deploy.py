@@ -0,0 +1,313 @@
+import ast
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Kinds of changed files, they decide what a deploy has to do
+CORE = 'core'
+EXTENSION = 'extension'
+NON_CODE = 'non-code'
+
+# Deploy actions from cheapest to most expensive
+ACTION_NONE = 'none'
+ACTION_RELOAD = 'reload'
+ACTION_RESTART = 'restart'
+
+# Imports a staged extension in a fresh interpreter and exits with 3 when it has no setup function
+IMPORT_CHECK = (
+    "import importlib, sys\n"
+    "sys.path.insert(0, sys.argv[1])\n"
+    "module = importlib.import_module(sys.argv[2])\n"
+    "sys.exit(0 if callable(getattr(module, 'setup', None)) else 3)\n"
+)
+
+# Settings of the import check interpreter. It inherits the production settings .env put into the environment,
+# these keep importing core from writing log files or a shared fleet database.
+IMPORT_CHECK_ENVIRONMENT = {
+    'LOG_MODE': 'development',
+    'LOG_LEVEL': 'WARNING',
+    'FLEET_STORE': 'memory',
+    'METRICS_PORT': '0',
+}
+
+IGNORED_DIRECTORIES = {'.git', '__pycache__', '.venv', 'venv', '.pytest_cache', '.mypy_cache', '.ruff_cache'}
+
+# Files the running bot writes into its directory, they are never code to deploy. The directories are only
+# matched at the top level.
+RUNTIME_DIRECTORIES = {'logs', 'cogs', 'servers', '.deploy-backup'}
+RUNTIME_SUFFIXES = ('.pyc', '.pyo', '.log', '.db', '.db-journal', '.db-wal', '.db-shm', '.journal', '.tmp', '.pid')
+
+
+# Content hashes of files, cached by path and only recomputed when a file's mtime or size changed
+class FileIndex:
+    def __init__(self):
+        self.entries = {}
+        self.hashed = 0
+
+    def digest(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.entries.pop(path, None)
+            return None
+        entry = self.entries.get(path)
+        if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry[2]
+
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(block)
+        digest = sha256.hexdigest()
+        self.entries[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        self.hashed += 1
+        return digest
+
+
+# Relative paths, always separated by '/', of all files under root except runtime files. Directories named in skip
+# are only skipped at the top level, the staging directory lives inside the production directory.
+def walk_tree(root, skip=()):
+    paths = []
+    for directory, directories, filenames in os.walk(root):
+        relative_directory = os.path.relpath(directory, root)
+        directories[:] = [name for name in directories if name not in IGNORED_DIRECTORIES
+                          and not (relative_directory == '.' and (name in skip or name in RUNTIME_DIRECTORIES))]
+        for filename in filenames:
+            if filename.endswith(RUNTIME_SUFFIXES):
+                continue
+            path = os.path.join(relative_directory, filename) if relative_directory != '.' else filename
+            paths.append(path.replace(os.sep, '/'))
+    return paths
+
+
+# The top-level module names imported anywhere in a file, including imports inside functions
+def imported_modules(path):
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), path)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module.split('.')[0])
+    return names
+
+
+# The top-level .py files of root the running bot imports: the entry point and every module reachable from it or
+# from an extension. Other .py files, such as the benchmarks, are never loaded by the bot.
+def find_core_modules(root, entry_point='bot.py'):
+    pending = [entry_point]
+    extensions_directory = os.path.join(root, 'extensions')
+    if os.path.isdir(extensions_directory):
+        pending += [f'extensions/{filename}' for filename in os.listdir(extensions_directory)
+                    if filename.endswith('.py')]
+    core_modules = {entry_point}
+    while pending:
+        path = pending.pop()
+        try:
+            names = imported_modules(os.path.join(root, *path.split('/')))
+        except (OSError, SyntaxError, ValueError):
+            continue
+        for name in names:
+            module_path = f'{name}.py'
+            if module_path not in core_modules and os.path.isfile(os.path.join(root, module_path)):
+                core_modules.add(module_path)
+                pending.append(module_path)
+    return core_modules
+
+
+def classify_change(path, core_modules=()):
+    if path.endswith('.py'):
+        parts = path.split('/')
+        if len(parts) == 2 and parts[0] == 'extensions':
+            return EXTENSION
+        if path in core_modules:
+            return CORE
+    return NON_CODE
+
+
+# Compare the staged tree against production. Every file that is new or different in staging is reported,
+# files missing from staging are only reported for extensions since production also holds untracked runtime
+# files (.env, server_info.json, logs) that must survive a deploy.
+def diff_trees(staging_directory, production_directory, index, skip=('staging',)):
+    changes = []
+    staged = set(walk_tree(staging_directory, skip))
+    core_modules = find_core_modules(staging_directory)
+    for path in sorted(staged):
+        staged_digest = index.digest(os.path.join(staging_directory, *path.split('/')))
+        production_digest = index.digest(os.path.join(production_directory, *path.split('/')))
+        if staged_digest != production_digest:
+            changes.append({
+                "path": path,
+                "kind": classify_change(path, core_modules),
+                "change": 'added' if production_digest is None else 'modified',
+            })
+
+    extensions_directory = os.path.join(production_directory, 'extensions')
+    if os.path.isdir(extensions_directory):
+        for filename in sorted(os.listdir(extensions_directory)):
+            path = f'extensions/{filename}'
+            if filename.endswith('.py') and path not in staged:
+                changes.append({"path": path, "kind": EXTENSION, "change": 'deleted'})
+
+    logging.info(f"Found {len(changes)} changed files between {staging_directory} and {production_directory}, "
+                 f"hashed {index.hashed} files so far")
+    return changes
+
+
+# The cheapest action that puts the changes live: core changes need a restart, extension changes a reload
+def choose_action(changes):
+    kinds = {change['kind'] for change in changes}
+    if CORE in kinds:
+        return ACTION_RESTART
+    if EXTENSION in kinds:
+        return ACTION_RELOAD
+    return ACTION_NONE
+
+
+# Copy the changed files from staging into production and remove deleted extensions
+def apply_changes(changes, staging_directory, production_directory):
+    for change in changes:
+        parts = change['path'].split('/')
+        destination = os.path.join(production_directory, *parts)
+        try:
+            if change['change'] == 'deleted':
+                os.remove(destination)
+                logging.info(f"Removed {change['path']} from {production_directory}")
+            else:
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                shutil.copy2(os.path.join(staging_directory, *parts), destination)
+                logging.info(f"Copied {change['path']} to {production_directory}")
+        except Exception as e:
+            logging.error(f"An unexpected error occurred while applying {change['path']}: {str(e)}. "
+                          f"Type: {type(e).__name__}")
+            raise e
+
+
+# Keep the production version of every file the changes will overwrite or delete, so restore_changes can put
+# them back when the new code does not come up
+def backup_changes(changes, production_directory, backup_directory):
+    shutil.rmtree(backup_directory, ignore_errors=True)
+    for change in changes:
+        if change['change'] == 'added':
+            continue
+        parts = change['path'].split('/')
+        destination = os.path.join(backup_directory, *parts)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copy2(os.path.join(production_directory, *parts), destination)
+    logging.info(f"Backed up {len(changes)} changed files to {backup_directory}")
+
+
+def restore_changes(changes, production_directory, backup_directory):
+    for change in changes:
+        parts = change['path'].split('/')
+        destination = os.path.join(production_directory, *parts)
+        try:
+            if change['change'] == 'added':
+                os.remove(destination)
+            else:
+                shutil.copy2(os.path.join(backup_directory, *parts), destination)
+            logging.info(f"Restored {change['path']} in {production_directory}")
+        except Exception as e:
+            logging.error(f"An unexpected error occurred while restoring {change['path']}: {str(e)}. "
+                          f"Type: {type(e).__name__}")
+    shutil.rmtree(backup_directory, ignore_errors=True)
+
+
+# Compiles the source in memory so nothing is written into the staged tree.
+def compile_file(root, path):
+    start_time = time.perf_counter()
+    error = None
+    try:
+        with open(os.path.join(root, *path.split('/')), 'rb') as f:
+            source = f.read()
+        compile(source, path, 'exec', dont_inherit=True)
+    except (SyntaxError, ValueError) as e:
+        error = f"{type(e).__name__}: {str(e)}"
+    except Exception as e:
+        error = f"An unexpected error occurred: {str(e)}. Type: {type(e).__name__}"
+    return {"path": path, "stage": 'compile', "ok": error is None, "error": error,
+            "duration": time.perf_counter() - start_time}
+
+
+# Copy the files of the staged tree for the import checks. Importing core creates directories and files next to it,
+# in the staging clone they would make the next pull find it dirty.
+def copy_tree(root, destination):
+    for path in walk_tree(root, skip=('staging',)):
+        target = os.path.join(destination, *path.split('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(os.path.join(root, *path.split('/')), target)
+
+
+# Import an extension in an isolated interpreter to check that it imports and exposes setup. root is a throwaway
+# copy of the staged tree, see copy_tree.
+async def import_extension(root, path, timeout):
+    start_time = time.perf_counter()
+    module_name = path[:-3].replace('/', '.')
+    error = None
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-B', '-c', IMPORT_CHECK, root, module_name, cwd=root,
+        env=dict(os.environ, **IMPORT_CHECK_ENVIRONMENT),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        error = f"Import timed out after {timeout}s"
+    else:
+        if process.returncode == 3:
+            error = "Extension does not define a setup function"
+        elif process.returncode != 0:
+            lines = stderr.decode('utf-8', errors='replace').strip().splitlines()
+            error = lines[-1] if lines else f"Import exited with code {process.returncode}"
+    return {"path": path, "stage": 'import', "ok": error is None, "error": error,
+            "duration": time.perf_counter() - start_time}
+
+
+# Validate the staged code before it goes live: every .py file is compiled on a worker thread, then every extension
+# that compiled is imported in its own subprocess from a temporary copy of the tree. Compiling stays in this process:
+# a process pool would re-import bot.py in every worker on Windows, or fork a process with live Steam and asyncio
+# threads elsewhere. Returns a per-file report with timings.
+async def validate_staged_code(staging_directory, import_timeout=60, max_workers=None):
+    start_time = time.perf_counter()
+    max_workers = max_workers or os.cpu_count() or 1
+    paths = [path for path in walk_tree(staging_directory, skip=('staging',)) if path.endswith('.py')]
+    results = []
+
+    if paths:
+        results = await asyncio.to_thread(lambda: [compile_file(staging_directory, path) for path in paths])
+
+    compiled_extensions = [result['path'] for result in results
+                           if result['ok'] and classify_change(result['path']) == EXTENSION]
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def limited_import(root, path):
+        async with semaphore:
+            return await import_extension(root, path, import_timeout)
+
+    if compiled_extensions:
+        import_directory = await asyncio.to_thread(tempfile.mkdtemp, prefix='deploy-import-')
+        try:
+            await asyncio.to_thread(copy_tree, staging_directory, import_directory)
+            results.extend(await asyncio.gather(*(limited_import(import_directory, path)
+                                                  for path in compiled_extensions)))
+        finally:
+            await asyncio.to_thread(shutil.rmtree, import_directory, True)
+
+    report = {
+        "ok": all(result['ok'] for result in results),
+        "duration": time.perf_counter() - start_time,
+        "results": results,
+    }
+    failed = [result for result in results if not result['ok']]
+    logging.info(f"Validated {len(paths)} files and {len(compiled_extensions)} extensions in "
+                 f"{report['duration']:.2f}s, {len(failed)} failed")
+    for result in failed:
+        logging.error(f"Validation of {result['path']} failed during {result['stage']}: {result['error']}")
+    return report
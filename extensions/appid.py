@@ -1,142 +1,346 @@
-from bot import *
-
-
-def read_server_info(filename):
-    logging.info(f"Reading server info from {filename}")
-    try:
-        with open(filename, 'r') as f:
-            data = json.load(f)
-            logging.debug(f"Data read from {filename}: {data}")
-            return data
-    except FileNotFoundError as e:
-        logging.error(f"FileNotFoundError: {str(e)}")
-        raise e
-    except json.JSONDecodeError as e:
-        logging.error(f"JSONDecodeError: {str(e)}")
-        raise e
-    except Exception as e:
-        logging.error(f"An unexpected error occurred: {str(e)}. Type: {type(e).__name__}")
-        raise e
-
-
-def write_server_info(filename, data):
-    logging.info(f"Writing server info to {filename}")
-    try:
-        with open(filename, 'w') as f:
-            json.dump(data, f, indent=4)
-            logging.debug(f"Data written to {filename}: {data}")
-    except Exception as e:
-        logging.error(f"An unexpected error occurred: {str(e)}. Type: {type(e).__name__}")
-        raise e
+from core import *
 
 
+# The fetch methods run on the SteamWorker thread with a logged-in client, gevent is imported there on first use.
+# With a ProductInfoCache, fetch_info_async only downloads and parses the apps whose PICS change number moved.
 class AppInfoFetcher:
-    def __init__(self, retries=3, timeout=5):
-        self.retries = retries
+    def __init__(self, timeout=5, cache=None):
         self.timeout = timeout
-        logging.debug(f"AppInfoFetcher initialized with retries: {retries}, timeout: {timeout}")
+        self.cache = cache
+        logging.debug(f"AppInfoFetcher initialized with timeout: {timeout}")
 
-    def fetch_info(self, app_id, client):
-        logging.info(f"Starting the process to fetch info for AppID: {app_id}")
-        try:
-            app_id = int(app_id)
-            logging.debug(f"AppID {app_id} converted to integer")
+    # Parse the product info of a single app into the format stored in server_info.json
+    def parse_info(self, app_id, app_data):
+        service_name = app_data['common']['name']
+        branches = app_data['depots']['branches']
+        build_id = branches.get('public', {}).get('buildid')
+        # Deferred %-formatting, the branches dict is only turned into a string when DEBUG is enabled
+        logging.debug("Parsed values - Service Name: %s, Build ID: %s, Branches: %s", service_name, build_id, branches)
+
+        if service_name and build_id:
+            password_required = {key: branches[key].get('pwdrequired', "0") == "1" for key in branches}
+            logging.debug("Password requirement parsed for branches: %s", password_required)
+            logging.debug("Returning data for AppID %s: service_name: %s, build_id: %s, password_required: %s",
+                          app_id, service_name, build_id, password_required)
+            return {
+                "name": service_name,
+                "build_id": build_id,
+                "branch": 'public',
+                "branches": list(branches.keys()),
+                "build_ids": {key: branches[key].get('buildid') for key in branches},
+                "password_required": password_required,
+            }
+        else:
+            logging.warning("Required data (service_name or build_id) missing for AppID %s", app_id)
+
+    # Fetch info for many AppIDs through a SteamWorker. With a cache, apps checked within its freshness window are
+    # answered from it, the others are checked with one PICS change query and only the apps that changed since
+    # their cached info (or are not cached) are downloaded.
+    @metrics.registry.timed('steam_fetch_duration_seconds', operation='fetch_info_async')
+    async def fetch_info_async(self, app_ids, worker, chunk_size=STEAM_PRODUCT_INFO_CHUNK_SIZE):
+        app_ids = list(app_ids)
+        if self.cache is None:
+            results, failures, _ = await self.download(app_ids, worker, chunk_size)
+            return results, failures
+
+        now = time.time()
+        results = {app_id: self.cache.parsed(app_id) for app_id in app_ids if self.cache.is_fresh(app_id, now)}
+        stale = [app_id for app_id in app_ids if app_id not in results]
+        cached = [app_id for app_id in stale if self.cache.has(app_id)]
+        changed = stale
+        change_number = 0
+        if cached:
+            try:
+                change_number, changes = await worker.call(self.fetch_changes, self.cache.since(cached))
+            except Exception as e:
+                logging.warning(f"Could not query PICS changes, downloading {len(stale)} AppIDs: {str(e)}. "
+                                f"Type: {type(e).__name__}")
+                changes = None
+            if changes is not None:
+                changed = self.cache.changed(stale, changes)
+                unchanged = sorted(set(cached) - set(changed))
+                self.cache.verified(unchanged, change_number, now)
+                results.update({app_id: self.cache.parsed(app_id) for app_id in unchanged})
+
+        failures = {}
+        if changed:
+            downloaded, failures, records = await self.download(changed, worker, chunk_size)
+            for app_id, record in records.items():
+                self.cache.store(app_id, record['change_number'], record['access_token'], record['info'],
+                                 downloaded[app_id], verified_change=change_number, now=now)
+            results.update(downloaded)
+            if records:
+                await asyncio.to_thread(self.cache.save)
+        logging.info("Product info for %d AppIDs: %d fresh, %d unchanged, %d downloaded, %d failed", len(app_ids),
+                     len(app_ids) - len(stale), len(stale) - len(changed), len(changed) - len(failures),
+                     len(failures))
+        return results, failures
+
+    # Download and parse product info, the chunks are requested concurrently. Returns the parsed data, the
+    # failures and the raw records for the cache keyed by AppID.
+    async def download(self, app_ids, worker, chunk_size=STEAM_PRODUCT_INFO_CHUNK_SIZE):
+        logging.info("Starting the process to fetch info for %d AppIDs in chunks of %d", len(app_ids), chunk_size)
+        access_tokens = {app_id: self.cache.access_token(app_id) for app_id in app_ids} if self.cache is not None else {}
+        chunks = [app_ids[start:start + chunk_size] for start in range(0, len(app_ids), chunk_size)]
+        responses = await asyncio.gather(*(worker.call(self.fetch_chunk, chunk, access_tokens) for chunk in chunks),
+                                         return_exceptions=True)
+        results = {}
+        failures = {}
+        records = {}
+        for chunk, response in zip(chunks, responses):
+            if isinstance(response, BaseException):
+                logging.error(f"An unexpected error occurred while fetching info for AppIDs {chunk}: {str(response)}. "
+                              f"Type: {type(response).__name__}")
+                for app_id in chunk:
+                    failures[app_id] = f"{type(response).__name__}: {str(response)}"
+                continue
+            results.update(response[0])
+            failures.update(response[1])
+            records.update(response[2])
+
+        logging.info("Fetched info for %d AppIDs, %d failed", len(results), len(failures))
+        return results, failures, records
+
+    # The current global PICS change number and the change number of every app that changed since
+    # since_change_number keyed by AppID, or None instead of the changes when Steam asks for a full update
+    # (since_change_number is too old)
+    def fetch_changes(self, client, since_change_number):
+        response = client.get_changes_since(since_change_number, app_changes=True, package_changes=False)
+        if response is None:
+            raise ConnectionError("No response to the PICS change query")
+        if response.force_full_update or response.force_full_app_update:
+            logging.info("Steam asked for a full update since change number %s", since_change_number)
+            return response.current_change_number, None
+        changes = {str(change.appid): change.change_number for change in response.app_changes}
+        logging.debug("%d apps changed since change number %s", len(changes), since_change_number)
+        return response.current_change_number, changes
+
+    # Fetch and parse one chunk of AppIDs with a single get_product_info call on a logged on client. Access tokens
+    # that are not known yet are requested first, one call for the whole chunk.
+    def fetch_chunk(self, client, app_ids, access_tokens=None):
+        import gevent
+        results = {}
+        failures = {}
+        records = {}
+        # server_info.json keys AppIDs as strings while Steam keys them as integers
+        steam_ids = {}
+        for app_id in app_ids:
+            try:
+                steam_ids[int(app_id)] = app_id
+            except ValueError as e:
+                logging.error("AppID %s is not a valid integer: %s", app_id, e)
+                failures[app_id] = f"Invalid AppID: {str(e)}"
+        if not steam_ids:
+            return results, failures, records
 
-            if not client.logged_on:
-                logging.debug(f"Client not logged on, logging on")
-                with gevent.Timeout(self.timeout):
-                    client.anonymous_login()
-                    logging.debug(f"Anonymous login for client successful")
+        tokens = {steam_id: (access_tokens or {}).get(app_id) for steam_id, app_id in steam_ids.items()}
+        missing = [steam_id for steam_id, token in tokens.items() if token is None]
+        if missing:
+            try:
+                response = client.get_access_tokens(app_ids=missing) or {}
+                tokens.update({steam_id: token for steam_id, token in response.get('apps', {}).items()
+                               if steam_id in tokens})
+            except (gevent.Timeout, Exception) as e:
+                # Public apps do not need a token
+                logging.warning("Could not get access tokens for AppIDs %s: %s", missing, e)
+
+        try:
+            data = client.get_product_info(apps=[(steam_id, tokens[steam_id] or 0) for steam_id in steam_ids],
+                                           timeout=self.timeout)
+        except (gevent.Timeout, Exception) as e:
+            logging.error("An unexpected error occurred while fetching info for AppIDs %s: %s. Type: %s",
+                          list(steam_ids), e, type(e).__name__)
+            for app_id in steam_ids.values():
+                failures[app_id] = f"{type(e).__name__}: {str(e)}"
+            return results, failures, records
 
+        apps = data.get('apps', {}) if data else {}
+        for steam_id, app_id in steam_ids.items():
+            if steam_id not in apps:
+                logging.warning("No data returned for AppID %s", app_id)
+                failures[app_id] = "No data returned"
+                continue
+            try:
+                parsed = self.parse_info(app_id, apps[steam_id])
+            except Exception as e:
+                logging.error("An unexpected error occurred while parsing info for AppID %s: %s. Type: %s",
+                              app_id, e, type(e).__name__)
+                failures[app_id] = f"{type(e).__name__}: {str(e)}"
+                continue
+            if parsed:
+                results[app_id] = parsed
+                app_data = apps[steam_id]
+                records[app_id] = {
+                    "change_number": app_data.get('_change_number', 0),
+                    # A token Steam did not accept is requested again next time
+                    "access_token": None if app_data.get('_missing_token') else tokens[steam_id],
+                    "info": app_data,
+                }
             else:
-                logging.debug(f"Client already logged on")
-
-            client.verbose_debug = False
-            data = client.get_product_info(apps=[app_id], timeout=1)
-
-            if data:
-                logging.debug(f"Data fetched for AppID {app_id}: {data}")
-                service_name = data['apps'][app_id]['common']['name']
-                branches = data['apps'][app_id]['depots']['branches']
-                build_id = branches.get('public', {}).get('buildid')
-                logging.debug(
-                    f"Parsed values - Service Name: {service_name}, Build ID: {build_id}, Branches: {branches}")
-
-                if service_name and build_id:
-                    password_required = {key: branches[key].get('pwdrequired', "0") == "1" for key in branches}
-                    logging.debug(f"Password requirement parsed for branches: {password_required}")
-                    logging.debug(
-                        f"Returning data for AppID {app_id}: service_name: {service_name}, build_id: {build_id}, password_required: {password_required}")
-                    return {
-                        "name": service_name,
-                        "build_id": build_id,
-                        "branch": 'public',
-                        "branches": list(branches.keys()),
-                        "password_required": password_required,
-                    }
+                failures[app_id] = "Required data (service_name or build_id) missing"
+        return results, failures, records
+
+
+# Compare the per-branch build IDs of a freshly fetched app record against the stored record of the app.
+# Returns (branch, old_build_id, new_build_id) for every branch whose build ID changed, branches without
+# a previously known build ID are not reported.
+def diff_build_ids(old_app, new_app):
+    if old_app is None:
+        return []
+    changes = []
+    for branch, build_id in new_app.build_ids.items():
+        old_build_id = old_app.build_ids.get(branch)
+        if old_build_id is not None and old_build_id != build_id:
+            changes.append((branch, old_build_id, build_id))
+    return changes
+
+
+# Polls Steam for the build IDs of every tracked AppID on a jittered interval, backing off exponentially while
+# polls fail. All polls go through the SteamWorker's logged-in client, and every app is polled at most once per
+# min_app_interval. When a branch's build ID changes the bot dispatches
+# on_steam_build_update(app_id, branch, old_build_id, new_build_id).
+# Across the fleet each app is polled by the instance holding its lease, the others use the data it shared.
+class BuildIDPoller:
+    def __init__(self, discord_bot, fetcher, worker, interval=STEAM_POLL_INTERVAL, jitter=STEAM_POLL_JITTER,
+                 min_app_interval=STEAM_APP_MIN_INTERVAL, max_backoff=STEAM_POLL_MAX_BACKOFF):
+        self.bot = discord_bot
+        self.fetcher = fetcher
+        self.worker = worker
+        self.interval = interval
+        self.jitter = jitter
+        self.min_app_interval = min_app_interval
+        self.max_backoff = max_backoff
+        self.last_polled = {}
+        self.consecutive_failures = 0
+        self.task = None
+        logging.debug(f"BuildIDPoller initialized with interval: {interval}, jitter: {jitter}, "
+                      f"min_app_interval: {min_app_interval}, max_backoff: {max_backoff}")
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+            logging.info("BuildIDPoller started")
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+            logging.info("BuildIDPoller stopped")
+
+    def next_delay(self):
+        delay = min(self.interval * 2 ** min(self.consecutive_failures, 16), self.max_backoff)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.next_delay())
+            try:
+                results, failures = await self.poll()
+                if failures and not results:
+                    self.consecutive_failures += 1
                 else:
-                    logging.warning(f"Required data (service_name or build_id) missing for AppID {app_id}")
-            else:
-                logging.warning(f"No data returned for AppID {app_id}")
-        except gevent.Timeout as e:
-            logging.error(f"Timeout error: {str(e)} while fetching info for AppID {app_id}")
-            raise e
-        except Exception as e:
-            logging.error(
-                f"An unexpected error occurred while fetching info for AppID {app_id}: {str(e)}. Type: {type(e).__name__}")
-            raise e
+                    self.consecutive_failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.consecutive_failures += 1
+                logging.error(f"An unexpected error occurred while polling build IDs: {str(e)}. Type: {type(e).__name__}")
+
+    # Fetch the AppIDs that are due (all of them when force is set), store the results and dispatch changes
+    async def poll(self, force=False):
+        store = self.bot.server_store
+        await store.ensure_loaded()
+        now = time.monotonic()
+        app_ids = [app_id for app_id in store.app_ids(COMPUTER_NAME)
+                   if force or now - self.last_polled.get(app_id, float('-inf')) >= self.min_app_interval]
+        if not app_ids:
+            return {}, {}
+
+        # Only the instance holding an app's lease polls Steam for it, the others use the data it shared
+        start_time = time.perf_counter()
+        fleet = self.bot.fleet
+        leases = await fleet.acquire_leases([f'steam-poll:{app_id}' for app_id in app_ids])
+        polled_app_ids = [app_id for app_id in app_ids if f'steam-poll:{app_id}' in leases]
+        shared_app_ids = [app_id for app_id in app_ids if f'steam-poll:{app_id}' not in leases]
+
+        results, failures = {}, {}
+        if polled_app_ids:
+            results, failures = await self.fetcher.fetch_info_async(polled_app_ids, self.worker)
+            await fleet.publish_steam_data(results)
+        if shared_app_ids:
+            results.update(await fleet.get_steam_data(shared_app_ids))
+            logging.debug("Using Steam data shared by other instances for %d AppIDs", len(shared_app_ids))
+        now = time.monotonic()
+        for app_id in app_ids:
+            self.last_polled[app_id] = now
+
+        for app_id, steam_data in results.items():
+            changes = diff_build_ids(store.app(COMPUTER_NAME, app_id), App.from_section(steam_data))
+            # The store only writes the AppIDs whose data actually changed. Merging keeps the keys that are not
+            # Steam data, such as the server launch settings of the supervisor.
+            if store.update(COMPUTER_NAME, app_id, steam_data):
+                logging.info('Updating AppID %s info', app_id)
+            for branch, old_build_id, new_build_id in changes:
+                logging.info("Build ID of AppID %s branch %s changed from %s to %s", app_id, branch, old_build_id,
+                             new_build_id)
+                self.bot.dispatch('steam_build_update', app_id, branch, old_build_id, new_build_id)
+
+        for app_id, error in failures.items():
+            logging.error("Failed to refresh AppID %s: %s", app_id, error)
+
+        logging.info("Refreshed %d of %d AppIDs (%d polled) in %.2fs, %d failed", len(results), len(app_ids),
+                     len(polled_app_ids), time.perf_counter() - start_time, len(failures))
+        return results, failures
 
 
 class AppIDCog(commands.Cog):
     def __init__(self, discord_bot):
         self.bot = discord_bot
-        self.app_info_fetcher = AppInfoFetcher()
+        self.product_info_cache = ProductInfoCache(STEAM_INFO_CACHE_FILE, freshness=STEAM_INFO_FRESHNESS)
+        self.app_info_fetcher = AppInfoFetcher(cache=self.product_info_cache)
+        self.steam_worker = SteamWorker(timeout=STEAM_REQUEST_TIMEOUT, login_timeout=self.app_info_fetcher.timeout)
+        self.poller = BuildIDPoller(discord_bot, self.app_info_fetcher, self.steam_worker)
+        self.start_task = None
         logging.info("AppIDCog initialized")
 
+    async def cog_load(self):
+        await asyncio.to_thread(self.product_info_cache.load)
+        # Reloaded on a connected bot (a deploy), on_ready does not fire again and the previous cog's poller was
+        # stopped by its cog_unload
+        if self.bot.is_ready():
+            self.start_task = asyncio.create_task(self.start_polling())
+
+    async def cog_unload(self):
+        if self.start_task is not None:
+            self.start_task.cancel()
+        self.poller.stop()
+        await self.steam_worker.stop()
+
+    # Cold start only, a reload of the extension starts polling from cog_load
     @commands.Cog.listener()
     async def on_ready(self):
         logging.info("AppIDCog on_ready started")
+        await self.start_polling()
+        logging.info("AppIDCog on_ready completed")
+
+    async def start_polling(self):
+        # A process started by a handoff only writes server_info.json once its predecessor exited
+        await self.bot.wait_for_handoff()
+        store = self.bot.server_store
         try:
-            if os.path.exists('server_info.json'):
-                server_info = read_server_info('server_info.json')
-                existing_app_ids = set(server_info.get(COMPUTER_NAME, {}).keys())
-                logging.debug(f"Existing AppIDs: {existing_app_ids}")
-            else:
-                server_info = {COMPUTER_NAME: {}}
-                existing_app_ids = set()
-        except FileNotFoundError as e:
-            logging.error(f"FileNotFoundError: {str(e)}")
-            server_info = {COMPUTER_NAME: {}}
-            existing_app_ids = set()
-        except KeyError as e:
-            logging.error(f"KeyError: {str(e)}")
-            server_info = {COMPUTER_NAME: {}}
-            existing_app_ids = set()
+            await store.ensure_loaded()
+            store.ensure_machine(COMPUTER_NAME)
         except Exception as e:
             logging.error(f"An unexpected error occurred: {str(e)}. Type: {type(e).__name__}")
             raise e
 
-        # Fetch the data for each AppID
-        client = SteamClient()
-        data_changed = False  # Track if the data has changed
-
-        for app_id in existing_app_ids:
+        # on_ready fires again after reconnects, only the first start refreshes everything and starts polling
+        if self.poller.task is None:
+            self.poller.start()
             try:
-                steam_data = self.app_info_fetcher.fetch_info(app_id, client)
-                if steam_data:
-                    server_info[COMPUTER_NAME][app_id] = steam_data
-                    logging.info(f'Updating AppID {app_id} info')
-                    data_changed = True  # Data has changed
+                await self.poller.poll(force=True)
             except Exception as e:
-                logging.error(
-                    f"An unexpected error occurred while processing AppID {app_id}: {str(e)}. Type: {type(e).__name__}")
-                raise e
-
-        # Only write the data to the file if it has changed
-        if data_changed:
-            write_server_info('server_info.json', server_info)
-
-        logging.info("AppIDCog on_ready completed")
+                logging.error(f"An unexpected error occurred while refreshing AppIDs: {str(e)}. Type: {type(e).__name__}")
 
 
 async def setup(bot):
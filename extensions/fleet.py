@@ -0,0 +1,122 @@
+from core import *
+
+
+# Shares this instance's state with the rest of the fleet: a heartbeat every FLEET_HEARTBEAT_INTERVAL seconds
+# and the state of every tracked AppID, which is only published again after it changed.
+class FleetCog(commands.Cog):
+    def __init__(self, discord_bot):
+        self.bot = discord_bot
+        self.published = {}
+        logging.info(f"{self.__class__.__name__} initialized")
+
+    async def cog_load(self):
+        self.heartbeat.start()
+
+    async def cog_unload(self):
+        self.heartbeat.cancel()
+
+    def app_states(self):
+        servers = getattr(self.bot, 'managed_servers', {})
+        states = {}
+        for app_id, app, settings in self.bot.server_store.records(COMPUTER_NAME):
+            # The branch steamcmd installs, the Steam data's own branch is always public
+            branch = settings.get('install_branch', 'public')
+            server = servers.get(app_id)
+            states[app_id] = {
+                "name": app.name if app is not None and app.name else settings.get('name', app_id),
+                "branch": branch,
+                "build_id": app.branch_build_id(branch) if app is not None else None,
+                "installed_build_id": settings.get('installed_build_id'),
+                "server": 'running' if server is not None and server.running else
+                          'stopped' if server is not None else 'unmanaged',
+            }
+        return states
+
+    @tasks.loop(seconds=FLEET_HEARTBEAT_INTERVAL)
+    async def heartbeat(self):
+        try:
+            await self.bot.fleet.heartbeat({
+                "pid": os.getpid(),
+                "guilds": len(self.bot.guilds),
+                "latency": round(self.bot.latency * 1000),
+                "apps": len(self.bot.server_store.app_ids(COMPUTER_NAME)),
+            })
+            changed = {}
+            for app_id, state in self.app_states().items():
+                digest = json.dumps(state, sort_keys=True)
+                if self.published.get(app_id) != digest:
+                    changed[app_id] = state
+                    self.published[app_id] = digest
+            await self.bot.fleet.publish_app_states(changed)
+            if changed:
+                logging.debug(f"Published the state of {len(changed)} AppIDs to the fleet")
+            if FLEET_INSTANCE_PRUNE_AFTER:
+                await self.bot.fleet.prune_instances(FLEET_INSTANCE_PRUNE_AFTER)
+        except Exception as e:
+            # Publish everything again on the next heartbeat
+            self.published = {}
+            logging.error(f"An unexpected error occurred during the fleet heartbeat: {str(e)}. "
+                          f"Type: {type(e).__name__}")
+
+    @heartbeat.before_loop
+    async def before_heartbeat(self):
+        await self.bot.wait_until_ready()
+        await self.bot.server_store.ensure_loaded()
+
+    @commands.command(name='fleet', description='Shows the bot instances, their AppIDs and the held leases.')
+    @commands.check(is_admin)
+    async def fleet(self, ctx):
+        logging.info(f"'fleet' command invoked by {ctx.author.name}#{ctx.author.discriminator}")
+        view = await self.bot.fleet.fleet_view()
+        now = time.time()
+
+        lines = ["Instances:"]
+        for instance in view['instances']:
+            age = now - instance['last_seen']
+            status = 'alive' if age <= FLEET_INSTANCE_STALE_AFTER else 'stale'
+            this = " (this instance)" if instance['instance_id'] == INSTANCE_ID else ""
+            lines.append(f"  {instance['instance_id']}{this}: {status}, seen {age:.0f}s ago, "
+                         f"{instance['info'].get('apps', 0)} AppIDs")
+
+        host = None
+        for app in view['apps']:
+            if app['host'] != host:
+                host = app['host']
+                lines.append(f"{host}:")
+            data = app['data']
+            outdated = " (outdated)" if data.get('build_id') and data.get('installed_build_id') and \
+                data['build_id'] != data['installed_build_id'] else ""
+            lines.append(f"  {app['app_id']} {data.get('name')} [{data.get('branch')}] build {data.get('build_id')}"
+                         f"{outdated}, server {data.get('server')}")
+
+        if view['leases']:
+            lines.append("Leases:")
+            for lease in view['leases']:
+                lines.append(f"  {lease['name']} held by {lease['owner']} for {lease['expires_at'] - now:.0f}s")
+
+        for message in split_messages(lines):
+            await ctx.send(message)
+
+
+# Join lines into as few messages of at most limit characters as possible, a large fleet takes several
+def split_messages(lines, limit=2000):
+    messages = []
+    current = []
+    length = 0
+    for line in lines:
+        line = line[:limit]
+        if current and length + 1 + len(line) > limit:
+            messages.append('\n'.join(current))
+            current = []
+            length = 0
+        length += len(line) + (1 if current else 0)
+        current.append(line)
+    if current:
+        messages.append('\n'.join(current))
+    return messages
+
+
+async def setup(bot):
+    cog = FleetCog(bot)
+    await bot.add_cog(cog)
+    logging.info(f"{cog.__class__.__name__} added to bot")
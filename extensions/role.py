@@ -1,35 +1,187 @@
-from bot import *
+from core import *
+
+MEMBERS_PER_PAGE = 20
+PAGE_NAVIGATION_TIMEOUT = 120
+PREVIOUS_PAGE = '\u25c0\ufe0f'
+NEXT_PAGE = '\u25b6\ufe0f'
+
+
+# Split the '--option value' flags off a query_role argument, the remaining words are the role name
+def parse_query_options(query):
+    options = {}
+    words = []
+    tokens = query.split()
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token == '--desc':
+            options['descending'] = True
+        elif token in ('--page', '--sort', '--joined-before', '--joined-after'):
+            if index + 1 >= len(tokens):
+                raise ValueError(f"{token} requires a value")
+            value = tokens[index + 1]
+            index += 1
+            if token == '--page':
+                if not value.isdigit() or int(value) < 1:
+                    raise ValueError("--page must be a positive number")
+                options['page'] = int(value) - 1
+            elif token == '--sort':
+                if value not in ('joined', 'name'):
+                    raise ValueError("--sort must be 'joined' or 'name'")
+                options['sort'] = value
+            else:
+                try:
+                    date = datetime.datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc)
+                except ValueError:
+                    raise ValueError(f"{token} must be a date formatted as YYYY-MM-DD")
+                options['joined_before' if token == '--joined-before' else 'joined_after'] = date
+        else:
+            words.append(token)
+        index += 1
+    return ' '.join(words), options
+
+
+# Sends the members of a role in pages of MEMBERS_PER_PAGE lines, navigated with reactions. Only the members of
+# the requested page are selected and formatted. With the join-date sorted entries of the role index, sorting and
+# join-date filters are a slice of the entries, otherwise a page costs one pass over the role's members.
+# query_role returns once the first page is sent and navigates in a background task, so the navigation window does
+# not hold its command slot.
+class RoleMemberPaginator:
+    def __init__(self, role, page=0, sort='joined', descending=False, joined_before=None, joined_after=None,
+                 per_page=MEMBERS_PER_PAGE, index_entries=None):
+        self.role = role
+        self.per_page = per_page
+        self.descending = descending
+        self.entries = None
+        if index_entries is not None and sort == 'joined':
+            start = 0
+            end = len(index_entries)
+            if joined_before or joined_after:
+                # Members without a join date have an infinite timestamp and are filtered out
+                end = bisect.bisect_left(index_entries, (float('inf'),))
+            if joined_after:
+                start = bisect.bisect_right(index_entries, (joined_after.timestamp(), float('inf')))
+            if joined_before:
+                end = min(end, bisect.bisect_left(index_entries, (joined_before.timestamp(),)))
+            self.entries = index_entries[start:max(start, end)]
+        else:
+            if sort == 'name':
+                self.key = lambda member: member.display_name.lower()
+            else:
+                never = datetime.datetime.max.replace(tzinfo=datetime.timezone.utc)
+                self.key = lambda member: member.joined_at or never
+            if joined_before or joined_after:
+                self.members = [member for member in role.members if member.joined_at
+                                and (joined_before is None or member.joined_at < joined_before)
+                                and (joined_after is None or member.joined_at > joined_after)]
+            else:
+                self.members = role.members
+        self.total = len(self.entries if self.entries is not None else self.members)
+        self.page_count = max(1, -(-self.total // per_page))
+        self.page = min(page, self.page_count - 1)
+
+    def page_members(self, page):
+        start = page * self.per_page
+        end = start + self.per_page
+        if self.entries is None:
+            select = heapq.nlargest if self.descending else heapq.nsmallest
+            return select(end, self.members, key=self.key)[start:end]
+        if self.descending:
+            entries = self.entries[max(0, self.total - end):self.total - start][::-1]
+        else:
+            entries = self.entries[start:end]
+        members = (self.role.guild.get_member(member_id) for _, member_id in entries)
+        return [member for member in members if member is not None]
+
+    def format_page(self, page):
+        page_members = self.page_members(page)
+        lines = []
+        for member in page_members:
+            join_date = member.joined_at.strftime('%Y-%m-%d %H:%M:%S') if member.joined_at else 'unknown'
+            lines.append(f"{member.mention} (Joined: {join_date})")
+        header = f"Members with the '{self.role.name}' role (page {page + 1}/{self.page_count}, {self.total} total):"
+        return (header + '\n' + '\n'.join(lines))[:2000]
+
+    # Send the first page, returns the message when there are more pages to navigate
+    async def send(self, ctx):
+        message = await ctx.send(self.format_page(self.page))
+        if self.page_count == 1:
+            return None
+        for emoji in (PREVIOUS_PAGE, NEXT_PAGE):
+            await message.add_reaction(emoji)
+        return message
+
+    # Follow the reactions on message for PAGE_NAVIGATION_TIMEOUT seconds after the last one
+    async def navigate(self, ctx, message):
+        def check(reaction, user):
+            return (user.id == ctx.author.id and reaction.message.id == message.id
+                    and str(reaction.emoji) in (PREVIOUS_PAGE, NEXT_PAGE))
+
+        while True:
+            try:
+                reaction, user = await ctx.bot.wait_for('reaction_add', timeout=PAGE_NAVIGATION_TIMEOUT, check=check)
+            except asyncio.TimeoutError:
+                break
+            step = -1 if str(reaction.emoji) == PREVIOUS_PAGE else 1
+            page = min(max(self.page + step, 0), self.page_count - 1)
+            if page != self.page:
+                self.page = page
+                await message.edit(content=self.format_page(page))
+            try:
+                await message.remove_reaction(reaction.emoji, user)
+            except discord.HTTPException:
+                pass
+
+        try:
+            await message.clear_reactions()
+        except discord.HTTPException:
+            pass
 
 
 class RoleCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.navigations = set()
         logging.info(f"{self.__class__.__name__} initialized")
 
+    async def cog_unload(self):
+        for task in list(self.navigations):
+            task.cancel()
+
     @commands.Cog.listener()
     async def on_command_error(self, ctx, error):
         logging.error(f"Error encountered in command '{ctx.command}': {error}")
         if isinstance(error, commands.CommandInvokeError):
             await ctx.send('Something went wrong while running the command.')
 
-    @commands.command(name='query_role', description='Lists members with a specific role.')
-    async def query_role(self, ctx, *, role_name):
+    @commands.command(name='query_role', description='Lists members with a specific role.',
+                      usage='<role name> [--page N] [--sort joined|name] [--desc] '
+                            '[--joined-before YYYY-MM-DD] [--joined-after YYYY-MM-DD]')
+    async def query_role(self, ctx, *, query):
         logging.info(f"'query_role' command invoked by {ctx.author.name}#{ctx.author.discriminator}")
         try:
             if ctx.guild:  # Check if the command is invoked in a guild and not in DMs
-                role = discord.utils.get(ctx.guild.roles, name=role_name)  # Find the role
+                try:
+                    role_name, options = parse_query_options(query)
+                except ValueError as e:
+                    await ctx.send(f"Invalid options: {str(e)}")
+                    return
+                role_index = self.bot.role_index
+                if role_index.is_indexed(ctx.guild.id):
+                    role = role_index.get_role(ctx.guild.id, role_name)
+                else:
+                    role = discord.utils.get(ctx.guild.roles, name=role_name)  # Find the role
                 if role:  # Check if the role exists
                     logging.info(f"Role '{role_name}' found in {ctx.guild.name}")
-                    members = [member.mention for member in role.members]  # List all members with the role
-                    if members:  # Check if there are members with the role
-                        # Modify the response to include join date
-                        response = []
-                        for member in role.members:
-                            join_date = member.joined_at.strftime('%Y-%m-%d %H:%M:%S')
-                            response.append(f"{member.mention} (Joined: {join_date})")
-
-                        logging.info(f"Members with '{role_name}' role in {ctx.guild.name}: {', '.join(members)}")
-                        await ctx.send(f"Members with the '{role_name}' role:\n" + '\n'.join(response))
+                    paginator = RoleMemberPaginator(role, index_entries=role_index.role_members(ctx.guild.id, role.id),
+                                                    **options)
+                    if paginator.total:  # Check if there are members with the role
+                        logging.info(f"{paginator.total} members with '{role_name}' role in {ctx.guild.name}")
+                        message = await paginator.send(ctx)
+                        if message is not None:
+                            task = asyncio.create_task(paginator.navigate(ctx, message))
+                            self.navigations.add(task)
+                            task.add_done_callback(self.navigations.discard)
                     else:
                         logging.warning(f"No members found with '{role_name}' role in {ctx.guild.name}")
                         await ctx.send(f"No members have the '{role_name}' role.")
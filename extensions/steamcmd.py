@@ -0,0 +1,326 @@
+from core import *
+
+# steamcmd prints e.g. " Update state (0x61) downloading, progress: 12.34 (123456789 / 1000000000)"
+PROGRESS_PATTERN = re.compile(r"Update state \(0x[0-9a-fA-F]+\) ([^,]+), progress: ([\d.]+) \((\d+) / (\d+)\)")
+SUCCESS_PATTERN = re.compile(r"Success! App '(\d+)'")
+ERROR_PATTERN = re.compile(r"(ERROR!|Error!) (.*)")
+PROGRESS_REPORT_INTERVAL = 10
+
+
+# Device of the filesystem a path is (or will be) created on, jobs on the same device share a disk limit
+def disk_key(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return path
+
+
+# One app_update run of steamcmd. Progress is parsed from the output stream while it runs.
+class SteamCMDJob:
+    def __init__(self, app_id, branch, install_dir, validate=False):
+        self.app_id = app_id
+        self.branch = branch
+        self.install_dir = install_dir
+        self.validate = validate
+        self.state = 'queued'
+        self.phase = None
+        self.percent = 0.0
+        self.bytes_done = 0
+        self.bytes_total = 0
+        self.throughput = 0.0
+        self.error = None
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.output = collections.deque(maxlen=50)
+        self.done = asyncio.get_running_loop().create_future()
+        self.last_progress = None
+
+    @property
+    def key(self):
+        return self.app_id, self.branch
+
+    def command(self, steamcmd_path):
+        command = [steamcmd_path, '+force_install_dir', self.install_dir, '+login', 'anonymous',
+                   '+app_update', str(self.app_id)]
+        if self.branch and self.branch != 'public':
+            command += ['-beta', self.branch]
+        if self.validate:
+            command.append('validate')
+        return command + ['+quit']
+
+    def parse_line(self, line):
+        self.output.append(line)
+        match = PROGRESS_PATTERN.search(line)
+        if match:
+            now = time.monotonic()
+            self.phase = match.group(1).strip()
+            self.percent = float(match.group(2))
+            bytes_done, self.bytes_total = int(match.group(3)), int(match.group(4))
+            if self.last_progress and now > self.last_progress[0] and bytes_done >= self.last_progress[1]:
+                rate = (bytes_done - self.last_progress[1]) / (now - self.last_progress[0])
+                # Smoothed so one slow or fast chunk doesn't swing the reported rate
+                self.throughput = rate if not self.throughput else 0.7 * self.throughput + 0.3 * rate
+            self.last_progress = (now, bytes_done)
+            self.bytes_done = bytes_done
+        elif SUCCESS_PATTERN.search(line):
+            self.percent = 100.0
+        else:
+            match = ERROR_PATTERN.search(line)
+            if match:
+                self.error = match.group(2).strip()
+
+    def describe(self):
+        label = f"AppID {self.app_id} ({self.branch})"
+        if self.state == 'queued':
+            return f"{label}: queued for {time.monotonic() - self.queued_at:.0f}s"
+        if self.state == 'running':
+            rate = f", {self.throughput / 1024 / 1024:.1f} MB/s" if self.throughput else ""
+            return (f"{label}: {self.phase or 'starting'} {self.percent:.1f}% "
+                    f"({self.bytes_done / 1024 / 1024:.0f}/{self.bytes_total / 1024 / 1024:.0f} MB{rate})")
+        duration = (self.finished_at or time.monotonic()) - (self.started_at or self.queued_at)
+        if self.state == 'done':
+            return f"{label}: updated in {duration:.0f}s"
+        return f"{label}: failed after {duration:.0f}s: {self.error}"
+
+
+# Runs steamcmd app_update jobs with at most max_jobs at once on the host and max_jobs_per_disk at once per disk.
+# A request for an AppID and branch that is already queued or running returns the existing job.
+class SteamCMDScheduler:
+    def __init__(self, steamcmd_path=STEAMCMD_PATH, max_jobs=STEAMCMD_MAX_JOBS,
+                 max_jobs_per_disk=STEAMCMD_MAX_JOBS_PER_DISK):
+        self.steamcmd_path = steamcmd_path
+        self.max_jobs_per_disk = max_jobs_per_disk
+        self.host_slots = asyncio.Semaphore(max_jobs)
+        self.disk_slots = {}
+        self.jobs = {}
+        self.history = collections.deque(maxlen=20)
+        self.tasks = set()
+        logging.debug(f"SteamCMDScheduler initialized with max_jobs: {max_jobs}, "
+                      f"max_jobs_per_disk: {max_jobs_per_disk}")
+
+    def submit(self, app_id, branch, install_dir, validate=False, on_start=None, on_finish=None):
+        job = self.jobs.get((app_id, branch))
+        if job is not None:
+            logging.info(f"steamcmd job for AppID {app_id} branch {branch} is already {job.state}")
+            return job, False
+        job = SteamCMDJob(app_id, branch, install_dir, validate)
+        self.jobs[job.key] = job
+        task = asyncio.create_task(self.run(job, on_start, on_finish))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        logging.info(f"Queued steamcmd job for AppID {app_id} branch {branch} into {install_dir}")
+        return job, True
+
+    def queue_depth(self):
+        return sum(1 for job in self.jobs.values() if job.state == 'queued')
+
+    async def run(self, job, on_start=None, on_finish=None):
+        disk = disk_key(job.install_dir)
+        if disk not in self.disk_slots:
+            self.disk_slots[disk] = asyncio.Semaphore(self.max_jobs_per_disk)
+        try:
+            # The disk slot is taken first so a job waiting for its disk never holds one of the host slots
+            async with self.disk_slots[disk], self.host_slots:
+                job.state = 'running'
+                job.started_at = time.monotonic()
+                if on_start:
+                    await on_start(job)
+                await self.execute(job)
+        except asyncio.CancelledError:
+            job.state = 'failed'
+            job.error = 'Cancelled'
+            raise
+        except Exception as e:
+            job.state = 'failed'
+            job.error = f"{type(e).__name__}: {str(e)}"
+            logging.error(f"An unexpected error occurred while running steamcmd for AppID {job.app_id}: {str(e)}. "
+                          f"Type: {type(e).__name__}")
+        finally:
+            job.finished_at = time.monotonic()
+            self.jobs.pop(job.key, None)
+            self.history.append(job)
+            if not job.done.done():
+                job.done.set_result(job.state == 'done')
+            logging.info(job.describe())
+            if on_finish:
+                try:
+                    await on_finish(job)
+                except Exception as e:
+                    logging.error(f"An unexpected error occurred after the steamcmd job for AppID {job.app_id}: "
+                                  f"{str(e)}. Type: {type(e).__name__}")
+
+    async def execute(self, job):
+        os.makedirs(job.install_dir, exist_ok=True)
+        process = await asyncio.create_subprocess_exec(
+            *job.command(self.steamcmd_path), stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        try:
+            # steamcmd redraws progress with carriage returns, so lines are split on both \r and \n
+            pending = ''
+            while True:
+                chunk = await process.stdout.read(4096)
+                if not chunk:
+                    break
+                lines = re.split(r'[\r\n]', pending + chunk.decode('utf-8', errors='replace'))
+                pending = lines.pop()
+                for line in lines:
+                    if line.strip():
+                        job.parse_line(line.strip())
+            if pending.strip():
+                job.parse_line(pending.strip())
+            return_code = await process.wait()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+
+        if return_code == 0 and job.percent >= 100.0 and not job.error:
+            job.state = 'done'
+        else:
+            job.state = 'failed'
+            job.error = job.error or f"steamcmd exited with code {return_code}"
+
+
+# Installs and updates the AppIDs tracked in server_info.json through steamcmd. Entries can set
+# "install_dir" (default STEAMCMD_INSTALL_DIRECTORY/<AppID>), "install_branch" (default public) and "auto_update".
+# "branch" belongs to the Steam data the AppID poller writes, so the installed branch has a key of its own. With
+# auto_update the build ID changes dispatched by the AppID poller queue an update of the installed branch.
+class SteamCMDCog(commands.Cog):
+    def __init__(self, discord_bot):
+        self.bot = discord_bot
+        # Kept on the bot like the supervisor's servers, so running downloads survive a reload of the extension
+        if not hasattr(discord_bot, 'steamcmd_scheduler'):
+            discord_bot.steamcmd_scheduler = SteamCMDScheduler()
+        self.scheduler = discord_bot.steamcmd_scheduler
+        self.reports = set()
+        logging.info(f"{self.__class__.__name__} initialized")
+
+    async def cog_unload(self):
+        for task in list(self.reports):
+            task.cancel()
+
+    def install_dir(self, app_id, app_data):
+        return app_data.get('install_dir') or os.path.join(STEAMCMD_INSTALL_DIRECTORY, str(app_id))
+
+    # Queue an update, a running managed server of the app is stopped for the update and started again after it
+    def queue_update(self, app_id, branch=None, validate=False):
+        app_data = self.bot.server_store.get(COMPUTER_NAME, app_id, {})
+        branch = branch or app_data.get('install_branch', 'public')
+        servers = getattr(self.bot, 'managed_servers', {})
+        server = servers.get(app_id)
+        was_running = server is not None and server.running
+
+        # The lease keeps other bot instances on this host from updating the same install at the same time
+        lease = f'steamcmd:{COMPUTER_NAME}:{app_id}'
+
+        async def on_start(job):
+            if lease not in await self.bot.fleet.acquire_leases([lease], ttl=STEAMCMD_LEASE_TTL):
+                raise RuntimeError(f"AppID {app_id} is being updated by another instance")
+            if was_running:
+                await server.stop()
+
+        async def on_finish(job):
+            await self.bot.fleet.release_leases([lease])
+            if job.state == 'done':
+                build_id = self.bot.server_store.build_id(COMPUTER_NAME, app_id, branch)
+                self.bot.server_store.update(COMPUTER_NAME, app_id, {"installed_branch": branch,
+                                                                     "installed_build_id": build_id})
+            if was_running:
+                server.start()
+
+        return self.scheduler.submit(app_id, branch, self.install_dir(app_id, app_data), validate,
+                                     on_start=on_start, on_finish=on_finish)
+
+    # AppIDs whose installed build differs from the build ID Steam reports for their branch
+    def outdated_app_ids(self):
+        outdated = []
+        for app_id, app, settings in self.bot.server_store.records(COMPUTER_NAME):
+            if app is None:
+                continue
+            branch = settings.get('install_branch', 'public')
+            build_id = app.branch_build_id(branch)
+            if build_id and (settings.get('installed_build_id') != build_id
+                             or settings.get('installed_branch', branch) != branch):
+                outdated.append(app_id)
+        return outdated
+
+    @commands.Cog.listener()
+    async def on_steam_build_update(self, app_id, branch, old_build_id, new_build_id):
+        app_data = self.bot.server_store.get(COMPUTER_NAME, app_id, {})
+        if not app_data.get('auto_update') or branch != app_data.get('install_branch', 'public'):
+            return
+        job, created = self.queue_update(app_id, branch)
+        if created:
+            channel = self.bot.get_channel(STEAMCMD_REPORT_CHANNEL_ID) if STEAMCMD_REPORT_CHANNEL_ID else None
+            if channel:
+                await channel.send(f"Build {new_build_id} of AppID {app_id} ({branch}) is out, updating.")
+                await self.report_progress(channel, [job])
+
+    @staticmethod
+    def describe_jobs(jobs):
+        return '\n'.join(job.describe() for job in jobs)[:2000]
+
+    # Send one status message for the jobs and keep it up to date in the background until all of them finished,
+    # so the command that queued them does not wait for the downloads
+    async def report_progress(self, destination, jobs):
+        message = await destination.send(self.describe_jobs(jobs))
+        task = asyncio.create_task(self.follow_progress(message, jobs))
+        self.reports.add(task)
+        task.add_done_callback(self.reports.discard)
+
+    async def follow_progress(self, message, jobs):
+        pending = {job.done for job in jobs}
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=PROGRESS_REPORT_INTERVAL)
+            try:
+                await message.edit(content=self.describe_jobs(jobs))
+            except discord.HTTPException as e:
+                logging.warning(f"Could not update steamcmd progress message: {e}")
+
+    @commands.group(name='steamcmd', invoke_without_command=True, description='Installs and updates servers.')
+    @commands.check(is_admin)
+    async def steamcmd(self, ctx):
+        await ctx.send("Usage: *steamcmd update <AppID|all> [branch] [validate] | *steamcmd jobs")
+
+    @steamcmd.command(name='update', description='Queues a steamcmd app_update for an AppID or all outdated ones.')
+    @commands.check(is_admin)
+    async def update(self, ctx, app_id, branch=None, validate=None):
+        logging.info(f"'steamcmd update' command invoked by {ctx.author.name}#{ctx.author.discriminator}")
+        await self.bot.server_store.ensure_loaded()
+        if app_id == 'all':
+            app_ids = self.outdated_app_ids()
+            if not app_ids:
+                await ctx.send("All tracked AppIDs are up to date.")
+                return
+        elif app_id in self.bot.server_store.app_ids(COMPUTER_NAME):
+            app_ids = [app_id]
+        else:
+            await ctx.send(f"AppID {app_id} is not tracked in {SERVER_INFO_FILE}.")
+            return
+
+        jobs = [self.queue_update(target, branch, validate == 'validate')[0] for target in app_ids]
+        await self.report_progress(ctx, jobs)
+
+    @steamcmd.command(name='jobs', description='Shows the queued, running and recent steamcmd jobs.')
+    @commands.check(is_admin)
+    async def jobs(self, ctx):
+        active = [job.describe() for job in self.scheduler.jobs.values()]
+        recent = [job.describe() for job in reversed(self.scheduler.history)][:5]
+        if not active and not recent:
+            await ctx.send("No steamcmd jobs.")
+            return
+        await ctx.send(("Active:\n" + '\n'.join(active or ['none']) + "\nRecent:\n" +
+                        '\n'.join(recent or ['none']))[:2000])
+
+
+async def setup(bot):
+    cog = SteamCMDCog(bot)
+    await bot.add_cog(cog)
+    logging.info(f"{cog.__class__.__name__} added to bot")
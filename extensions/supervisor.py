@@ -0,0 +1,271 @@
+from core import *
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# CPU time in seconds and resident memory in bytes of a process, or None when they can't be read.
+# Uses psutil when it is installed and /proc otherwise, which leaves Windows hosts without psutil unsampled.
+def read_process_usage(pid):
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            cpu_times = process.cpu_times()
+            return cpu_times.user + cpu_times.system, process.memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            # The fields after the parenthesized command name start at field 3 (state)
+            fields = f.read().rsplit(')', 1)[1].split()
+        clock_ticks = os.sysconf('SC_CLK_TCK')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        return (int(fields[11]) + int(fields[12])) / clock_ticks, int(fields[21]) * page_size
+    except (OSError, IndexError, ValueError, AttributeError):
+        return None
+
+
+# A dedicated server process started from the launch settings of an AppID in server_info.json. Output is kept in
+# bounded ring buffers, crashes are restarted with exponential backoff that resets once the server ran for
+# SUPERVISOR_STABLE_UPTIME seconds.
+class ManagedServer:
+    def __init__(self, app_id, name, command, cwd=None, env=None, log_lines=SUPERVISOR_LOG_LINES):
+        self.app_id = app_id
+        self.name = name
+        self.command = command
+        self.cwd = cwd
+        self.env = env
+        self.stdout = collections.deque(maxlen=log_lines)
+        self.stderr = collections.deque(maxlen=log_lines)
+        self.process = None
+        self.task = None
+        self.stopping = False
+        self.started_at = None
+        self.restarts = 0
+        self.last_exit_code = None
+        self.cpu_percent = None
+        self.rss = None
+        self.last_sample = None
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.returncode is None
+
+    def uptime(self):
+        return time.monotonic() - self.started_at if self.running and self.started_at else 0
+
+    def start(self):
+        if self.task is not None and not self.task.done():
+            return False
+        self.stopping = False
+        self.task = asyncio.create_task(self.supervise())
+        return True
+
+    async def supervise(self):
+        backoff = SUPERVISOR_RESTART_BACKOFF
+        while not self.stopping:
+            env = dict(os.environ, **self.env) if self.env else None
+            try:
+                self.process = await asyncio.create_subprocess_exec(
+                    *self.command, cwd=self.cwd, env=env, stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            except OSError as e:
+                logging.error(f"Failed to start server for AppID {self.app_id}: {str(e)}. Type: {type(e).__name__}")
+            else:
+                self.started_at = time.monotonic()
+                self.last_sample = None
+                logging.info(f"Started server for AppID {self.app_id} with PID {self.process.pid}")
+                await asyncio.gather(self.pump(self.process.stdout, self.stdout),
+                                     self.pump(self.process.stderr, self.stderr))
+                self.last_exit_code = await self.process.wait()
+                uptime = time.monotonic() - self.started_at
+                if self.stopping:
+                    break
+                if uptime >= SUPERVISOR_STABLE_UPTIME:
+                    backoff = SUPERVISOR_RESTART_BACKOFF
+                logging.warning(f"Server for AppID {self.app_id} exited with code {self.last_exit_code} after "
+                                f"{uptime:.0f}s, restarting in {backoff:.0f}s")
+
+            self.restarts += 1
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, SUPERVISOR_MAX_RESTART_BACKOFF)
+        logging.info(f"Stopped supervising server for AppID {self.app_id}")
+
+    @staticmethod
+    async def pump(stream, buffer):
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # The line is longer than the stream limit, keep the next chunk of it instead
+                line = await stream.read(65536)
+            if not line:
+                return
+            buffer.append(line.decode('utf-8', errors='replace').rstrip())
+
+    async def stop(self, timeout=SUPERVISOR_STOP_TIMEOUT):
+        self.stopping = True
+        if self.running:
+            logging.info(f"Stopping server for AppID {self.app_id} with PID {self.process.pid}")
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Server for AppID {self.app_id} did not stop within {timeout}s, killing it")
+                self.process.kill()
+                await self.process.wait()
+        if self.task is not None and not self.task.done():
+            # Interrupts a pending restart backoff
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.task = None
+
+    # Runs on a worker thread, CPU usage is the CPU time used since the previous sample
+    def sample(self):
+        if not self.running:
+            self.cpu_percent = None
+            self.rss = None
+            return
+        usage = read_process_usage(self.process.pid)
+        now = time.monotonic()
+        if usage is None:
+            return
+        cpu_time, self.rss = usage
+        if self.last_sample is not None and now > self.last_sample[0]:
+            self.cpu_percent = (cpu_time - self.last_sample[1]) / (now - self.last_sample[0]) * 100
+        self.last_sample = (now, cpu_time)
+
+    def describe(self):
+        if not self.running:
+            exit_code = f", last exit code {self.last_exit_code}" if self.last_exit_code is not None else ""
+            return f"{self.app_id} {self.name}: stopped, {self.restarts} restarts{exit_code}"
+        cpu = f"{self.cpu_percent:.1f}%" if self.cpu_percent is not None else "n/a"
+        rss = f"{self.rss / 1024 / 1024:.0f} MB" if self.rss is not None else "n/a"
+        uptime = datetime.timedelta(seconds=int(self.uptime()))
+        return (f"{self.app_id} {self.name}: running, PID {self.process.pid}, uptime {uptime}, CPU {cpu}, "
+                f"RSS {rss}, {self.restarts} restarts")
+
+
+# Starts, stops and watches the dedicated servers configured in server_info.json. An AppID is managed when its
+# entry has launch settings:
+#   "server": {"command": ["path/to/server", "-arg"], "cwd": "optional", "env": {}, "autostart": false}
+# The managed servers are kept on the bot, so reloading this extension does not stop or orphan them.
+class SupervisorCog(commands.Cog):
+    def __init__(self, discord_bot):
+        self.bot = discord_bot
+        if not hasattr(discord_bot, 'managed_servers'):
+            discord_bot.managed_servers = {}
+        self.servers = discord_bot.managed_servers
+        logging.info(f"{self.__class__.__name__} initialized")
+
+    async def cog_load(self):
+        self.sample_servers.start()
+
+    async def cog_unload(self):
+        self.sample_servers.cancel()
+
+    @tasks.loop(seconds=SUPERVISOR_SAMPLE_INTERVAL)
+    async def sample_servers(self):
+        servers = [server for server in self.servers.values() if server.running]
+        if servers:
+            await asyncio.to_thread(lambda: [server.sample() for server in servers])
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # After a handoff the predecessor stopped its servers first, the ones it ran are started again here
+        await self.bot.wait_for_handoff()
+        await self.bot.server_store.ensure_loaded()
+        inherited = set(self.bot.inherited_servers)
+        self.bot.inherited_servers = []
+        for app_id, _, settings in self.bot.server_store.records(COMPUTER_NAME):
+            if settings.get('server', {}).get('autostart') or app_id in inherited:
+                server = self.get_server(app_id)
+                if server and server.start():
+                    logging.info(f"Autostarted server for AppID {app_id}")
+
+    # The ManagedServer of an AppID, created from its launch settings on first use
+    def get_server(self, app_id):
+        app_data = self.bot.server_store.get(COMPUTER_NAME, app_id)
+        settings = app_data.get('server') if app_data else None
+        if not settings or not settings.get('command'):
+            return None
+        server = self.servers.get(app_id)
+        if server is None or (not server.running and server.command != settings['command']):
+            server = ManagedServer(app_id, app_data.get('name', app_id), settings['command'], settings.get('cwd'),
+                                   settings.get('env'))
+            self.servers[app_id] = server
+        return server
+
+    @commands.group(name='server', invoke_without_command=True, description='Manages dedicated game servers.')
+    @commands.check(is_admin)
+    async def server(self, ctx):
+        await ctx.send("Usage: *server start|stop|restart|status|logs <AppID>")
+
+    @server.command(name='start', description='Starts the dedicated server of an AppID.')
+    @commands.check(is_admin)
+    async def start(self, ctx, app_id):
+        logging.info(f"'server start' command invoked by {ctx.author.name}#{ctx.author.discriminator}")
+        server = self.get_server(app_id)
+        if server is None:
+            await ctx.send(f"AppID {app_id} has no server launch settings in {SERVER_INFO_FILE}.")
+        elif server.start():
+            await ctx.send(f"Starting server for AppID {app_id}.")
+        else:
+            await ctx.send(f"Server for AppID {app_id} is already running.")
+
+    @server.command(name='stop', description='Stops the dedicated server of an AppID.')
+    @commands.check(is_admin)
+    async def stop(self, ctx, app_id):
+        logging.info(f"'server stop' command invoked by {ctx.author.name}#{ctx.author.discriminator}")
+        server = self.servers.get(app_id)
+        if server is None or server.task is None:
+            await ctx.send(f"Server for AppID {app_id} is not running.")
+            return
+        await server.stop()
+        await ctx.send(f"Stopped server for AppID {app_id}.")
+
+    @server.command(name='restart', description='Restarts the dedicated server of an AppID.')
+    @commands.check(is_admin)
+    async def restart(self, ctx, app_id):
+        logging.info(f"'server restart' command invoked by {ctx.author.name}#{ctx.author.discriminator}")
+        server = self.servers.get(app_id)
+        if server is not None:
+            await server.stop()
+        server = self.get_server(app_id)
+        if server is None:
+            await ctx.send(f"AppID {app_id} has no server launch settings in {SERVER_INFO_FILE}.")
+            return
+        server.start()
+        await ctx.send(f"Restarting server for AppID {app_id}.")
+
+    @server.command(name='status', description='Shows the state and resource use of the managed servers.')
+    @commands.check(is_admin)
+    async def status(self, ctx):
+        if not self.servers:
+            await ctx.send("No servers are managed on this host.")
+            return
+        lines = [server.describe() for server in self.servers.values()]
+        await ctx.send(f"Servers on {COMPUTER_NAME}:\n" + '\n'.join(lines)[:1900])
+
+    @server.command(name='logs', description='Shows the latest output lines of a server.')
+    @commands.check(is_admin)
+    async def logs(self, ctx, app_id, lines: int = 20, stream='stdout'):
+        server = self.servers.get(app_id)
+        if server is None:
+            await ctx.send(f"Server for AppID {app_id} is not managed.")
+            return
+        buffer = server.stderr if stream == 'stderr' else server.stdout
+        output = '\n'.join(list(buffer)[-max(1, lines):])
+        # Keep the newest output when it doesn't fit in one message
+        await ctx.send(f"```\n{output[-1900:] or 'No output yet.'}\n```")
+
+
+async def setup(bot):
+    cog = SupervisorCog(bot)
+    await bot.add_cog(cog)
+    logging.info(f"{cog.__class__.__name__} added to bot")
@@ -1,4 +1,4 @@
-from bot import *
+from core import *
 
 class UtilityCog(commands.Cog):
     def __init__(self, bot):
@@ -24,7 +24,7 @@ class UtilityCog(commands.Cog):
     async def info(self, ctx):
         logging.info(f"'info' command invoked by {ctx.author.name}#{ctx.author.discriminator}")
         try:
-            commit, branch = get_git_info(BOT_DIRECTORY)
+            commit, branch = await self.bot.git_service.get_git_info(BOT_DIRECTORY)
             if ctx.guild:
                 embed = discord.Embed(title=f"{ctx.guild.name}", description="Utility Information",
                                       timestamp=ctx.message.created_at, color=discord.Color.brand_green())
@@ -32,9 +32,12 @@ class UtilityCog(commands.Cog):
                 embed.add_field(name="Github Branch", value=branch, inline=False)
                 embed.add_field(name="Discord.py Version", value=discord.__version__)
                 embed.add_field(name="Python Version", value=platform.python_version(), inline=False)
-                embed.add_field(name="Members", value=len(ctx.guild.members))
+                embed.add_field(name="Members", value=ctx.guild.member_count)
                 embed.add_field(name="Text Channels", value=len(ctx.guild.text_channels))
                 embed.add_field(name="Voice Channels", value=len(ctx.guild.voice_channels))
+                cache_stats = self.bot.git_service.cache_stats()
+                embed.set_footer(text=f"Git info cache: {cache_stats['hits']} hits, "
+                                      f"{cache_stats['stale_hits']} stale hits, {cache_stats['misses']} misses")
 
                 if ctx.channel.permissions_for(ctx.guild.me).embed_links:
                     await ctx.send(embed=embed)
@@ -47,6 +50,29 @@ class UtilityCog(commands.Cog):
             logging.error(f"Error executing 'info' command: {e}")
             await ctx.send("An error occurred while fetching the bot info.")
 
+    @commands.command(name='stats', description='Shows latency percentiles of the instrumented bot paths.')
+    @commands.check(is_admin)
+    async def stats(self, ctx, *, name_filter=''):
+        logging.info(f"'stats' command invoked by {ctx.author.name}#{ctx.author.discriminator}")
+        rows = [row for row in self.bot.metrics.summary() if name_filter in row['name']]
+        if not rows:
+            await ctx.send("No measurements recorded yet.")
+            return
+
+        def ms(value):
+            return f"{value * 1000:.1f}" if value is not None else "n/a"
+
+        lines = [f"{'series':<48} {'count':>6} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}"]
+        for row in rows:
+            labels = ','.join(f"{label}={value}" for label, value in row['labels'].items())
+            series = f"{row['name'].removesuffix('_seconds')}{{{labels}}}" if labels else \
+                row['name'].removesuffix('_seconds')
+            lines.append(f"{series[:48]:<48} {row['count']:>6} {ms(row['p50']):>8} {ms(row['p99']):>8} "
+                         f"{ms(row['max']):>8}")
+        table = '\n'.join(lines)[:1850]
+        await ctx.send(f"```\n{table}\n```Event loop lag now: {ms(self.bot.loop_lag_monitor.last_lag)} ms, "
+                       f"commands queued now: {self.bot.command_limiter.queue_depth()}")
+
 
 async def setup(bot):
     cog = UtilityCog(bot)
@@ -0,0 +1,274 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    instance_id TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    last_seen REAL NOT NULL,
+    info TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS app_state (
+    host TEXT NOT NULL,
+    app_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (host, app_id)
+);
+CREATE TABLE IF NOT EXISTS steam_apps (
+    app_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    polled_at REAL NOT NULL,
+    polled_by TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+# Fleet state shared by every bot instance through one SQLite database, e.g. on a network share.
+# Each call opens its own connection, so the store can be used from any worker thread.
+class SQLiteFleetStore:
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        with self.connect() as connection:
+            connection.executescript(SCHEMA)
+
+    # Autocommit connection, a transaction left open by an error is rolled back when it is closed
+    @contextlib.contextmanager
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def heartbeat(self, instance_id, host, info):
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT INTO instances (instance_id, host, last_seen, info) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(instance_id) DO UPDATE SET host = excluded.host, last_seen = excluded.last_seen, "
+                "info = excluded.info", (instance_id, host, time.time(), json.dumps(info)))
+
+    def remove_instance(self, instance_id):
+        with self.connect() as connection:
+            connection.execute("DELETE FROM instances WHERE instance_id = ?", (instance_id,))
+            connection.execute("DELETE FROM leases WHERE owner = ?", (instance_id,))
+
+    # Remove the instances whose last heartbeat is older than cutoff, returns their ids
+    def prune_instances(self, cutoff):
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            rows = connection.execute("SELECT instance_id FROM instances WHERE last_seen < ?", (cutoff,)).fetchall()
+            connection.execute("DELETE FROM instances WHERE last_seen < ?", (cutoff,))
+            connection.execute("COMMIT")
+        return [row['instance_id'] for row in rows]
+
+    def publish_app_states(self, host, states):
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "INSERT INTO app_state (host, app_id, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(host, app_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                [(host, app_id, json.dumps(data), now) for app_id, data in states.items()])
+            connection.execute("COMMIT")
+
+    def publish_steam_data(self, instance_id, apps):
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "INSERT INTO steam_apps (app_id, data, polled_at, polled_by) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(app_id) DO UPDATE SET data = excluded.data, polled_at = excluded.polled_at, "
+                "polled_by = excluded.polled_by",
+                [(app_id, json.dumps(data), now, instance_id) for app_id, data in apps.items()])
+            connection.execute("COMMIT")
+
+    # The Steam data other instances polled for the given AppIDs after newer_than
+    def get_steam_data(self, app_ids, newer_than=0):
+        app_ids = list(app_ids)
+        if not app_ids:
+            return {}
+        with self.connect() as connection:
+            rows = connection.execute(
+                f"SELECT app_id, data FROM steam_apps WHERE polled_at > ? "
+                f"AND app_id IN ({', '.join('?' * len(app_ids))})", [newer_than] + app_ids).fetchall()
+        return {row['app_id']: json.loads(row['data']) for row in rows}
+
+    # Take or renew the named leases for owner, returns the names the owner holds afterwards
+    def acquire_leases(self, names, owner, ttl):
+        names = list(names)
+        if not names:
+            return set()
+        now = time.time()
+        with self.connect() as connection:
+            # BEGIN IMMEDIATE takes the write lock up front, so two instances can't both see a lease as free
+            connection.execute("BEGIN IMMEDIATE")
+            rows = connection.execute(
+                f"SELECT name, owner, expires_at FROM leases WHERE name IN ({', '.join('?' * len(names))})",
+                names).fetchall()
+            held_by_others = {row['name'] for row in rows if row['owner'] != owner and row['expires_at'] > now}
+            acquired = [name for name in names if name not in held_by_others]
+            connection.executemany(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at",
+                [(name, owner, now + ttl) for name in acquired])
+            connection.execute("COMMIT")
+        return set(acquired)
+
+    def release_leases(self, names, owner):
+        names = list(names)
+        with self.connect() as connection:
+            connection.executemany("DELETE FROM leases WHERE name = ? AND owner = ?", [(name, owner) for name in names])
+
+    def fleet_view(self):
+        with self.connect() as connection:
+            instances = [dict(row) for row in connection.execute(
+                "SELECT instance_id, host, last_seen, info FROM instances ORDER BY host, instance_id")]
+            apps = [dict(row) for row in connection.execute(
+                "SELECT host, app_id, data, updated_at FROM app_state ORDER BY host, app_id")]
+            leases = [dict(row) for row in connection.execute(
+                "SELECT name, owner, expires_at FROM leases WHERE expires_at > ? ORDER BY name", (time.time(),))]
+        for instance in instances:
+            instance['info'] = json.loads(instance['info'])
+        for app in apps:
+            app['data'] = json.loads(app['data'])
+        return {"instances": instances, "apps": apps, "leases": leases}
+
+
+# In-process stand-in with the same interface, for single-instance setups and local testing
+class MemoryFleetStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.instances = {}
+        self.app_state = {}
+        self.steam_apps = {}
+        self.leases = {}
+
+    def heartbeat(self, instance_id, host, info):
+        with self.lock:
+            self.instances[instance_id] = {"instance_id": instance_id, "host": host, "last_seen": time.time(),
+                                           "info": json.loads(json.dumps(info))}
+
+    def remove_instance(self, instance_id):
+        with self.lock:
+            self.instances.pop(instance_id, None)
+            self.leases = {name: lease for name, lease in self.leases.items() if lease[0] != instance_id}
+
+    def prune_instances(self, cutoff):
+        with self.lock:
+            pruned = [instance_id for instance_id, instance in self.instances.items() if instance['last_seen'] < cutoff]
+            for instance_id in pruned:
+                del self.instances[instance_id]
+        return pruned
+
+    def publish_app_states(self, host, states):
+        now = time.time()
+        with self.lock:
+            for app_id, data in states.items():
+                self.app_state[(host, app_id)] = (json.loads(json.dumps(data)), now)
+
+    def publish_steam_data(self, instance_id, apps):
+        now = time.time()
+        with self.lock:
+            for app_id, data in apps.items():
+                self.steam_apps[app_id] = (json.loads(json.dumps(data)), now, instance_id)
+
+    def get_steam_data(self, app_ids, newer_than=0):
+        with self.lock:
+            return {app_id: json.loads(json.dumps(self.steam_apps[app_id][0])) for app_id in app_ids
+                    if app_id in self.steam_apps and self.steam_apps[app_id][1] > newer_than}
+
+    def acquire_leases(self, names, owner, ttl):
+        now = time.time()
+        acquired = set()
+        with self.lock:
+            for name in names:
+                lease = self.leases.get(name)
+                if lease is None or lease[0] == owner or lease[1] <= now:
+                    self.leases[name] = (owner, now + ttl)
+                    acquired.add(name)
+        return acquired
+
+    def release_leases(self, names, owner):
+        with self.lock:
+            for name in names:
+                if self.leases.get(name, (None,))[0] == owner:
+                    del self.leases[name]
+
+    def fleet_view(self):
+        now = time.time()
+        with self.lock:
+            return {
+                "instances": sorted((dict(instance) for instance in self.instances.values()),
+                                    key=lambda instance: (instance['host'], instance['instance_id'])),
+                "apps": [{"host": host, "app_id": app_id, "data": data, "updated_at": updated_at}
+                         for (host, app_id), (data, updated_at) in sorted(self.app_state.items())],
+                "leases": [{"name": name, "owner": owner, "expires_at": expires_at}
+                           for name, (owner, expires_at) in sorted(self.leases.items()) if expires_at > now],
+            }
+
+
+# 'memory' selects the in-process stand-in, anything else is the path of the shared SQLite database
+def open_fleet_store(location):
+    if not location or location == 'memory':
+        return MemoryFleetStore()
+    directory = os.path.dirname(os.path.abspath(location))
+    os.makedirs(directory, exist_ok=True)
+    return SQLiteFleetStore(location)
+
+
+# The async face of a fleet store for one bot instance, store calls run on worker threads
+class FleetCoordinator:
+    def __init__(self, store, instance_id, host, lease_ttl=600):
+        self.store = store
+        self.instance_id = instance_id
+        self.host = host
+        self.lease_ttl = lease_ttl
+        logging.debug(f"FleetCoordinator initialized for {instance_id} with {type(store).__name__}")
+
+    async def heartbeat(self, info):
+        await asyncio.to_thread(self.store.heartbeat, self.instance_id, self.host, info)
+
+    async def leave(self):
+        await asyncio.to_thread(self.store.remove_instance, self.instance_id)
+
+    # Forget instances that sent no heartbeat for max_age seconds, they went away without leaving
+    async def prune_instances(self, max_age):
+        pruned = await asyncio.to_thread(self.store.prune_instances, time.time() - max_age)
+        if pruned:
+            logging.info(f"Pruned {len(pruned)} fleet instances without a heartbeat for {max_age:.0f}s: "
+                         f"{', '.join(pruned)}")
+        return pruned
+
+    async def publish_app_states(self, states):
+        if states:
+            await asyncio.to_thread(self.store.publish_app_states, self.host, states)
+
+    async def publish_steam_data(self, apps):
+        if apps:
+            await asyncio.to_thread(self.store.publish_steam_data, self.instance_id, apps)
+
+    async def get_steam_data(self, app_ids, newer_than=0):
+        return await asyncio.to_thread(self.store.get_steam_data, app_ids, newer_than)
+
+    async def acquire_leases(self, names, ttl=None):
+        return await asyncio.to_thread(self.store.acquire_leases, names, self.instance_id, ttl or self.lease_ttl)
+
+    async def release_leases(self, names):
+        await asyncio.to_thread(self.store.release_leases, names, self.instance_id)
+
+    async def fleet_view(self):
+        return await asyncio.to_thread(self.store.fleet_view)
@@ -0,0 +1,296 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+import signal
+import subprocess
+import tempfile
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Set on the successor process, they tell it where its predecessor waits and how to prove it was started by it
+ENV_ADDRESS = 'HANDOFF_ADDRESS'
+ENV_TOKEN = 'HANDOFF_TOKEN'
+
+# Messages, one JSON object per line:
+#   successor -> predecessor  {"type": "ready", "token", "pid"}      connected and every extension loaded
+#                             {"type": "failed", "token", "error"}   could not get ready
+#   predecessor -> successor  {"type": "go", "last_message_id"}      stopped taking commands, take over the
+#                                                                    messages after the last one it took
+#                             {"type": "done", ...}                  drained and flushed, about to exit
+READY = 'ready'
+FAILED = 'failed'
+GO = 'go'
+DONE = 'done'
+
+
+class HandoffError(Exception):
+    pass
+
+
+async def send(writer, message):
+    writer.write(json.dumps(message).encode('utf-8') + b'\n')
+    await writer.drain()
+
+
+async def receive(reader, timeout=None):
+    line = await asyncio.wait_for(reader.readline(), timeout)
+    if not line:
+        raise HandoffError("Connection closed")
+    return json.loads(line)
+
+
+# Unix sockets where available, a localhost TCP port otherwise. Addresses are "unix:<path>" or "tcp:<host>:<port>".
+async def start_server(handler):
+    if hasattr(asyncio, 'start_unix_server') and os.name != 'nt':
+        path = os.path.join(tempfile.mkdtemp(prefix='handoff-'), 'handoff.sock')
+        server = await asyncio.start_unix_server(handler, path)
+        os.chmod(path, 0o600)
+        return server, f'unix:{path}'
+    server = await asyncio.start_server(handler, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    return server, f'tcp:127.0.0.1:{port}'
+
+
+async def open_connection(address):
+    kind, _, location = address.partition(':')
+    if kind == 'unix':
+        return await asyncio.open_unix_connection(location)
+    host, _, port = location.rpartition(':')
+    return await asyncio.open_connection(host, int(port))
+
+
+def remove_address(address):
+    kind, _, location = address.partition(':')
+    if kind == 'unix':
+        try:
+            os.remove(location)
+            os.rmdir(os.path.dirname(location))
+        except OSError:
+            pass
+
+
+# The running (old) process. It starts the successor, waits until the successor reports ready, tells it to go
+# and finally reports done once it drained. If the successor exits, fails or times out first it is killed and
+# the old process simply keeps running.
+class Predecessor:
+    def __init__(self, command, cwd, ready_timeout=120, env=None):
+        self.command = command
+        self.cwd = cwd
+        self.ready_timeout = ready_timeout
+        self.env = env
+        self.token = secrets.token_hex(16)
+        self.server = None
+        self.address = None
+        self.process = None
+        self.writer = None
+        self.messages = asyncio.Queue()
+
+    async def handle(self, reader, writer):
+        try:
+            message = await receive(reader, self.ready_timeout)
+        except (HandoffError, asyncio.TimeoutError, ValueError):
+            writer.close()
+            return
+        if message.get('token') != self.token or self.writer is not None:
+            logging.warning("Rejected a handoff connection with an unknown token")
+            writer.close()
+            return
+        self.writer = writer
+        await self.messages.put(message)
+
+    # Start the successor and wait for its ready message, returns its pid
+    async def launch(self):
+        self.server, self.address = await start_server(self.handle)
+        env = dict(self.env if self.env is not None else os.environ)
+        env[ENV_ADDRESS] = self.address
+        env[ENV_TOKEN] = self.token
+        # A new session so the successor outlives this process and does not get its signals
+        options = {'start_new_session': True} if os.name != 'nt' else \
+            {'creationflags': 0x00000200 | 0x00000008}  # CREATE_NEW_PROCESS_GROUP | DETACHED_PROCESS
+        # A plain Popen, asyncio kills the children of its subprocess transports when they are closed
+        self.process = subprocess.Popen(self.command, cwd=self.cwd, env=env, stdin=subprocess.DEVNULL, **options)
+        logging.info(f"Started successor process {self.process.pid}, waiting for it to get ready")
+
+        message_task = asyncio.ensure_future(self.messages.get())
+        exit_task = asyncio.ensure_future(self.wait_exit())
+        try:
+            finished, _ = await asyncio.wait({message_task, exit_task}, timeout=self.ready_timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (message_task, exit_task):
+                task.cancel()
+        if message_task in finished:
+            message = message_task.result()
+            if message.get('type') == READY:
+                return message.get('pid', self.process.pid)
+            await self.abort()
+            raise HandoffError(f"Successor failed: {message.get('error', 'unknown error')}")
+        if exit_task in finished:
+            await self.abort()
+            raise HandoffError(f"Successor exited with code {self.process.returncode} before it was ready")
+        await self.abort()
+        raise HandoffError(f"Successor was not ready within {self.ready_timeout}s")
+
+    async def wait_exit(self, interval=0.2):
+        while self.process.poll() is None:
+            await asyncio.sleep(interval)
+        return self.process.returncode
+
+    async def go(self, **info):
+        await send(self.writer, dict(info, type=GO))
+
+    async def done(self, **info):
+        try:
+            await send(self.writer, dict(info, type=DONE))
+        except (ConnectionError, OSError) as e:
+            logging.warning(f"Could not tell the successor the handoff is done: {e}")
+        await self.close()
+
+    async def abort(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            await self.wait_exit()
+        await self.close()
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            remove_address(self.address)
+
+
+# The new process. It reports ready once it is connected, then waits for go before it takes commands and for
+# done before it touches state the old process may still write.
+class Successor:
+    def __init__(self, address, token):
+        self.address = address
+        self.token = token
+        self.reader = None
+        self.writer = None
+
+    @classmethod
+    def from_environment(cls):
+        address = os.environ.pop(ENV_ADDRESS, None)
+        token = os.environ.pop(ENV_TOKEN, None)
+        return cls(address, token) if address and token else None
+
+    # Returns the go message
+    async def signal_ready(self, timeout=60):
+        self.reader, self.writer = await open_connection(self.address)
+        await send(self.writer, {"type": READY, "token": self.token, "pid": os.getpid()})
+        message = await receive(self.reader, timeout)
+        if message.get('type') != GO:
+            raise HandoffError(f"Expected go, got {message.get('type')}")
+        return message
+
+    async def signal_failed(self, error):
+        try:
+            self.reader, self.writer = await open_connection(self.address)
+            await send(self.writer, {"type": FAILED, "token": self.token, "error": error})
+        except (OSError, ConnectionError) as e:
+            logging.error(f"Could not report the failed handoff: {e}")
+
+    # The done message, or an empty one when the old process went away without sending it
+    async def wait_done(self, timeout=None):
+        try:
+            message = await receive(self.reader, timeout)
+        except (HandoffError, ConnectionError, asyncio.TimeoutError, ValueError) as e:
+            logging.warning(f"Predecessor went away without finishing the handoff: {e}")
+            message = {}
+        finally:
+            self.writer.close()
+        return message
+
+
+# The pid of the bot process that currently takes commands, kept in a file next to the bot. The predecessor writes
+# the successor's pid before it lets it go, so the file always names a running bot during a handoff.
+def write_active_pid(path, pid):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(str(pid))
+    os.replace(temp_path, path)
+
+
+def read_active_pid(path):
+    try:
+        with open(path, 'r') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+# Whether a process that is not necessarily our child still runs. os.kill(pid, 0) would terminate it on Windows.
+def pid_alive(pid):
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+        except psutil.Error:
+            return False
+    if os.name == 'nt':
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        try:
+            exit_code = ctypes.c_ulong()
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+            return exit_code.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def terminate_pid(pid):
+    try:
+        if psutil is not None:
+            psutil.Process(pid).terminate()
+        else:
+            os.kill(pid, signal.SIGTERM)
+    except Exception as e:
+        logging.warning(f"Could not stop process {pid}: {e}")
+
+
+# Runs in the process the service wrapper started once it handed off. It stays alive while the bot named in
+# pid_file runs, that is its successor or any later one, so the wrapper does not start a second bot and stopping
+# the service still stops the running one. Returns True when this process was asked to stop (and stopped the
+# running bot), False once the running bot exited on its own.
+async def keep_alive(pid_file, interval=1.0):
+    stop = asyncio.Event()
+    if os.name != 'nt':
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+    pid = None
+    try:
+        while not stop.is_set():
+            pid = read_active_pid(pid_file)
+            if pid is None or pid == os.getpid() or not pid_alive(pid):
+                logging.warning(f"The running bot process {pid} exited")
+                return False
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+    except asyncio.CancelledError:
+        # Ctrl+C on Windows cancels the main task
+        if pid is not None:
+            terminate_pid(pid)
+        raise
+    logging.info(f"Stopping the running bot process {pid}")
+    terminate_pid(pid)
+    return True
@@ -0,0 +1,65 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+LOG_FORMAT = '%(asctime)s:%(levelname)s:%(name)s: %(message)s'
+
+# The listener of the production mode, kept so configure_logging only runs once per process
+listener = None
+configured = False
+
+
+# Parse per-logger levels such as "discord=WARNING,discord.gateway=ERROR,steam=INFO"
+def parse_levels(spec):
+    levels = {}
+    for item in (spec or '').split(','):
+        if not item.strip():
+            continue
+        name, _, level = item.partition('=')
+        level = level.strip().upper()
+        if not name.strip() or not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f"Invalid logger level '{item.strip()}', expected name=LEVEL")
+        levels[name.strip()] = logging.getLevelName(level)
+    return levels
+
+
+# development: everything at DEBUG to stderr, formatted and written on the calling thread (the old behaviour).
+# production: the calling thread only merges the message with its arguments (QueueHandler.prepare) and puts the
+# record on a queue. A QueueListener thread applies LOG_FORMAT and writes to size-capped rotating files and stderr,
+# so no disk write ever happens on the event loop.
+def configure_logging(mode='development', level=None, levels='', log_file='bot.log', max_bytes=10 * 1024 * 1024,
+                      backup_count=5, console_level='WARNING'):
+    global listener, configured
+    if configured:
+        return
+    configured = True
+
+    root = logging.getLogger()
+    if mode != 'production':
+        logging.basicConfig(level=level or logging.DEBUG, format=LOG_FORMAT)
+    else:
+        directory = os.path.dirname(os.path.abspath(log_file))
+        os.makedirs(directory, exist_ok=True)
+        formatter = logging.Formatter(LOG_FORMAT)
+        file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count,
+                                                            encoding='utf-8')
+        file_handler.setFormatter(formatter)
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(formatter)
+        console_handler.setLevel(console_level)
+
+        log_queue = queue.SimpleQueue()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        root.setLevel(level or logging.INFO)
+        listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler,
+                                                  respect_handler_level=True)
+        listener.start()
+        # Drain the queue before the interpreter exits
+        atexit.register(listener.stop)
+
+    for name, logger_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(logger_level)
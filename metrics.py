@@ -0,0 +1,242 @@
+import asyncio
+import bisect
+import collections
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+# Upper bounds in seconds, from fast cache hits up to git clones and Steam timeouts
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Metric names are exported with this prefix
+PREFIX = 'dgm_'
+
+
+# Latency distribution of one labelled series: bucket counts for the Prometheus endpoint and the most recent
+# samples for exact percentiles in *stats
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS, recent=1024):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self.recent = collections.deque(maxlen=recent)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def percentile(self, q):
+        samples = sorted(self.recent)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q / 100 * len(samples)))]
+
+
+# Histograms keyed by metric name and label values. Observations can come from any thread, the git and
+# persistence helpers run on worker threads.
+class MetricsRegistry:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.gauges = {}
+        self.counters = {}
+        self.descriptions = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, description):
+        self.descriptions[name] = description
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    # Current value of a level such as a queue depth
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def gauge(self, name, **labels):
+        with self.lock:
+            return self.gauges.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def increment(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    # with registry.time('git_operation_duration_seconds', operation='fetch'): ...
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    # Decorator form of time() for plain functions and coroutine functions
+    def timed(self, name, **labels):
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.time(name, **labels):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # One dict per series with count, mean, p50, p99 and max, slowest p99 first
+    def summary(self):
+        rows = []
+        with self.lock:
+            for name, series in self.histograms.items():
+                for key, histogram in series.items():
+                    rows.append({
+                        "name": name,
+                        "labels": dict(key),
+                        "count": histogram.count,
+                        "mean": histogram.sum / histogram.count if histogram.count else 0.0,
+                        "p50": histogram.percentile(50),
+                        "p99": histogram.percentile(99),
+                        "max": histogram.max,
+                    })
+        rows.sort(key=lambda row: row['p99'] or 0, reverse=True)
+        return rows
+
+    # Prometheus text exposition format 0.0.4
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.histograms):
+                metric = PREFIX + name
+                if name in self.descriptions:
+                    lines.append(f"# HELP {metric} {self.descriptions[name]}")
+                lines.append(f"# TYPE {metric} histogram")
+                for key, histogram in sorted(self.histograms[name].items()):
+                    labels = [f'{label}="{escape_label(value)}"' for label, value in key]
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        bucket_labels = ','.join(labels + [f'le="{bound}"'])
+                        lines.append(f"{metric}_bucket{{{bucket_labels}}} {cumulative}")
+                    suffix = f"{{{','.join(labels)}}}" if labels else ''
+                    lines.append(f"{metric}_sum{suffix} {histogram.sum}")
+                    lines.append(f"{metric}_count{suffix} {histogram.count}")
+            for kind, values in (('gauge', self.gauges), ('counter', self.counters)):
+                for name in sorted(values):
+                    metric = PREFIX + name
+                    if name in self.descriptions:
+                        lines.append(f"# HELP {metric} {self.descriptions[name]}")
+                    lines.append(f"# TYPE {metric} {kind}")
+                    for key, value in sorted(values[name].items()):
+                        labels = ','.join(f'{label}="{escape_label(label_value)}"' for label, label_value in key)
+                        lines.append(f"{metric}{{{labels}}} {value}" if labels else f"{metric} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Measures how late the event loop wakes up from a sleep of interval seconds. Anything blocking the loop
+# (a synchronous git call, a large json.dumps) shows up as lag.
+class LoopLagMonitor:
+    def __init__(self, registry, interval=0.5):
+        self.registry = registry
+        self.interval = interval
+        self.last_lag = None
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start_time = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, loop.time() - start_time - self.interval)
+            self.registry.observe('event_loop_lag_seconds', self.last_lag)
+
+
+# Serves GET /metrics in the Prometheus text format. Binds to localhost by default, the endpoint has no
+# authentication.
+class MetricsServer:
+    def __init__(self, registry, host='127.0.0.1', port=9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+
+    @property
+    def started(self):
+        return self.server is not None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # Skip the headers, nothing in them changes the response
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.registry.render()
+            else:
+                status, body = '404 Not Found', 'Not found\n'
+            payload = body.encode('utf-8')
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode('latin-1') + payload)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+# Shared by the bot and every module that records metrics
+registry = MetricsRegistry()
+registry.describe('command_duration_seconds', 'Time to run a bot command.')
+registry.describe('git_operation_duration_seconds', 'Time of git operations including cache lookups.')
+registry.describe('steam_fetch_duration_seconds', 'Time to fetch product info from Steam.')
+registry.describe('extension_duration_seconds', 'Time to load, reload or unload an extension.')
+registry.describe('persistence_duration_seconds', 'Time to load, journal or compact server_info.json.')
+registry.describe('event_loop_lag_seconds', 'How late the event loop woke up from a timed sleep.')
+registry.describe('command_queue_wait_seconds', 'Time a command waited for a free slot of its command group.')
+registry.describe('command_queue_depth', 'Commands waiting for a free slot of their command group.')
+registry.describe('command_in_flight', 'Commands running per command group.')
+registry.describe('command_rejected_total', 'Commands rejected by a rate limit or a full command group.')
+registry.describe('command_coalesced_total', 'Commands answered by an identical command that was already running.')
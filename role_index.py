@@ -0,0 +1,152 @@
+import bisect
+import logging
+
+
+# Join time used to sort members, members without a known join date sort last
+def join_key(member):
+    return member.joined_at.timestamp() if member.joined_at else float('inf')
+
+
+# Index of one guild's roles: role name -> role and role id -> (join timestamp, member id) pairs sorted by join date
+class GuildRoleIndex:
+    def __init__(self, guild):
+        self.guild_id = guild.id
+        self.roles = {role.id: role for role in guild.roles}
+        self.roles_by_name = {}
+        self.role_members = {role.id: [] for role in guild.roles}
+        self.member_roles = {}
+        self.member_keys = {}
+        for member in guild.members:
+            key = (join_key(member), member.id)
+            self.member_keys[member.id] = key
+            self.member_roles[member.id] = {role.id for role in member.roles}
+            for role in member.roles:
+                self.role_members.setdefault(role.id, []).append(key)
+        for entries in self.role_members.values():
+            entries.sort()
+        self.index_names()
+
+    # Like discord.utils.get(guild.roles, name=...), the lowest role wins when names are duplicated
+    def index_names(self):
+        self.roles_by_name = {}
+        for role in sorted(self.roles.values(), key=lambda role: role.position):
+            self.roles_by_name.setdefault(role.name, role)
+
+    def add_member_role(self, member_id, role_id):
+        key = self.member_keys[member_id]
+        entries = self.role_members.setdefault(role_id, [])
+        position = bisect.bisect_left(entries, key)
+        if position == len(entries) or entries[position] != key:
+            entries.insert(position, key)
+        self.member_roles.setdefault(member_id, set()).add(role_id)
+
+    def remove_member_role(self, member_id, role_id):
+        key = self.member_keys.get(member_id)
+        entries = self.role_members.get(role_id)
+        if key is None or entries is None:
+            return
+        position = bisect.bisect_left(entries, key)
+        if position < len(entries) and entries[position] == key:
+            del entries[position]
+        self.member_roles.get(member_id, set()).discard(role_id)
+
+
+# Role lookups and role membership for every guild the bot is in. Built on ready and kept current from the
+# member and role events once register() added the listeners to the bot.
+class RoleIndex:
+    def __init__(self, discord_bot):
+        self.bot = discord_bot
+        self.guilds = {}
+
+    def register(self):
+        for listener in (self.on_ready, self.on_guild_join, self.on_guild_remove, self.on_member_join,
+                         self.on_member_remove, self.on_member_update, self.on_guild_role_create,
+                         self.on_guild_role_delete, self.on_guild_role_update):
+            self.bot.add_listener(listener)
+
+    def build(self, guild):
+        self.guilds[guild.id] = GuildRoleIndex(guild)
+        logging.info(f"Indexed {len(guild.roles)} roles and {len(guild.members)} members of {guild.name}")
+
+    def is_indexed(self, guild_id):
+        return guild_id in self.guilds
+
+    def get_role(self, guild_id, name):
+        index = self.guilds.get(guild_id)
+        return index.roles_by_name.get(name) if index else None
+
+    def member_has_role(self, guild_id, member_id, role_name):
+        index = self.guilds.get(guild_id)
+        role = index.roles_by_name.get(role_name) if index else None
+        return role is not None and role.id in index.member_roles.get(member_id, ())
+
+    # (join timestamp, member id) pairs of a role's members sorted by join date, the list must not be modified
+    def role_members(self, guild_id, role_id):
+        index = self.guilds.get(guild_id)
+        return index.role_members.get(role_id, []) if index else None
+
+    # Rebuilt on every ready so the index resyncs after reconnects
+    async def on_ready(self):
+        for guild in self.bot.guilds:
+            self.build(guild)
+
+    async def on_guild_join(self, guild):
+        self.build(guild)
+
+    async def on_guild_remove(self, guild):
+        self.guilds.pop(guild.id, None)
+
+    async def on_member_join(self, member):
+        index = self.guilds.get(member.guild.id)
+        if index is None:
+            return
+        index.member_keys[member.id] = (join_key(member), member.id)
+        for role in member.roles:
+            index.add_member_role(member.id, role.id)
+
+    async def on_member_remove(self, member):
+        index = self.guilds.get(member.guild.id)
+        if index is None:
+            return
+        for role_id in list(index.member_roles.get(member.id, ())):
+            index.remove_member_role(member.id, role_id)
+        index.member_roles.pop(member.id, None)
+        index.member_keys.pop(member.id, None)
+
+    async def on_member_update(self, before, after):
+        index = self.guilds.get(after.guild.id)
+        if index is None or before.roles == after.roles:
+            return
+        if after.id not in index.member_keys:
+            index.member_keys[after.id] = (join_key(after), after.id)
+        before_roles = {role.id for role in before.roles}
+        after_roles = {role.id for role in after.roles}
+        for role_id in after_roles - before_roles:
+            index.add_member_role(after.id, role_id)
+        for role_id in before_roles - after_roles:
+            index.remove_member_role(after.id, role_id)
+
+    async def on_guild_role_create(self, role):
+        index = self.guilds.get(role.guild.id)
+        if index is None:
+            return
+        index.roles[role.id] = role
+        index.role_members.setdefault(role.id, [])
+        index.index_names()
+
+    async def on_guild_role_delete(self, role):
+        index = self.guilds.get(role.guild.id)
+        if index is None:
+            return
+        for _, member_id in index.role_members.pop(role.id, []):
+            index.member_roles.get(member_id, set()).discard(role.id)
+        index.roles.pop(role.id, None)
+        index.index_names()
+
+    async def on_guild_role_update(self, before, after):
+        index = self.guilds.get(after.guild.id)
+        if index is None:
+            return
+        index.roles[after.id] = after
+        if before.name != after.name or before.position != after.position:
+            index.index_names()
@@ -0,0 +1,304 @@
+import asyncio
+import atexit
+import copy
+import json
+import logging
+import os
+import threading
+
+from app_model import split_section, join_section
+from metrics import registry as metrics
+
+
+# In-memory copy of server_info.json, keyed by machine name and then AppID.
+# Changed machine/AppID sections are appended to a journal next to the file (one JSON line each) instead of
+# rewriting the whole file. Bursts of changes are coalesced into one flush after flush_delay seconds, and once
+# the journal holds compact_threshold entries it is folded back into server_info.json with a temp-file-plus-rename.
+# Replaying the journal is idempotent, so a crash at any point leaves a file and journal that load consistently.
+# The parsed Steam data of a section is held as an app_model.App record in apps, data only keeps the other keys.
+class ServerInfoStore:
+    def __init__(self, filename, flush_delay=1.0, compact_threshold=200):
+        self.filename = filename
+        self.journal_filename = f"{filename}.journal"
+        self.flush_delay = flush_delay
+        self.compact_threshold = compact_threshold
+        self.data = {}
+        self.apps = {}
+        self.dirty = set()
+        self.journal_entries = 0
+        self.loaded = False
+        self.loop = None
+        self.flush_handle = None
+        self.load_lock = None
+        # Guards data and dirty, io_lock serializes writes to the file and journal
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
+        atexit.register(self.flush_sync)
+        logging.debug(f"ServerInfoStore initialized for {filename} with flush_delay: {flush_delay}, "
+                      f"compact_threshold: {compact_threshold}")
+
+    @metrics.timed('persistence_duration_seconds', operation='load')
+    def load(self):
+        logging.info(f"Reading server info from {self.filename}")
+        data = {}
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            logging.info(f"{self.filename} does not exist yet, starting empty")
+        except json.JSONDecodeError as e:
+            logging.error(f"JSONDecodeError: {str(e)}")
+            raise e
+
+        entries = 0
+        try:
+            with open(self.journal_filename, 'rb+') as f:
+                valid_length = 0
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except (json.JSONDecodeError, UnicodeDecodeError):
+                        # Only the last line can be partial, it was never acknowledged as flushed. Cut it off so
+                        # the next append starts on a fresh line.
+                        logging.warning(f"Discarding incomplete entry at the end of {self.journal_filename}")
+                        f.truncate(valid_length)
+                        break
+                    self.apply_entry(data, entry)
+                    valid_length += len(line)
+                    entries += 1
+                else:
+                    # A crash right before the trailing newline leaves a complete last entry without it, the next
+                    # append would continue on the same line
+                    if valid_length and not line.endswith(b'\n'):
+                        logging.warning(f"Terminating the last entry of {self.journal_filename}")
+                        f.seek(0, os.SEEK_END)
+                        f.write(b'\n')
+        except FileNotFoundError:
+            pass
+
+        apps = {}
+        for machine, sections in data.items():
+            for app_id, section in sections.items():
+                app, sections[app_id] = split_section(section)
+                if app is not None:
+                    apps[(machine, app_id)] = app
+
+        with self.lock:
+            self.data = data
+            self.apps = apps
+            self.dirty.clear()
+            self.journal_entries = entries
+            self.loaded = True
+        logging.info(f"Loaded server info for {len(data)} machines, replayed {entries} journal entries")
+
+    # Load on a worker thread the first time any caller needs the data
+    async def ensure_loaded(self):
+        if self.loaded:
+            return
+        if self.load_lock is None:
+            self.load_lock = asyncio.Lock()
+        async with self.load_lock:
+            if not self.loaded:
+                await asyncio.to_thread(self.load)
+
+    @staticmethod
+    def apply_entry(data, entry):
+        machine, app_id, section = entry['machine'], entry.get('app_id'), entry.get('data')
+        if app_id is None:
+            if section is None:
+                data.pop(machine, None)
+            else:
+                data[machine] = section
+        elif section is None:
+            data.get(machine, {}).pop(app_id, None)
+        else:
+            data.setdefault(machine, {})[app_id] = section
+
+    def machines(self):
+        with self.lock:
+            return list(self.data.keys())
+
+    def app_ids(self, machine):
+        with self.lock:
+            return list(self.data.get(machine, {}).keys())
+
+    # The persisted form of a section, callers must hold lock. Settings are only copied when copy_settings is set,
+    # the Steam data is always built into new containers.
+    def section(self, machine, app_id, copy_settings=True):
+        settings = self.data.get(machine, {}).get(app_id)
+        if settings is None:
+            return None
+        return join_section(self.apps.get((machine, app_id)), copy.deepcopy(settings) if copy_settings else settings)
+
+    def get(self, machine, app_id, default=None):
+        with self.lock:
+            section = self.section(machine, app_id)
+            return section if section is not None else default
+
+    def get_machine(self, machine):
+        with self.lock:
+            return {app_id: self.section(machine, app_id) for app_id in self.data.get(machine, {})}
+
+    # The Steam data record of an AppID, or None. Records are replaced and never modified, so it is not copied.
+    def app(self, machine, app_id):
+        with self.lock:
+            return self.apps.get((machine, app_id))
+
+    def build_id(self, machine, app_id, branch=None):
+        with self.lock:
+            app = self.apps.get((machine, app_id))
+            return app.branch_build_id(branch) if app is not None else None
+
+    # (AppID, Steam data record or None, shallow copy of the other settings) for every AppID of a machine
+    def records(self, machine):
+        with self.lock:
+            return [(app_id, self.apps.get((machine, app_id)), dict(settings))
+                    for app_id, settings in self.data.get(machine, {}).items()]
+
+    def ensure_machine(self, machine):
+        with self.lock:
+            if machine in self.data:
+                return
+            self.data[machine] = {}
+            self.dirty.add((machine, None))
+        self.schedule_flush()
+
+    # Replace the data of an AppID, nothing is written when it is unchanged
+    def set(self, machine, app_id, section):
+        app, settings = split_section(section)
+        with self.lock:
+            apps = self.data.setdefault(machine, {})
+            if app_id in apps and apps[app_id] == settings and self.apps.get((machine, app_id)) == app:
+                return False
+            apps[app_id] = copy.deepcopy(settings)
+            if app is None:
+                self.apps.pop((machine, app_id), None)
+            else:
+                self.apps[(machine, app_id)] = app
+            self.dirty.add((machine, app_id))
+        self.schedule_flush()
+        return True
+
+    # Merge fields into the data of an AppID, keeping the keys that are not given
+    def update(self, machine, app_id, fields):
+        with self.lock:
+            section = self.section(machine, app_id, copy_settings=False) or {}
+        section = dict(section)
+        section.update(fields)
+        return self.set(machine, app_id, section)
+
+    def delete(self, machine, app_id):
+        with self.lock:
+            if app_id not in self.data.get(machine, {}):
+                return False
+            del self.data[machine][app_id]
+            self.apps.pop((machine, app_id), None)
+            self.dirty.add((machine, app_id))
+        self.schedule_flush()
+        return True
+
+    # Callers must hold lock
+    def machine_sections(self, machine):
+        if machine not in self.data:
+            return None
+        return {app_id: self.section(machine, app_id, copy_settings=False) for app_id in self.data[machine]}
+
+    # Coalesce changes into a single flush, safe to call from any thread
+    def schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop is None:
+            if self.loop is not None and self.loop.is_running():
+                self.loop.call_soon_threadsafe(self.schedule_flush)
+            else:
+                self.flush_sync()
+            return
+
+        self.loop = loop
+        if self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.flush_delay, self.start_flush)
+
+    def start_flush(self):
+        self.flush_handle = None
+        task = asyncio.ensure_future(self.flush())
+        task.add_done_callback(self.flush_done)
+
+    @staticmethod
+    def flush_done(task):
+        if not task.cancelled() and task.exception():
+            logging.error(f"Flushing server info failed: {task.exception()}")
+
+    async def flush(self):
+        await asyncio.to_thread(self.flush_sync)
+
+    # Append the dirty sections to the journal and compact it when it grew too large
+    def flush_sync(self):
+        with self.io_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                lines = []
+                keys = set(self.dirty)
+                for machine, app_id in sorted(keys, key=lambda key: (key[0], key[1] or '')):
+                    if app_id is None:
+                        section = self.machine_sections(machine)
+                    else:
+                        section = self.section(machine, app_id, copy_settings=False)
+                    lines.append(json.dumps({"machine": machine, "app_id": app_id, "data": section}))
+                self.dirty.clear()
+
+            try:
+                with metrics.time('persistence_duration_seconds', operation='journal'), \
+                        open(self.journal_filename, 'a') as f:
+                    f.write('\n'.join(lines) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+            except Exception as e:
+                logging.error(f"An unexpected error occurred: {str(e)}. Type: {type(e).__name__}")
+                # Written again by the next flush (or the one at exit), replaying an entry twice is harmless
+                with self.lock:
+                    self.dirty.update(keys)
+                raise e
+            self.journal_entries += len(lines)
+            logging.info("Journaled %d changed sections to %s", len(lines), self.journal_filename)
+
+            if self.journal_entries >= self.compact_threshold:
+                self.compact_sync()
+
+    # Rewrite server_info.json from memory through a temp file and rename, then empty the journal.
+    # Callers must hold io_lock.
+    @metrics.timed('persistence_duration_seconds', operation='compact')
+    def compact_sync(self):
+        logging.info("Writing server info to %s", self.filename)
+        with self.lock:
+            content = json.dumps({machine: self.machine_sections(machine) for machine in self.data}, indent=4)
+        temp_filename = f"{self.filename}.tmp"
+        try:
+            with open(temp_filename, 'w') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_filename, self.filename)
+            # The journal is only emptied once the rename made its entries redundant
+            with open(self.journal_filename, 'w') as f:
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            logging.error(f"An unexpected error occurred: {str(e)}. Type: {type(e).__name__}")
+            raise e
+        self.journal_entries = 0
+
+    async def close(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        await self.flush()
+        await asyncio.to_thread(self.compact)
+
+    def compact(self):
+        with self.io_lock:
+            if self.loaded:
+                self.compact_sync()
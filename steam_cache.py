@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from metrics import registry as metrics
+
+
+# Persistent copy of the raw Steam product info per AppID with what is needed to tell whether it is still current:
+# - change_number: the PICS change number of the app when its info was downloaded
+# - access_token: the token product info requests need for the app
+# - verified_change: the global PICS change number the info was last known to be current at
+# - checked_at: wall-clock time of the last download or verification
+# The parsed form is cached next to the raw info, so only apps that changed are parsed again. Saved to filename
+# (temp file plus rename) only when downloaded info changed, a lost verification only costs a wider change query.
+class ProductInfoCache:
+    def __init__(self, filename, freshness=60):
+        self.filename = filename
+        self.freshness = freshness
+        self.apps = {}
+        self.loaded = False
+        self.dirty = False
+        self.lock = threading.Lock()
+        logging.debug(f"ProductInfoCache initialized for {filename} with freshness: {freshness}")
+
+    @metrics.timed('persistence_duration_seconds', operation='product_info_load')
+    def load(self):
+        apps = {}
+        try:
+            with open(self.filename, 'r') as f:
+                apps = json.load(f).get('apps', {})
+        except FileNotFoundError:
+            logging.info(f"{self.filename} does not exist yet, starting empty")
+        except (json.JSONDecodeError, AttributeError) as e:
+            # Only a cache, everything is downloaded again
+            logging.warning(f"Discarding unreadable product info cache {self.filename}: {str(e)}")
+        with self.lock:
+            self.apps = apps
+            self.loaded = True
+        logging.info(f"Loaded cached product info for {len(apps)} AppIDs")
+
+    @metrics.timed('persistence_duration_seconds', operation='product_info_save')
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            content = json.dumps({"apps": self.apps}, separators=(',', ':'))
+            self.dirty = False
+        temp_filename = f"{self.filename}.tmp"
+        try:
+            with open(temp_filename, 'w') as f:
+                f.write(content)
+            os.replace(temp_filename, self.filename)
+        except OSError as e:
+            logging.error(f"Could not save the product info cache: {str(e)}")
+            with self.lock:
+                self.dirty = True
+
+    def has(self, app_id):
+        with self.lock:
+            return app_id in self.apps
+
+    # Checked within the freshness window, handed out without asking Steam
+    def is_fresh(self, app_id, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            record = self.apps.get(app_id)
+            return record is not None and now - record['checked_at'] < self.freshness
+
+    def parsed(self, app_id):
+        with self.lock:
+            record = self.apps.get(app_id)
+            return dict(record['parsed']) if record is not None else None
+
+    def access_token(self, app_id):
+        with self.lock:
+            record = self.apps.get(app_id)
+            return record['access_token'] if record is not None else None
+
+    # The oldest point the cached info of app_ids was known to be current at, where a change query has to start
+    def since(self, app_ids):
+        with self.lock:
+            return min((self.apps[app_id]['verified_change'] for app_id in app_ids if app_id in self.apps), default=0)
+
+    # The cached app_ids whose change number in changes (app id -> change number) is newer than the cached info
+    def changed(self, app_ids, changes):
+        with self.lock:
+            return [app_id for app_id in app_ids if app_id not in self.apps
+                    or changes.get(app_id, 0) > self.apps[app_id]['change_number']]
+
+    # The cached info of app_ids was current at change_number
+    def verified(self, app_ids, change_number, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            for app_id in app_ids:
+                record = self.apps.get(app_id)
+                if record is not None:
+                    record['verified_change'] = max(record['verified_change'], change_number)
+                    record['checked_at'] = now
+
+    def store(self, app_id, change_number, access_token, info, parsed, verified_change=0, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.apps[app_id] = {
+                "change_number": change_number,
+                "access_token": access_token,
+                "verified_change": max(verified_change, change_number),
+                "checked_at": now,
+                "info": info,
+                "parsed": parsed,
+            }
+            self.dirty = True
@@ -0,0 +1,166 @@
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+
+
+# Raised for calls that did not complete within their timeout on the Steam thread
+class SteamTimeoutError(TimeoutError):
+    pass
+
+
+# Owns a SteamClient and the gevent hub it runs on in a dedicated thread, so Steam logins and requests never
+# run on the asyncio event loop. Calls are queued from the event loop and wake the hub through an async watcher,
+# so an idle thread sleeps instead of polling the queue. Each call runs in its own greenlet with a
+# gevent timeout, and cancelling the awaiting task kills the greenlet. The client is logged on anonymously
+# before the first call and again whenever Steam dropped the session. The thread, and with it gevent and steam, only
+# starts with the first call, so nothing of Steam is imported before the bot logs in.
+class SteamWorker:
+    def __init__(self, timeout=30, login_timeout=15):
+        self.timeout = timeout
+        self.login_timeout = login_timeout
+        self.requests = queue.Queue()
+        self.thread = None
+        self.client = None
+        # The hub's async watcher, its send() is the one call that is safe from other threads
+        self.wakeup = None
+        # Only touched from the Steam thread
+        self.active = {}
+        self.login_lock = None
+        logging.debug(f"SteamWorker initialized with timeout: {timeout}, login_timeout: {login_timeout}")
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.run, name='steam-worker', daemon=True)
+        self.thread.start()
+        logging.info("SteamWorker started")
+
+    async def stop(self, timeout=10):
+        if self.thread is None:
+            return
+        self.put(None)
+        await asyncio.to_thread(self.thread.join, timeout)
+        self.thread = None
+        logging.info("SteamWorker stopped")
+
+    # Run func(client, *args) on the Steam thread and wait for its result without blocking the event loop
+    async def call(self, func, *args, timeout=None, login=True):
+        self.start()
+        timeout = timeout or self.timeout
+        future = concurrent.futures.Future()
+        self.put(('call', func, args, timeout, login, future))
+        try:
+            # The gevent timeout fires first, this one only guards against a stalled Steam thread
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout + self.login_timeout + 5)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            # Queued calls are cancelled by wrap_future, running ones need their greenlet killed
+            self.put(('cancel', future))
+            raise
+
+    def put(self, request):
+        self.requests.put(request)
+        wakeup = self.wakeup
+        if wakeup is not None:
+            wakeup.send()
+
+    def queue_depth(self):
+        return self.requests.qsize()
+
+    # Everything below runs on the Steam thread
+    def run(self):
+        try:
+            import gevent
+            import gevent.event
+            import gevent.lock
+            from steam.client import SteamClient
+
+            self.client = SteamClient()
+        except Exception as e:
+            logging.error(f"Could not start the Steam client: {str(e)}. Type: {type(e).__name__}")
+            self.fail_queued(e)
+            return
+        self.client.verbose_debug = False
+        self.login_lock = gevent.lock.Semaphore()
+        # The watcher stays started, so a send() between draining the queue and waiting still sets queued
+        queued = gevent.event.Event()
+        wakeup = gevent.get_hub().loop.async_()
+        wakeup.start(queued.set)
+        self.wakeup = wakeup
+        try:
+            while True:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    # Waiting in gevent keeps the client's own greenlets (heartbeats, messages) running
+                    queued.wait()
+                    queued.clear()
+                    continue
+
+                if request is None:
+                    break
+                if request[0] == 'cancel':
+                    greenlet = self.active.pop(request[1], None)
+                    if greenlet is not None:
+                        greenlet.kill(block=False)
+                    continue
+
+                _, func, args, timeout, login, future = request
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.active[future] = gevent.spawn(self.execute, func, args, timeout, login, future)
+        finally:
+            self.wakeup = None
+            wakeup.stop()
+            for greenlet in list(self.active.values()):
+                greenlet.kill(block=False)
+            self.active.clear()
+            try:
+                self.client.logout()
+                self.client.disconnect()
+            except Exception as e:
+                logging.error(f"An unexpected error occurred while disconnecting from Steam: {str(e)}. "
+                              f"Type: {type(e).__name__}")
+
+    # Fail the calls waiting in the queue when the thread can not run them
+    def fail_queued(self, error):
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if request is not None and request[0] == 'call' and request[5].set_running_or_notify_cancel():
+                request[5].set_exception(error)
+
+    def execute(self, func, args, timeout, login, future):
+        import gevent
+
+        try:
+            name = getattr(func, '__name__', repr(func))
+            with gevent.Timeout(timeout, SteamTimeoutError(f"{name} timed out after {timeout}s")):
+                if login:
+                    self.ensure_login()
+                result = func(self.client, *args)
+        except gevent.GreenletExit:
+            future.set_exception(concurrent.futures.CancelledError())
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            self.active.pop(future, None)
+
+    def ensure_login(self):
+        import gevent
+        from steam.enums import EResult
+
+        with self.login_lock:
+            if self.client.logged_on:
+                return
+            logging.debug("Client not logged on, logging on")
+            with gevent.Timeout(self.login_timeout, SteamTimeoutError(f"Login timed out after {self.login_timeout}s")):
+                result = self.client.anonymous_login()
+            if result != EResult.OK:
+                raise ConnectionError(f"Anonymous login failed: {result!r}")
+            logging.debug("Anonymous login for client successful")